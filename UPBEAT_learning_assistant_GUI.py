@@ -1,6 +1,6 @@
 import os
-import pickle
 import tempfile
+import uuid
 from datetime import datetime
 
 import gradio as gr
@@ -10,20 +10,28 @@ from langchain_community.tools import TavilySearchResults
 from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.prebuilt import create_react_agent
 
+from plan_store import PlanStore, open_plan_store, refresh_plan_store
+from sqlite_checkpointer import SqliteCheckpointer
+from state_store import open_state_store
+
 # TODO:
 # -adding more model options
 
 # --- CONFIGURATION ---
 IS_DEBUG = 1
 STUDY_PLANS_FILE = r'learning_plans/study_plans_data.pickle'
+STUDY_PLANS_STORE = r'learning_plans/study_plans'
 CURATED_MATERIALS_FILE = r'data/curated_additional_materials.txt'
 LLM_MODEL="gpt-4o"
 TRAINING_PERIOD_START = datetime(2025, month=3, day=1, hour=6)
 TRAINING_PERIOD_END = datetime(2025, month=3, day=30, hour=23)
 ENABLE_STREAM=1
+CONVERSATION_DB_FILE = os.getenv('CONVERSATION_DB_FILE', r'user_data/conversations.sqlite')  # Shared with the API
+CONVERSATION_KEEP_CHECKPOINTS = 5
+CONVERSATION_MAX_USER_BYTES = 5 * 1024 * 1024
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', r'user_data/state.sqlite')  # Shared with the API
 
 # --- ENVIRONMENT SETUP ---
 def setup_environment():
@@ -52,13 +60,21 @@ user_data = None
 session_counter = 0
 session_snapshots = []
 print('loading study plans data...',end='')
-user_datasets = pickle.load(open(STUDY_PLANS_FILE, 'rb')) # AT ROOT
+user_datasets = open_plan_store(STUDY_PLANS_STORE, STUDY_PLANS_FILE) # AT ROOT
+study_plans_mtime = os.path.getmtime(STUDY_PLANS_FILE) if os.path.exists(STUDY_PLANS_FILE) else None
 print(f' done ({len(user_datasets)} items loaded)')
 print('loading curated materials data...',end='')
 additional_courses_data = pd.read_csv(CURATED_MATERIALS_FILE, sep='|', index_col=0)
 additional_courses_data = (additional_courses_data['description'] + ' URL: ' + additional_courses_data['url']).to_list()
 print(f' done ({len(additional_courses_data)} items)')
 llm_options = {}
+conversation_memory = SqliteCheckpointer(
+    CONVERSATION_DB_FILE,
+    keep_latest=CONVERSATION_KEEP_CHECKPOINTS,
+    max_user_bytes=CONVERSATION_MAX_USER_BYTES
+)
+conversation_memory.start_background_compaction()
+state_store = open_state_store(STATE_DB_FILE, 'user_data')
 print('setting environment...',end='')
 current_phase = setup_environment()
 print(' done')
@@ -115,8 +131,11 @@ def update_agents():
     """Update the LLM agents based on current options"""
     global llm_options
 
-    llm_options['config'] = {"configurable": {"thread_id": "1"}}
-    llm_options['memory'] = MemorySaver()
+    # Every update starts a new conversation thread, earlier ones stay in the database
+    llm_options['config'] = {"configurable": {
+        "thread_id": f"gui-{user_data['username']}-{uuid.uuid4().hex[:8]}",
+        "user_id": user_data['username']}}
+    llm_options['memory'] = conversation_memory
 
     # Create tool lists based on settings
     phase1_tools = []
@@ -184,63 +203,38 @@ def predict(message, history):
     return response
 
 # --- USER DATA & AUTHENTICATION ---
-# Add these functions for user state management
-def ensure_user_directory(username):
-    """Create user directory if it doesn't exist"""
-    user_dir = os.path.join('user_data', username)
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir, exist_ok=True)
-    return user_dir
-
 def load_user_state(username):
-    """Load user state from pickle file or create default if not exists"""
-    user_dir = ensure_user_directory(username)
-    state_file = os.path.join(user_dir, 'state_variables.pickle')
-
-    if os.path.exists(state_file):
-        try:
-            with open(state_file, 'rb') as f:
-                return pickle.load(f)
-        except Exception as e:
-            raise(Exception(f"Error loading user state: {e}"))
-    else:
-        return None
+    """Load user state from the state store, None if not saved yet"""
+    try:
+        return state_store.load_learning_state(username)
+    except Exception as e:
+        raise(Exception(f"Error loading user state: {e}"))
 
 def save_user_state(username, state):
-    """Save user state to pickle file using a safe temp file method"""
-    user_dir = ensure_user_directory(username)
-    state_file = os.path.join(user_dir, 'state_variables.pickle')
-    temp_file = os.path.join(user_dir, 'state_variables.temp.pickle')
-
+    """Save user state to the state store"""
     try:
-        # First write to a temporary file
-        with open(temp_file, 'wb') as f:
-            pickle.dump(state, f)
-            f.flush()  # Ensure data is written to disk
-            os.fsync(f.fileno())  # Force write to physical storage
-
-        # Then rename the temp file to the target file (atomic operation)
-        if os.path.exists(state_file):
-            # On Windows, we need to remove the target file first
-            if os.name == 'nt' and os.path.exists(state_file):
-                os.remove(state_file)
-
-        os.rename(temp_file, state_file)
+        state_store.save_learning_state(username, state)
         return True
     except Exception as e:
         print(f"Error saving user state: {e}")
-        # Clean up temp file if it exists after an error
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
         return False
 
+def reload_study_plans():
+    """Reopen the study plans if a new plans file was published (or converted by the API)"""
+    global user_datasets, study_plans_mtime
+    if os.path.exists(STUDY_PLANS_FILE) and os.path.getmtime(STUDY_PLANS_FILE) != study_plans_mtime:
+        study_plans_mtime = os.path.getmtime(STUDY_PLANS_FILE)
+        refresh_plan_store(STUDY_PLANS_STORE, STUDY_PLANS_FILE)
+    if os.path.getmtime(STUDY_PLANS_STORE + '.index.json') != user_datasets.modified:
+        user_datasets = PlanStore(STUDY_PLANS_STORE)
+        print(f'reloaded study plans ({len(user_datasets)} items)')
+
 def authenticate(username, password):
     """Authenticate user with username and password"""
     global user_data
 
+    reload_study_plans()
+
     if username in user_datasets and user_datasets[username]['password'] == password:
         user_data = user_datasets[username]
         user_data['username'] = username
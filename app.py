@@ -5,97 +5,230 @@ This is a FastAPI backend for a learning assistant application that provides lea
 to users and chatbot functionality.
 """
 
+import asyncio
+import gzip
+import hashlib
+import json
+import math
+import threading
 import os
-import pickle
 import re
-import tempfile
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from email.utils import formatdate, parsedate_to_datetime
+from itertools import islice
+from typing import Annotated, Any, Dict, List, NotRequired, Optional
 
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
-from langchain_community.tools import TavilySearchResults
-from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
-from langchain_core.tools import tool
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.tools import StructuredTool, tool
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.prebuilt import create_react_agent
+from langgraph.config import get_config
+from langgraph.constants import TAG_NOSTREAM
+from langgraph.prebuilt import InjectedState, create_react_agent
+from langgraph.prebuilt.chat_agent_executor import AgentState
 from pydantic import BaseModel
 
+try:
+    import orjson  # Optional, several times faster than the json module for the cached payloads
+except ImportError:
+    orjson = None
+
+import metrics
+import tracing
+from plan_store import PlanStore, open_plan_store, refresh_plan_store
+from sqlite_checkpointer import SqliteCheckpointer
+from state_store import LearningStateBuffer, open_state_store
+from web_search import CachedSearch, FixtureBackend, TavilyBackend, extract_results, extraction_stats
+
 # --- CONFIGURATION ---
 IS_DEBUG = 1  # Set to 0 in production environment
 STUDY_PLANS_FILE = r'learning_plans/study_plans_data.pickle'
+STUDY_PLANS_STORE = r'learning_plans/study_plans'  # Plan store converted from STUDY_PLANS_FILE when that is newer
+STUDY_PLANS_RELOAD_INTERVAL = int(os.getenv('STUDY_PLANS_RELOAD_INTERVAL', 30))  # Seconds between checks for new study plans, 0 disables reloading
 CURATED_MATERIALS_FILE = r'data/curated_additional_materials.txt'
+MATERIALS_TOP_K = 5  # Curated materials returned per additional_materials_tool call
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'tavily')  # 'tavily', or 'fixture' for offline development and benchmarks
+SEARCH_FIXTURE_FILE = os.getenv('SEARCH_FIXTURE_FILE')  # Optional JSON of {query: results} for the fixture backend
+SEARCH_CACHE_TTL = 24 * 3600  # Seconds a web search result is reused
+SEARCH_CACHE_SIZE = 1000  # Max. search queries cached in memory
+SEARCH_CACHE_DB_FILE = os.getenv('SEARCH_CACHE_DB_FILE', r'user_data/search_cache.sqlite')  # Persistent search cache shared by the workers
+SEARCH_CACHE_DB_MAX_ROWS = 50000  # Max. search results kept in the persistent cache, the oldest ones are dropped
+SEARCH_RESULT_TOKEN_BUDGET = 350  # Max. tokens of page content passed to the agent per search result
 LLM_MODEL = "gpt-4o"  # You can change to another model if needed
 TRAINING_PERIOD_START = datetime(2025, month=3, day=1, hour=6)
 TRAINING_PERIOD_END = datetime(2025, month=3, day=30, hour=23)
+PDF_CHUNK_SIZE = 64 * 1024  # Bytes of a PDF sent per chunk, PDFs are streamed from the plan store map
+PRECOMPUTE_STRUCTURED_PLANS = bool(int(os.getenv('PRECOMPUTE_STRUCTURED_PLANS', 0)))  # Parse all plans in each worker at startup, by default plans are parsed on first access
+AGENT_POOL_CAPACITY = int(os.getenv('AGENT_POOL_CAPACITY', 500))  # Max. number of users with an agent in memory
+AGENT_POOL_IDLE_TTL = int(os.getenv('AGENT_POOL_IDLE_TTL', 3600))  # Seconds of inactivity before an agent is evicted
+CHAT_CONCURRENCY_LIMIT = int(os.getenv('CHAT_CONCURRENCY_LIMIT', 16))  # Max. concurrently running chat turns (streamed or not) per worker
+CHAT_QUEUE_LIMIT = int(os.getenv('CHAT_QUEUE_LIMIT', 100))  # Max. chat turns waiting for a free slot per worker, further turns get 429
+STREAM_RING_BUFFER_SIZE = 1024  # Events kept per chat stream for Last-Event-ID resumption
+STREAM_RETENTION_SECONDS = 300  # How long finished chat streams can still be resumed
+STREAM_RECONNECT_MS = 2000  # SSE retry interval suggested to clients
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv('STREAM_FLUSH_INTERVAL_MS', 50))  # Max. time tokens are coalesced before sending, 0 sends every token
+STREAM_FLUSH_CHARS = int(os.getenv('STREAM_FLUSH_CHARS', 256))  # Coalesced tokens are sent once they reach this many characters
+CONVERSATION_DB_FILE = os.getenv('CONVERSATION_DB_FILE', r'user_data/conversations.sqlite')  # Shared by all workers on the host
+CONVERSATION_KEEP_CHECKPOINTS = 5  # Latest checkpoints kept per conversation thread
+CONVERSATION_MAX_USER_BYTES = 5 * 1024 * 1024  # Max. stored conversation checkpoints per user
+CONVERSATION_COMPACTION_INTERVAL = 30  # Seconds between compaction passes
+CONVERSATION_TOKEN_BUDGET = int(os.getenv('CONVERSATION_TOKEN_BUDGET', 6000))  # History tokens sent to the model before older turns are summarized
+CONVERSATION_KEEP_RECENT_TOKENS = 2000  # Latest history kept word for word when older turns are summarized
+SUMMARY_MODEL = "gpt-4o-mini"  # Model writing the running summary of older turns
+SUMMARY_TOOL_OUTPUT_CHARS = 300  # Tool outputs are shortened to this length for the summary
+USER_DATA_DIR = r'user_data'  # Per-user pickle files of earlier versions, imported to the state store once
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', r'user_data/state.sqlite')  # Milestone states and agent settings of all users
+MILESTONE_DURABILITY = os.getenv('MILESTONE_DURABILITY', 'write-behind')  # 'write-behind', or 'sync' to write each update before responding
+MILESTONE_FLUSH_INTERVAL_MS = int(os.getenv('MILESTONE_FLUSH_INTERVAL_MS', 1000))  # Max. time a milestone update waits for its write
+STATE_EVENT_POLL_MS = int(os.getenv('STATE_EVENT_POLL_MS', 500))  # How often a worker reads the state changes of the other workers
+STATE_EVENT_RETENTION = 3600  # Seconds invalidation events are kept
+ANSWER_CACHE_ENABLED = bool(int(os.getenv('ANSWER_CACHE_ENABLED', 0)))  # Answer repeated plan questions from a cache, see ANSWER CACHE
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 3600))  # Seconds a cached answer is reused
+ANSWER_CACHE_SIZE = 5000  # Max. cached answers per worker
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))  # Fraction of chat turns traced, 0 disables tracing
+TRACE_FILE = os.getenv('TRACE_FILE', r'user_data/traces.jsonl')  # Spans of the traced chat turns, one JSON object per line
 
 # --- LEARNING PLAN PARSER ---
+# The parser works line by line: every line is classified once with anchored,
+# backtracking-free patterns, so parsing time stays linear in the plan size even
+# for long or malformed LLM output.
+SECTION_HEADER_PATTERN = re.compile(r'(\d+)\.\s+(\S.*)')
+TOPIC_HEADER_PATTERN = re.compile(r'(\d+)\s+(\S.*)')
+MATERIAL_ITEM_PATTERN = re.compile(r'(\d+):\s*(.*)')
+LIST_MARKER_PATTERN = re.compile(r'(?:[-*+•]|\d+[.)])\s+')
+ENDING_PREFIXES = ('We are glad to have you onboard', 'We hope you have a fruitful learning period')
+ASSIGNMENT_LABELS = {
+    'task': 'task',
+    'process': 'process',
+    'tool': 'tools',
+    'tools': 'tools',
+    'sample prompt': 'sample_prompt',
+    'example prompt': 'sample_prompt'
+}
+DEFAULT_OBJECTIVE_CATEGORY = 'Learning objectives'
+
+def strip_heading_marker(line: str) -> str:
+    """Removes Markdown heading markers ("## ") from a line"""
+    return line.lstrip('#').strip()
+
+def strip_list_marker(line: str) -> str:
+    """Removes a bullet or numbered list marker ("- ", "* ", "1. ") from a line"""
+    match = LIST_MARKER_PATTERN.match(line)
+    return line[match.end():] if match else line
+
 def parse_learning_plan(plan_text: str) -> Dict:
     """
     Parses the learning plan text into a structured JSON object.
     
+    Both the Markdown format produced by the plan generator ("## 1. Title") and the
+    older plain text format ("1. Title") are supported.
+    
     Args:
         plan_text: Learning plan Markdown text
     
     Returns:
         Dict: Parsed plan with section names as keys
     """
-    # Separate title and introduction
-    title_match = re.search(r'^(.*?)\n(Dear.*?)(?=\n\n\d+\.)', plan_text, re.DOTALL)
+    lines = plan_text.split('\n')
+    
+    # Classify lines in a single pass
+    dear_index = None
+    ending_index = None
+    markdown_headers = []
+    plain_headers = []
+    
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        
+        if stripped.startswith('#'):
+            header_match = SECTION_HEADER_PATTERN.fullmatch(strip_heading_marker(stripped))
+            if header_match:
+                markdown_headers.append((index, header_match.group(1), header_match.group(2)))
+            continue
+        
+        if dear_index is None and stripped.startswith('Dear'):
+            dear_index = index
+        elif ending_index is None and stripped.startswith(ENDING_PREFIXES):
+            ending_index = index
+        else:
+            header_match = SECTION_HEADER_PATTERN.fullmatch(stripped)
+            if header_match:
+                plain_headers.append((index, header_match.group(1), header_match.group(2)))
     
-    if not title_match:
+    # Markdown headers take precedence, numbered list items are then part of the content
+    headers = markdown_headers or plain_headers
+    if dear_index is not None:
+        headers = [header for header in headers if header[0] > dear_index]
+    
+    # Separate title and introduction
+    if dear_index is None or not headers:
         return {"error": "Couldn't parse the learning plan format"}
     
-    title = title_match.group(1).strip()
-    introduction = title_match.group(2).strip()
+    title = '\n'.join(strip_heading_marker(line) for line in lines[:dear_index] if line.strip())
+    introduction = '\n'.join(lines[dear_index:headers[0][0]]).strip()
     
-    # Identify different sections
-    # Find all headers in the format "## X. Title" and their contents
-    section_pattern = r'(?:^|\n)(\d+)\.\s+(.*?)\n(.*?)(?=\n\d+\.|$)'
-    sections_raw = re.findall(section_pattern, plan_text, re.DOTALL)
+    # Extract the final paragraph
+    if ending_index is not None and ending_index > headers[-1][0]:
+        ending = '\n'.join(lines[ending_index:]).strip()
+        content_end = ending_index
+    else:
+        ending = ""
+        content_end = len(lines)
     
     sections = {}
     
     # Process found sections
-    for section_num, section_title, section_content in sections_raw:
+    for position, (start, section_num, section_title) in enumerate(headers):
+        end = headers[position + 1][0] if position + 1 < len(headers) else content_end
+        section_content = '\n'.join(lines[start + 1:end]).strip()
+        
         key = f"section_{section_num}"
         sections[key] = {
             "number": section_num,
             "title": section_title.strip(),
-            "content": section_content.strip()
+            "content": section_content
         }
         
+        title_lower = section_title.lower()
+        
         # Special handling for topic sections (Essential learning topics)
-        if "Essential learning topics" in section_title:
+        if "essential learning topics" in title_lower:
             topics = parse_learning_topics(section_content)
             if topics:
                 sections[key]["topics"] = topics
                 
         # Special handling for learning objectives
-        elif "Learning objectives" in section_title:
+        elif "learning objectives" in title_lower or "learning goals" in title_lower:
             objectives = parse_learning_objectives(section_content)
             if objectives:
                 sections[key]["objectives"] = objectives
                 
         # Special handling for assignments (Extra assignments)
-        elif "Extra assignments" in section_title:
+        elif "extra assignments" in title_lower:
             assignments = parse_assignments(section_content)
             if assignments:
                 sections[key]["assignments"] = assignments
                 
         # Special handling for additional materials
-        elif "Additional" in section_title:
+        elif "additional" in title_lower:
             materials = parse_additional_materials(section_content)
             if materials:
                 sections[key]["materials"] = materials
-                
-    # Extract the final paragraph
-    ending_match = re.search(r'We are glad to have you onboard.*', plan_text, re.DOTALL)
-    ending = ending_match.group(0) if ending_match else ""
     
     # Build the final result
     result = {
@@ -109,17 +242,28 @@ def parse_learning_plan(plan_text: str) -> Dict:
 
 def parse_learning_topics(content: str) -> List[Dict]:
     """Parses learning topics into a list"""
-    # Finds numbered topics, e.g. "1 Generative AI skills"
-    topic_pattern = r'(\d+)\s+(.*?)(?=\n|$)(.*?)(?=\n\d+\s+|$)'
-    topics_raw = re.findall(topic_pattern, content, re.DOTALL)
-    
+    # Finds numbered topics, e.g. "1 Generative AI skills" or "### 1 Generative AI skills"
     topics = []
-    for num, title, description in topics_raw:
-        topics.append({
-            "number": num,
-            "title": title.strip(),
-            "description": description.strip()
-        })
+    description_lines = []
+    
+    for line in content.split('\n'):
+        stripped = line.strip()
+        topic_match = TOPIC_HEADER_PATTERN.fullmatch(strip_heading_marker(stripped)) if stripped else None
+        
+        if topic_match:
+            if topics:
+                topics[-1]["description"] = '\n'.join(description_lines).strip()
+            topics.append({
+                "number": topic_match.group(1),
+                "title": topic_match.group(2).strip(),
+                "description": ""
+            })
+            description_lines = []
+        elif topics:
+            description_lines.append(stripped)
+    
+    if topics:
+        topics[-1]["description"] = '\n'.join(description_lines).strip()
     
     return topics
 
@@ -127,69 +271,344 @@ def parse_learning_objectives(content: str) -> Dict[str, List[str]]:
     """Parses learning objectives"""
     # Finds topics and their bullet points
     objective_groups = {}
+    category = None
+    after_blank_line = True
     
-    # Identify topics and add them to the object
-    category_pattern = r'(.*?)\n((?:.*?\n)*?)(?=\n[A-Za-z]|$)'
-    matches = re.findall(category_pattern, content)
-    
-    for category, items_text in matches:
-        category = category.strip()
-        if not category:
+    for line in content.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            after_blank_line = True
             continue
-            
-        # Split text rows into a list and remove empty ones
-        items = [line.strip() for line in items_text.split('\n') if line.strip()]
-        objective_groups[category] = items
+        
+        # A heading, or the first non-list line of a paragraph, starts a new category
+        is_list_item = LIST_MARKER_PATTERN.match(stripped) is not None
+        if stripped.startswith('#') or (after_blank_line and not is_list_item):
+            category = strip_heading_marker(stripped).strip('*').rstrip(':').strip()
+            objective_groups.setdefault(category, [])
+        else:
+            if category is None:
+                # Objectives listed without a category
+                category = DEFAULT_OBJECTIVE_CATEGORY
+                objective_groups.setdefault(category, [])
+            objective_groups[category].append(strip_list_marker(stripped))
+        after_blank_line = False
     
     return objective_groups
 
+def split_assignment_label(line: str):
+    """
+    Splits a labelled assignment line such as "Task: ..." or "**Sample prompt:** ...".
+    
+    Returns:
+        Tuple of (field name, value) or None if the line is not labelled
+    """
+    text = line.replace('**', '')
+    label, separator, value = text.partition(':')
+    if not separator:
+        return None
+    field = ASSIGNMENT_LABELS.get(label.strip().lower())
+    if field is None:
+        return None
+    return field, value.strip()
+
+def split_assignment_title(line: str):
+    """
+    Splits an assignment line that starts with a bold title, e.g. "1. **Title**: description".
+    
+    Returns:
+        Tuple of (title, description) or None if the line has no bold title
+    """
+    text = strip_list_marker(line)
+    if not text.startswith('**'):
+        return None
+    title_end = text.find('**', 2)
+    if title_end == -1:
+        return None
+    title = strip_list_marker(text[2:title_end].strip()).rstrip(':').strip()
+    description = text[title_end + 2:].strip().lstrip(':').strip()
+    return title, description
+
 def parse_assignments(content: str) -> List[Dict]:
     """Parses assignments"""
-    # Identify assignments and their descriptions
-    assignment_pattern = r'(.*?)\nTask:(.*?)(?:Process:|Tool:|$)(.*?)(?:Tool:|Sample prompt:|$)(.*?)(?:Sample prompt:|$)(.*?)(?=\n\n|$)'
-    assignments_raw = re.findall(assignment_pattern, content, re.DOTALL)
-    
+    # Identify assignments and their descriptions. Supported layouts are a plain title
+    # followed by "Task:"/"Process:"/... lines, bold titles ("1. **Title**: description")
+    # and headings ("### Assignment for Module 1: Title") followed by a description.
+    # Field values are collected as lists of lines and joined at the end, so long
+    # descriptions are parsed in linear time.
     assignments = []
-    for matches in assignments_raw:
-        # Remove empty strings and process the remaining ones
-        parts = [p.strip() for p in matches if p.strip()]
+    current = None
+    current_field = None
+    heading = None
+    markdown_layout = False
+    after_blank_line = True
+    
+    for line in content.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            after_blank_line = True
+            continue
         
-        if len(parts) < 2:
+        if stripped.startswith('#'):
+            # Headings group assignments and become the title when no bold title follows
+            heading = strip_heading_marker(stripped)
+            markdown_layout = True
+            current = None
+            current_field = None
+            after_blank_line = False
             continue
-            
-        assignment = {"title": parts[0]}
         
-        # Find key-value pairs where the key is "Task:", "Process:", etc.
-        for i in range(1, len(parts)):
-            if "Task:" in parts[i-1]:
-                assignment["task"] = parts[i]
-            elif "Process:" in parts[i-1]:
-                assignment["process"] = parts[i]
-            elif "Tool:" in parts[i-1] or "Tools:" in parts[i-1]:
-                assignment["tools"] = parts[i]
-            elif "Sample prompt:" in parts[i-1]:
-                assignment["sample_prompt"] = parts[i]
+        labelled = split_assignment_label(strip_list_marker(stripped))
+        bold_title = split_assignment_title(stripped)
         
-        assignments.append(assignment)
-    
-    return assignments
+        if labelled and current is not None:
+            # Key-value lines where the key is "Task:", "Process:", etc.
+            current_field, value = labelled
+            current[current_field] = [value]
+        elif bold_title:
+            title, description = bold_title
+            markdown_layout = True
+            current = {"title": [title]}
+            assignments.append(current)
+            current_field = 'task'
+            if description:
+                current['task'] = [description]
+        elif heading is not None and current is None:
+            current = {"title": [heading], "task": [stripped]}
+            assignments.append(current)
+            current_field = 'task'
+        elif not markdown_layout and (after_blank_line or current is None):
+            # Plain text title followed by labelled lines
+            current = {"title": [stripped]}
+            assignments.append(current)
+            current_field = None
+        elif current is not None:
+            # Continuation lines, list items always belong to the task description
+            field = 'task' if current_field is None or LIST_MARKER_PATTERN.match(stripped) else current_field
+            if field == 'task' and current_field is None and 'task' not in current:
+                current['title'].append(stripped)
+            else:
+                current.setdefault(field, []).append(stripped)
+        after_blank_line = False
+    
+    # Assignments need at least a title and one description field
+    return [{field: '\n'.join(value_lines) for field, value_lines in assignment.items()}
+            for assignment in assignments if len(assignment) > 1]
 
 def parse_additional_materials(content: str) -> List[Dict]:
     """Parses additional materials"""
-    # This typically contains numbered items and URLs
-    material_pattern = r'(\d+): (.*?)(?=\nhttp|\n\d+:|$)\n?(https?://[^\s]+)?'
-    materials_raw = re.findall(material_pattern, content, re.DOTALL)
-    
+    # This typically contains numbered items and URLs, either on the next line
+    # or separated from the description with "<br>". Description lines are
+    # joined at the end, so long descriptions are parsed in linear time.
     materials = []
-    for num, description, url in materials_raw:
-        materials.append({
-            "number": num,
-            "description": description.strip(),
-            "url": url.strip() if url else None
-        })
+    description_lines = {}  # item index -> continuation lines of its description
+    current = None
     
+    for line in content.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        
+        material_match = MATERIAL_ITEM_PATTERN.fullmatch(stripped)
+        if material_match:
+            description, _, url = material_match.group(2).partition('<br>')
+            current = {
+                "number": material_match.group(1),
+                "description": description.strip(),
+                "url": url.strip() if url.strip().startswith(('http://', 'https://')) else None
+            }
+            materials.append(current)
+        elif current is not None and current["url"] is None:
+            if stripped.startswith(('http://', 'https://')):
+                current["url"] = stripped.split()[0]
+            else:
+                description_lines.setdefault(len(materials) - 1, []).append(stripped)
+    
+    for index, lines in description_lines.items():
+        materials[index]["description"] = '\n'.join([materials[index]["description"]] + lines)
     return materials
 
+# --- JSON SERIALIZATION ---
+def dumps_json(value) -> bytes:
+    """Serializes a value of plain Python types to compact UTF-8 JSON, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# --- STRUCTURED PLAN CACHE ---
+# Parsed plans are stored as ready-to-send JSON bytes (plain and gzip) so that
+# repeated requests from the tab view cost only a dict lookup.
+structured_plan_cache = {}
+
+def get_structured_plan_entry(user_id: str, phase: int) -> Dict:
+    """
+    Returns the cached structured plan entry for a user and phase, parsing the plan on first access.
+    
+    An entry is only used while it has the content hash of the user's data in
+    the plan store, so a plan changed on reload is parsed again. Reloads also
+    drop the entries of changed users.
+    
+    Returns:
+        Dict: Entry with 'body' (JSON bytes), 'gzip_body' (gzip-compressed JSON bytes)
+              and an ETag for each of them
+    """
+    plan_hash = user_datasets.content_hash(user_id)
+    entry = structured_plan_cache.get((user_id, phase))
+    if entry is not None and entry['plan_hash'] == plan_hash:
+        return entry
+    
+    plan_key = 'smart_plan_phase1' if phase == 1 else 'smart_plan_phase2'
+    body = dumps_json(parse_learning_plan(user_datasets[user_id][plan_key]))
+    body_hash = hashlib.sha256(body).hexdigest()[:32]
+    entry = {
+        'plan_hash': plan_hash,
+        'etag': f'"{body_hash}"',
+        'gzip_etag': f'"{body_hash}-gzip"',
+        'body': body,
+        'gzip_body': gzip.compress(body, compresslevel=9, mtime=0)
+    }
+    structured_plan_cache[(user_id, phase)] = entry
+    return entry
+
+def warm_structured_plan_cache():
+    """Parses and caches the structured plans of all users"""
+    for user_id in list(user_datasets.keys()):
+        for phase in (1, 2):
+            get_structured_plan_entry(user_id, phase)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Checks an If-None-Match header value against an ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    for candidate in if_none_match.split(','):
+        if candidate.strip().removeprefix('W/') == opaque_tag:
+            return True
+    return False
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Checks whether the client accepts gzip content encoding"""
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+# --- USER PAYLOAD CACHE ---
+# The /api/user response is stored as JSON bytes per user. The plans, milestones
+# and survey answers are serialized once, the learning state is added when the
+# body is built, and saving the learning state drops the body.
+user_payload_cache = {}
+user_payload_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def get_user_payload(user_id: str) -> bytes:
+    """Returns the JSON body of /api/user for a user, building it on first access or after a state change"""
+    entry = user_payload_cache.get(user_id)
+    if entry is not None and entry['body'] is not None:
+        user_payload_stats['hits'] += 1
+        return entry['body']
+    
+    user_payload_stats['misses'] += 1
+    if entry is None:
+        # The plan store has normalized the records to plain Python types
+        record = user_datasets[user_id]
+        static_fields = dumps_json({
+            "username": user_id,
+            "smart_plan_phase1": record["smart_plan_phase1"],
+            "smart_plan_phase2": record["smart_plan_phase2"],
+            "milestones": record["milestones"],
+            "data": record.get("data", {})
+        })
+        # Everything up to the learning state, the closing brace is added with the state
+        entry = {'prefix': static_fields[:-1] + b',"learning_state":', 'body': None}
+    
+    entry['body'] = entry['prefix'] + dumps_json(load_user_state(user_id)) + b'}'
+    user_payload_cache[user_id] = entry
+    return entry['body']
+
+def invalidate_user_payload(user_id: str):
+    """Drops the cached body of a user after a learning state change, the static part is kept"""
+    entry = user_payload_cache.get(user_id)
+    if entry is not None and entry['body'] is not None:
+        entry['body'] = None
+        user_payload_stats['invalidations'] += 1
+
+# --- PDF DOWNLOADS ---
+# PDFs are served straight from the plan store buffers. The validators of each
+# PDF are cached until a reload of the study plans changes the user's record.
+pdf_cache = {}
+
+def get_pdf_entry(user_id: str, phase: int) -> Dict:
+    """
+    Returns the PDF of a user and phase with its validators.
+
+    Returns:
+        Dict: Entry with 'data' (bytes-like PDF), 'etag', 'modified' (timestamp)
+              and 'last_modified' (HTTP date)
+    """
+    pdf_key = 'smart_plan_pdf_phase1' if phase == 1 else 'smart_plan_pdf_phase2'
+    data = user_datasets[user_id][pdf_key]
+
+    validators = pdf_cache.get((user_id, phase))
+    if validators is None:
+        modified = getattr(user_datasets, 'modified', 0)
+        validators = {
+            'modified': modified,
+            'etag': f'"{hashlib.sha256(data).hexdigest()[:32]}"',
+            'last_modified': formatdate(modified, usegmt=True)
+        }
+        pdf_cache[(user_id, phase)] = validators
+    return {'data': data, **validators}
+
+def iter_pdf_chunks(data):
+    """Yields a bytes-like PDF in chunks, only one chunk at a time is copied out of the plan store map"""
+    view = memoryview(data)
+    for offset in range(0, len(view), PDF_CHUNK_SIZE):
+        yield bytes(view[offset:offset + PDF_CHUNK_SIZE])
+
+def not_modified_since(if_modified_since: Optional[str], modified: float) -> bool:
+    """Checks an If-Modified-Since header value against a modification time"""
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since.tzinfo is not None and int(modified) <= since.timestamp()
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Parses a single-range Range header.
+
+    Returns:
+        tuple: (start, end) with an inclusive end, None to serve the full content
+               (no header or a multi-range request)
+
+    Raises:
+        ValueError: If the range cannot be satisfied
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+    ranges = range_header[len('bytes='):].split(',')
+    if len(ranges) != 1:
+        return None
+    first, _, last = ranges[0].strip().partition('-')
+    if not first:
+        # Suffix range: the last N bytes
+        if not last.isdigit() or int(last) == 0 or size == 0:
+            raise ValueError(range_header)
+        return max(0, size - int(last)), size - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        raise ValueError(range_header)
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(range_header)
+    return start, end
+
 # --- ENVIRONMENT SETUP ---
 def setup_environment():
     """Loads environment variables and determines current phase"""
@@ -211,22 +630,502 @@ def setup_environment():
     else:
         return 3
 
+# --- CURATED MATERIALS INDEX ---
+# TF-IDF index over the curated materials, so the materials tool returns only
+# the best matches for a query instead of the whole list. The file is checked
+# for changes on every search, and only new or changed rows are re-tokenized.
+TERM_PATTERN = re.compile(r'[a-z0-9]+')
+STOP_WORDS = frozenset(
+    'a an and are as at be by for from how in into is it its of on or that the their this to with your you'.split()
+)
+
+def stem(term: str) -> str:
+    """Strips common English suffixes, so that e.g. "pitching" and "pitch" match"""
+    for suffix in ('ing', 'ed', 's'):
+        if term.endswith(suffix) and not term.endswith('ss') and len(term) - len(suffix) >= 3:
+            return term[:-len(suffix)]
+    return term
+
+def tokenize(text: str) -> List[str]:
+    """Stemmed lowercase word terms of a text without stop words"""
+    return [stem(term) for term in TERM_PATTERN.findall(text.lower()) if term not in STOP_WORDS]
+
+class MaterialsIndex:
+    """TF-IDF index of the curated materials file, vectorized with NumPy"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        self.items = []
+        self.vocabulary = {}
+        self.idf = np.zeros(0)
+        self.matrix = np.zeros((0, 0))
+        self._term_counts = {}  # Row text -> term counts, reused when the file changes
+        self._lock = threading.Lock()
+        self.refresh()
+    
+    def __len__(self) -> int:
+        return len(self.items)
+    
+    def refresh(self) -> bool:
+        """Rebuilds the index if the file has changed, returns True if it was rebuilt"""
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        
+        with self._lock:
+            if mtime == self.mtime:
+                return False
+            materials = pd.read_csv(self.path, sep='|', index_col=0)
+            items = (materials['description'] + ' URL: ' + materials['url']).to_list()
+            
+            term_counts = {}
+            for item, description in zip(items, materials['description']):
+                if description in self._term_counts:
+                    term_counts[description] = self._term_counts[description]
+                else:
+                    terms, counts = np.unique(tokenize(description), return_counts=True)
+                    term_counts[description] = dict(zip(terms.tolist(), counts.tolist()))
+            
+            vocabulary = {}
+            for counts in term_counts.values():
+                for term in counts:
+                    vocabulary.setdefault(term, len(vocabulary))
+            
+            # Sublinear term frequencies, smoothed idf and L2 normalized rows
+            matrix = np.zeros((len(items), len(vocabulary)), dtype=np.float32)
+            for row, description in enumerate(materials['description']):
+                counts = term_counts[description]
+                matrix[row, [vocabulary[term] for term in counts]] = 1 + np.log(list(counts.values()))
+            document_frequency = np.count_nonzero(matrix, axis=0)
+            idf = (np.log((1 + len(items)) / (1 + document_frequency)) + 1).astype(np.float32)
+            matrix *= idf
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            
+            self.items, self.vocabulary, self.idf, self.matrix = items, vocabulary, idf, matrix
+            self._term_counts = term_counts
+            self.mtime = mtime
+        return True
+    
+    def search(self, query: str, top_k: int = MATERIALS_TOP_K) -> List[str]:
+        """Returns the top_k materials most similar to the query, best first"""
+        self.refresh()
+        items, vocabulary, idf, matrix = self.items, self.vocabulary, self.idf, self.matrix
+        
+        query_vector = np.zeros(len(vocabulary), dtype=np.float32)
+        for term in tokenize(query):
+            if term in vocabulary:
+                query_vector[vocabulary[term]] += 1
+        if not query_vector.any():
+            return []
+        
+        query_vector[query_vector > 0] = 1 + np.log(query_vector[query_vector > 0])
+        scores = matrix @ (query_vector * idf)
+        top_k = min(top_k, np.count_nonzero(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        return [items[row] for row in best[np.argsort(-scores[best])]]
+
 # --- GLOBAL STATE ---
 print('Loading study plans data...', end='')
-user_datasets = pickle.load(open(STUDY_PLANS_FILE, 'rb'))
+# Only the metadata index is loaded, plans and PDFs are read from the memory-mapped blob file on access
+user_datasets = open_plan_store(STUDY_PLANS_STORE, STUDY_PLANS_FILE)
 print(f' done ({len(user_datasets)} items loaded)')
 
+# Milestone states and agent settings of all users, shared by the workers
+state_store = open_state_store(STATE_DB_FILE, USER_DATA_DIR)
+# Learning states are served from memory, changes are written behind the requests
+learning_states = LearningStateBuffer(state_store, MILESTONE_DURABILITY)
+
 print('Loading curated materials data...', end='')
-additional_courses_data = pd.read_csv(CURATED_MATERIALS_FILE, sep='|', index_col=0)
-additional_courses_data = (additional_courses_data['description'] + ' URL: ' + additional_courses_data['url']).to_list()
-print(f' done ({len(additional_courses_data)} items)')
+materials_index = MaterialsIndex(CURATED_MATERIALS_FILE)
+print(f' done ({len(materials_index)} items indexed)')
 
 # Determine current phase
 current_phase = setup_environment()
 print(f'Current phase: {current_phase}')
 
+# --- METRICS ---
+# Exposed at /metrics in the Prometheus text format, each worker reports its own values.
+# Model calls and tool calls are measured by a callback handler passed in the
+# run config of the agents, so every model call and tool call of a run is covered.
+http_request_duration = metrics.Histogram(
+    'http_request_duration_seconds', 'Time to the response start per route', ('method', 'route', 'status'))
+chat_time_to_first_token = metrics.Histogram(
+    'chat_time_to_first_token_seconds', 'Time from the start of a streamed chat turn to its first token')
+chat_stream_duration = metrics.Histogram(
+    'chat_stream_duration_seconds', 'Duration of streamed chat turns', ('outcome',), buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+llm_request_duration = metrics.Histogram(
+    'llm_request_duration_seconds', 'Round-trip time of model calls', ('model', 'outcome'))
+llm_prompt_tokens = metrics.Counter('llm_prompt_tokens_total', 'Prompt tokens sent to the models', ('model',))
+llm_completion_tokens = metrics.Counter('llm_completion_tokens_total', 'Completion tokens received from the models', ('model',))
+tool_calls = metrics.Counter('tool_calls_total', 'Tool invocations of the agents', ('tool', 'outcome'))
+tool_duration = metrics.Histogram('tool_duration_seconds', 'Duration of tool invocations', ('tool',))
+chat_streams_active = metrics.Gauge('chat_streams_active', 'Streamed chat turns with a running agent')
+chat_queue_length = metrics.Gauge('chat_queue_length', 'Chat turns waiting for a free slot')
+chat_queue_wait = metrics.Histogram('chat_queue_wait_seconds', 'Time chat turns waited for a free slot')
+chat_admission_rejections = metrics.Counter(
+    'chat_admission_rejections_total', 'Chat turns rejected with 429', ('reason',))
+sse_connections_active = metrics.Gauge('sse_connections_active', 'Open SSE connections following a chat stream')
+event_loop_lag = metrics.Histogram(
+    'event_loop_lag_seconds', 'Delay of a timer on the event loop beyond its due time',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Measures the model and tool calls of agent runs"""
+    
+    run_inline = True  # Only updates counters, no need for a worker thread
+    
+    def __init__(self):
+        self._runs = {}
+    
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        model = (metadata or {}).get('ls_model_name') or (serialized or {}).get('kwargs', {}).get('model_name', 'unknown')
+        self._runs[run_id] = (time.perf_counter(), model)
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start, model = self._runs.pop(run_id, (None, 'unknown'))
+        if start is not None:
+            llm_request_duration.observe(time.perf_counter() - start, model=model, outcome='ok')
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    llm_prompt_tokens.inc(usage.get('input_tokens', 0), model=model)
+                    llm_completion_tokens.inc(usage.get('output_tokens', 0), model=model)
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start, model = self._runs.pop(run_id, (None, 'unknown'))
+        if start is not None:
+            llm_request_duration.observe(time.perf_counter() - start, model=model, outcome='error')
+    
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._runs[run_id] = (time.perf_counter(), (serialized or {}).get('name') or kwargs.get('name', 'unknown'))
+    
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish_tool(run_id, 'ok')
+    
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish_tool(run_id, 'error')
+    
+    def _finish_tool(self, run_id, outcome):
+        start, name = self._runs.pop(run_id, (None, 'unknown'))
+        if start is not None:
+            tool_duration.observe(time.perf_counter() - start, tool=name)
+        tool_calls.inc(tool=name, outcome=outcome)
+
+metrics_callback = MetricsCallbackHandler()
+
+# --- TRACING ---
+# Sampled chat turns are traced as a tree of spans: the turn, agent rebuilds,
+# checkpoint reads and writes, agent steps with their model and tool calls and
+# SSE serialization. Spans follow the current context (see tracing.py), agent
+# steps, model and tool calls are traced by a callback handler in the run
+# config like the metrics above.
+# Print the timeline of a turn with: python tracing.py user_data/traces.jsonl
+if TRACE_SAMPLE_RATE > 0:
+    tracing.configure(tracing.JsonlExporter(TRACE_FILE), TRACE_SAMPLE_RATE)
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records the agent steps of traced agent runs, and their model and tool calls, as spans"""
+    
+    run_inline = True  # Spans must be started in the context of the run to find their parent
+    
+    def __init__(self):
+        self._spans = {}
+        self._steps = {}  # run_id of a chain inside an agent step -> span of the step
+    
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        node = (metadata or {}).get('langgraph_node')
+        if node is not None and kwargs.get('name') == node:
+            span = tracing.start_span(f'agent_step {node}', node=node, step=metadata.get('langgraph_step'))
+            if span is not None:
+                self._spans[run_id] = self._steps[run_id] = span
+        elif parent_run_id in self._steps:
+            self._steps[run_id] = self._steps[parent_run_id]
+    
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._steps.pop(run_id, None)
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.end()
+    
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._steps.pop(run_id, None)
+        self.on_llm_error(error, run_id=run_id)
+    
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        model = (metadata or {}).get('ls_model_name') or (serialized or {}).get('kwargs', {}).get('model_name', 'unknown')
+        span = tracing.start_span(f'chat {model}', parent=self._steps.get(parent_run_id), model=model,
+                                  messages=len(messages[0]) if messages else 0)
+        if span is not None:
+            self._spans[run_id] = span
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    span.set(input_tokens=usage.get('input_tokens', 0), output_tokens=usage.get('output_tokens', 0))
+        span.end()
+    
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = (serialized or {}).get('name') or kwargs.get('name', 'unknown')
+        span = tracing.start_span(f'execute_tool {name}', parent=self._steps.get(parent_run_id), tool=name)
+        if span is not None:
+            self._spans[run_id] = span
+    
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.end()
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.set(error=f'{type(error).__name__}: {error}')
+            span.end('error')
+    
+    on_tool_error = on_llm_error
+
+tracing_callback = TracingCallbackHandler()
+
+async def count_sse_connection(events):
+    """Passes the events of an SSE response through while counting it as an open connection"""
+    sse_connections_active.inc()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        sse_connections_active.dec()
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Measures how late the event loop runs a timer, i.e. time spent in blocking code"""
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - due))
+
+# --- AGENT POOL ---
+class AgentPool:
+    """
+    Bounded pool of per-user agent entries.
+    
+    Entries are kept in least-recently-used order. The least recently used entry is
+    evicted when the pool is over capacity, and entries that have not been used for
+    idle_ttl seconds are evicted on access and by a periodic sweep. Evicted users are
+    rebuilt by create_agent_for_user on their next message.
+    """
+    
+    def __init__(self, capacity: int, idle_ttl: float):
+        self.capacity = capacity
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()
+        self._last_used = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __contains__(self, user_id) -> bool:
+        self._evict_if_idle(user_id)
+        return user_id in self._entries
+    
+    def __getitem__(self, user_id):
+        entry = self._entries[user_id]
+        self._touch(user_id)
+        return entry
+    
+    def __setitem__(self, user_id, entry):
+        self._entries[user_id] = entry
+        self._touch(user_id)
+        self.evict_idle()
+        while len(self._entries) > self.capacity:
+            oldest_user_id = next(iter(self._entries))
+            self._evict(oldest_user_id)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get(self, user_id):
+        """Returns the user's entry and counts a hit, or counts a miss and returns None"""
+        if user_id in self:
+            self.hits += 1
+            return self[user_id]
+        self.misses += 1
+        return None
+    
+    def pop(self, user_id, default=None):
+        """Removes the user's entry without counting it as an eviction"""
+        self._last_used.pop(user_id, None)
+        return self._entries.pop(user_id, default)
+    
+    def evict_idle(self) -> int:
+        """Evicts all entries that have been idle longer than idle_ttl, returns the number evicted"""
+        deadline = time.monotonic() - self.idle_ttl
+        evicted = 0
+        # Entries are in LRU order, so the idle ones are at the front
+        while self._entries:
+            oldest_user_id = next(iter(self._entries))
+            if self._last_used[oldest_user_id] > deadline:
+                break
+            self._evict(oldest_user_id)
+            evicted += 1
+        return evicted
+    
+    def stats(self) -> Dict:
+        """Returns pool metrics, counts only so that the call stays cheap"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "idle_ttl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "evictions": self.evictions
+        }
+    
+    def _touch(self, user_id):
+        self._entries.move_to_end(user_id)
+        self._last_used[user_id] = time.monotonic()
+    
+    def _evict_if_idle(self, user_id):
+        last_used = self._last_used.get(user_id)
+        if last_used is not None and time.monotonic() - last_used >= self.idle_ttl:
+            self._evict(user_id)
+    
+    def _evict(self, user_id):
+        print(f'Evicting agent of {user_id}')
+        self.pop(user_id)
+        self.evictions += 1
+
+async def sweep_agent_pool(interval: float = 60):
+    """Periodically evicts idle agents so that their memory is released without new traffic"""
+    while True:
+        await asyncio.sleep(interval)
+        user_agents.evict_idle()
+
 # LLM agents for different users
-user_agents = {}
+user_agents = AgentPool(AGENT_POOL_CAPACITY, AGENT_POOL_IDLE_TTL)
+
+# --- STUDY PLAN RELOAD ---
+# New cohorts are published by replacing STUDY_PLANS_FILE. A watcher converts
+# it to the plan store in a worker thread (only one worker converts, the others
+# open the new store), swaps user_datasets and drops the caches and agents of
+# the users whose records changed. Conversations and learning states are kept.
+plans_reload_stats = {"reloads": 0, "changed_users": 0, "last_reload_at": None, "last_reload_ms": None, "last_error": None}
+
+def study_plans_signature() -> tuple:
+    """Returns the modification times and sizes of the plans pickle and the store index"""
+    signature = []
+    for path in (STUDY_PLANS_FILE, STUDY_PLANS_STORE + '.index.json'):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+def load_changed_study_plans():
+    """
+    Converts a changed plans pickle and opens the new store, runs in a worker thread.
+    
+    Returns:
+        tuple: (new store, user ids with changed records), or None if the store is unchanged
+    """
+    if os.path.exists(STUDY_PLANS_FILE):
+        refresh_plan_store(STUDY_PLANS_STORE, STUDY_PLANS_FILE)
+    if os.path.getmtime(STUDY_PLANS_STORE + '.index.json') == user_datasets.modified:
+        return None
+    store = PlanStore(STUDY_PLANS_STORE)
+    return store, user_datasets.changed_users(store)
+
+def swap_study_plans(store, changed_users):
+    """Replaces the study plans and invalidates the cached data and agents of the changed users"""
+    global user_datasets
+    old_store, user_datasets = user_datasets, store
+    old_store.close()
+    for user_id in changed_users:
+        user_payload_cache.pop(user_id, None)
+        for phase in (1, 2):
+            pdf_cache.pop((user_id, phase), None)
+        for key in [key for key in structured_plan_cache if key[0] == user_id]:
+            del structured_plan_cache[key]
+        # The agent is created again with the new plans on the next request
+        user_agents.pop(user_id)
+        invalidate_answers(user_id)
+
+async def watch_study_plans(interval: float):
+    """Checks for new study plans every interval seconds and reloads them without a restart"""
+    signature = study_plans_signature()
+    while True:
+        await asyncio.sleep(interval)
+        current = study_plans_signature()
+        if current == signature:
+            continue
+        signature = current
+        
+        start = time.perf_counter()
+        try:
+            result = await asyncio.to_thread(load_changed_study_plans)
+        except Exception as e:
+            print(f"Error reloading study plans: {e}")
+            plans_reload_stats['last_error'] = str(e)
+            continue
+        if result is None:
+            continue
+        
+        store, changed_users = result
+        swap_study_plans(store, changed_users)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        plans_reload_stats.update({
+            "reloads": plans_reload_stats['reloads'] + 1,
+            "changed_users": len(changed_users),
+            "last_reload_at": datetime.now().isoformat(timespec='seconds'),
+            "last_reload_ms": round(elapsed_ms, 1),
+            "last_error": None
+        })
+        print(f"Reloaded study plans: {len(store)} users, {len(changed_users)} changed ({elapsed_ms:.0f} ms)")
+
+# --- WORKER SYNC ---
+# With several uvicorn workers (WEB_CONCURRENCY), conversations and state are
+# shared through the SQLite files, but each worker caches learning states,
+# /api/user payloads and agent settings in memory. Every save records an event
+# in the state store, and each worker follows the events of the others to drop
+# its stale copies.
+worker_sync_stats = {"applied_events": 0, "last_event_id": 0}
+
+def apply_state_event(kind: str, user_id: str):
+    """Drops the cached data of a user changed by another worker"""
+    if kind == 'learning_state':
+        learning_states.discard(user_id)
+        invalidate_user_payload(user_id)
+    elif kind == 'agent_settings':
+        # The agent is created again with the stored settings on the next request
+        user_agents.pop(user_id)
+    invalidate_answers(user_id)
+    worker_sync_stats['applied_events'] += 1
+
+async def follow_state_events(interval: float, prune_interval: float = 600):
+    """Applies the invalidation events of the other workers every interval seconds"""
+    last_event_id = worker_sync_stats['last_event_id'] = await asyncio.to_thread(state_store.last_event_id)
+    last_prune = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            events = await asyncio.to_thread(state_store.read_events, last_event_id)
+            for event_id, kind, user_id in events:
+                apply_state_event(kind, user_id)
+                last_event_id = event_id
+            worker_sync_stats['last_event_id'] = last_event_id
+            if time.monotonic() - last_prune > prune_interval:
+                last_prune = time.monotonic()
+                await asyncio.to_thread(state_store.prune_events, STATE_EVENT_RETENTION)
+        except sqlite3.Error as e:
+            print(f"Error reading state events: {e}")
 
 # --- PYDANTIC MODELS ---
 class ChatRequest(BaseModel):
@@ -266,150 +1165,535 @@ class LearningPlanStructuredResponse(BaseModel):
 
 
 # --- TOOLS ---
-def get_additional_materials_tool(user_id):
-    """Creates and returns an additional materials tool for a specific user"""
-    @tool
-    def additional_materials_tool():
-        """List of additional learning materials, such as videos, articles and courses, covering topics of teaching"""
-        print(f'Obtaining learning materials for {user_id}')
-        return additional_courses_data
-    
-    return additional_materials_tool
-
-def get_phase1_plan_tool(user_id):
-    """Creates and returns a phase 1 plan tool for a specific user"""
-    @tool
-    def phase1_plan_tool():
-        """Contains the personalized smart learning plan created for the student"""
-        print(f'Obtaining smart_plan_phase1 for {user_id}')
-        return user_datasets[user_id]['smart_plan_phase1']
-    
-    return phase1_plan_tool
-
-def get_phase2_plan_tool(user_id):
-    """Creates and returns a phase 2 plan tool for a specific user"""
-    @tool
-    def phase2_plan_tool():
-        """Contains the personalized smart learning plan created for the student"""
-        print(f'Obtaining smart_plan_phase2 for {user_id}')
-        return user_datasets[user_id]['smart_plan_phase2']
-    
-    return phase2_plan_tool
-
-def get_milestones_tool(user_id):
-    """Creates and returns a milestones tool for a specific user"""
-    @tool
-    def milestones_tool():
-        """Contains the personalized milestones (max 10) created for the student"""
-        print(f'Obtaining milestones for {user_id}')
-        return user_datasets[user_id]['milestones']
-    
-    return milestones_tool
+# Tools are shared by all users, the user is read from the run config
+# (config["configurable"]["user_id"]) set in create_agent_for_user.
+@tool
+def additional_materials_tool(query: str, config: RunnableConfig):
+    """
+    Searches curated additional learning materials, such as videos, articles and courses, covering topics of teaching.
+    
+    Args:
+        query: Topic or skill to find materials for, e.g. "market research" or "pitching to investors"
+    """
+    user_id = config["configurable"]["user_id"]
+    print(f'Searching learning materials for {user_id}: {query}')
+    return materials_index.search(query) or "No matching curated materials found, try a broader topic."
+
+@tool
+def phase1_plan_tool(config: RunnableConfig):
+    """Contains the personalized smart learning plan created for the student"""
+    user_id = config["configurable"]["user_id"]
+    print(f'Obtaining smart_plan_phase1 for {user_id}')
+    return user_datasets[user_id]['smart_plan_phase1']
+
+@tool
+def phase2_plan_tool(config: RunnableConfig):
+    """Contains the personalized smart learning plan created for the student"""
+    user_id = config["configurable"]["user_id"]
+    print(f'Obtaining smart_plan_phase2 for {user_id}')
+    return user_datasets[user_id]['smart_plan_phase2']
+
+@tool
+def milestones_tool(config: RunnableConfig):
+    """Contains the personalized milestones (max 10) created for the student"""
+    user_id = config["configurable"]["user_id"]
+    print(f'Obtaining milestones for {user_id}')
+    return user_datasets[user_id]['milestones']
+
+web_search = None
+search_tool = None
+
+def latest_question(state) -> str:
+    """Returns the student's latest message in the agent state"""
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            return str(message.content)
+    return ''
+
+def web_search_tool(query: str, state: Annotated[dict, InjectedState]):
+    """A search engine optimized for comprehensive, accurate, and trusted results. Useful for when you need to answer questions about current events. Input should be a search query."""
+    print(f'Searching the web: {query}')
+    return extract_results(web_search.search(query), f'{query} {latest_question(state)}', SEARCH_RESULT_TOKEN_BUDGET)
+
+async def aweb_search_tool(query: str, state: Annotated[dict, InjectedState]):
+    """A search engine optimized for comprehensive, accurate, and trusted results. Useful for when you need to answer questions about current events. Input should be a search query."""
+    print(f'Searching the web: {query}')
+    results = await web_search.asearch(query)
+    return extract_results(results, f'{query} {latest_question(state)}', SEARCH_RESULT_TOKEN_BUDGET)
 
 def initialize_search_tool():
-    """Initializes the search tool"""
-    return TavilySearchResults(
-        max_results=5,
-        search_depth="advanced",
-        include_answer=True,
-        include_raw_content=True,
-        include_images=False
-    )
+    """Initializes the cached search tool, a single instance is shared by all agents"""
+    global web_search, search_tool
+    if search_tool is None:
+        if SEARCH_BACKEND == 'fixture':
+            backend = FixtureBackend(SEARCH_FIXTURE_FILE)
+        else:
+            backend = TavilyBackend(
+                max_results=5,
+                search_depth="advanced",
+                include_answer=True,
+                include_raw_content=True,
+                include_images=False
+            )
+        web_search = CachedSearch(backend, ttl=SEARCH_CACHE_TTL, capacity=SEARCH_CACHE_SIZE, db_path=SEARCH_CACHE_DB_FILE,
+                                  db_max_rows=SEARCH_CACHE_DB_MAX_ROWS)
+        search_tool = StructuredTool.from_function(func=web_search_tool, coroutine=aweb_search_tool)
+    return search_tool
 
 # --- STATE MANAGEMENT ---
+def default_learning_state(user_id):
+    """Returns the initial learning state of a user, None if the user has no milestones"""
+    if user_id in user_datasets and 'milestones' in user_datasets[user_id]:
+        return {
+            'labels': user_datasets[user_id]['milestones'],
+            'states': [False] * len(user_datasets[user_id]['milestones'])
+        }
+    return None
+
 def load_user_state(user_id):
     """Loads the user's learning state"""
-    user_dir = os.path.join('user_data', user_id)
+    try:
+        state = learning_states.get(user_id)
+    except sqlite3.Error as e:
+        print(f"Warning: Error loading user state: {e}")
+        # Return a memory-only state
+        return default_learning_state(user_id)
     
-    if not os.path.exists(user_dir):
-        try:
-            os.makedirs(user_dir, exist_ok=True)
-        except PermissionError as e:
-            print(f"Warning: Permission error creating directory {user_dir}: {e}")
-            # Return a default state instead of failing
-            if user_id in user_datasets and 'milestones' in user_datasets[user_id]:
-                return {
-                    'labels': user_datasets[user_id]['milestones'],
-                    'states': [False] * len(user_datasets[user_id]['milestones'])
-                }
-            return None
-        
-    state_file = os.path.join(user_dir, 'state_variables.pickle')
-    
-    if os.path.exists(state_file):
-        try:
-            with open(state_file, 'rb') as f:
-                return pickle.load(f)
-        except (PermissionError, pickle.PickleError) as e:
-            print(f"Warning: Error loading user state: {e}")
-            # Return a memory-only state
-            if user_id in user_datasets and 'milestones' in user_datasets[user_id]:
-                return {
-                    'labels': user_datasets[user_id]['milestones'],
-                    'states': [False] * len(user_datasets[user_id]['milestones'])
-                }
-            return None
+    if state is not None:
+        return state
     
     # Create default state
-    if user_id in user_datasets and 'milestones' in user_datasets[user_id]:
-        default_state = {
-            'labels': user_datasets[user_id]['milestones'],
-            'states': [False] * len(user_datasets[user_id]['milestones'])
-        }
+    default_state = default_learning_state(user_id)
+    if default_state is not None:
         save_user_state(user_id, default_state)
-        return default_state
-    
-    return None
+    return default_state
 
 def save_user_state(user_id, state):
     """Saves the user's learning state"""
-    # For Rahti environment, handle in-memory only mode if needed
-    is_rahti = os.environ.get('DEPLOYMENT_ENV') == 'rahti'
-    
-    user_dir = os.path.join('user_data', user_id)
-    
     try:
-        if not os.path.exists(user_dir):
-            os.makedirs(user_dir, exist_ok=True)
-            
-        state_file = os.path.join(user_dir, 'state_variables.pickle')
-        temp_file = os.path.join(user_dir, 'state_variables.temp.pickle')
-        
-        with open(temp_file, 'wb') as f:
-            pickle.dump(state, f)
-            f.flush()
-            os.fsync(f.fileno())
-        
-        # Rename for atomic write
-        if os.path.exists(state_file) and os.name == 'nt':
-            os.remove(state_file)
-            
-        os.rename(temp_file, state_file)
+        learning_states.update(user_id, state)
+        invalidate_user_payload(user_id)
+        invalidate_answers(user_id)
         return True
-    except PermissionError as e:
+    except sqlite3.Error as e:
         print(f"Error saving user state: {e}")
-        if is_rahti:
+        if os.environ.get('DEPLOYMENT_ENV') == 'rahti':
             print("Running in Rahti environment - continuing with in-memory state only")
             # We'll consider it a success in Rahti even if we can't save to disk
             # This allows the UI to show the updated state during the current session
             return True
-        
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
-        return False
-    except Exception as e:
-        print(f"Error saving user state: {e}")
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
         return False
 
+# --- CONVERSATION SUMMARY ---
+# The history sent to the model is compacted before each model call once it
+# exceeds CONVERSATION_TOKEN_BUDGET. Older turns, including their tool outputs,
+# are folded into a running summary stored in the graph state, and the model
+# gets the summary and the latest turns. The stored conversation is unchanged.
+summarization_stats = {"summaries": 0, "compacted_calls": 0, "prompt_tokens_saved": 0}
+
+SUMMARY_PROMPT = """Summarize the conversation between a student and their learning assistant for the assistant's own use.
+Keep the student's goals, questions, decisions and progress, facts and links the assistant gave, and open follow-ups.
+Tool outputs (learning plans, milestones, materials, search results) can be fetched again, so only note what was used from them.
+Write at most 300 words."""
+
+class ConversationState(AgentState):
+    """Agent state with the running summary of older turns"""
+    summary: NotRequired[Optional[Dict]]
+
+def get_summary_model():
+    """Returns the model writing conversation summaries, its tokens are not streamed to the user"""
+    if 'summary' not in chat_models:
+        chat_models['summary'] = ChatOpenAI(model=SUMMARY_MODEL, temperature=0, stream_usage=True).with_config(tags=[TAG_NOSTREAM])
+    return chat_models['summary']
+
+def summary_message(summary: Dict) -> SystemMessage:
+    return SystemMessage(content=f"Summary of the earlier conversation:\n{summary['text']}")
+
+def format_for_summary(messages) -> str:
+    """Formats messages as a transcript, tool outputs are shortened"""
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"Student: {message.content}")
+        elif isinstance(message, ToolMessage):
+            content = str(message.content)
+            if len(content) > SUMMARY_TOOL_OUTPUT_CHARS:
+                content = content[:SUMMARY_TOOL_OUTPUT_CHARS] + ' ...'
+            lines.append(f"Tool {message.name}: {content}")
+        elif isinstance(message, AIMessage):
+            if message.content:
+                lines.append(f"Assistant: {message.content}")
+            if message.tool_calls:
+                lines.append(f"Assistant used tools: {', '.join(call['name'] for call in message.tool_calls)}")
+    return '\n'.join(lines)
+
+def plan_history_compaction(state) -> tuple:
+    """
+    Splits the history into the part to fold into the summary and the part sent word for word.
+    
+    Returns:
+        (summary, messages_to_fold, recent_messages), messages_to_fold is empty
+        when the summary and the recent messages fit the token budget
+    """
+    messages = state["messages"]
+    summary = state.get("summary")
+    
+    # Messages up to the last summarized one are covered by the summary
+    start = 0
+    if summary:
+        message_ids = [message.id for message in messages]
+        if summary['last_message_id'] in message_ids:
+            start = message_ids.index(summary['last_message_id']) + 1
+        else:
+            summary = None
+    recent = messages[start:]
+    
+    message_tokens = [count_tokens_approximately([message]) for message in recent]
+    summary_tokens = count_tokens_approximately([summary_message(summary)]) if summary else 0
+    if summary_tokens + sum(message_tokens) <= CONVERSATION_TOKEN_BUDGET:
+        return summary, [], recent
+    
+    # Cut at the start of a turn, so that tool calls stay with their results.
+    # The earliest turn start that leaves at most CONVERSATION_KEEP_RECENT_TOKENS
+    # is used, or the start of the latest turn if that alone is longer.
+    turn_starts = [index for index, message in enumerate(recent) if isinstance(message, HumanMessage) and index > 0]
+    if not turn_starts:
+        return summary, [], recent
+    cut = turn_starts[-1]
+    kept_tokens = sum(message_tokens[cut:])
+    for index in reversed(turn_starts[:-1]):
+        kept_tokens += sum(message_tokens[index:cut])
+        if kept_tokens > CONVERSATION_KEEP_RECENT_TOKENS:
+            break
+        cut = index
+    return summary, recent[:cut], recent[cut:]
+
+def build_summary_request(summary, messages_to_fold) -> List:
+    """Returns the messages asking the summary model to extend the running summary"""
+    transcript = format_for_summary(messages_to_fold)
+    if summary:
+        transcript = f"Summary so far:\n{summary['text']}\n\nConversation after the summary:\n{transcript}"
+    return [SystemMessage(content=SUMMARY_PROMPT), HumanMessage(content=transcript)]
+
+def finish_history_compaction(state, summary, messages_to_fold, recent, summary_text=None) -> Dict:
+    """Returns the pre-model hook update and records the saved prompt tokens"""
+    update = {}
+    if messages_to_fold:
+        summary = {"text": summary_text, "last_message_id": messages_to_fold[-1].id}
+        update["summary"] = summary
+        summarization_stats["summaries"] += 1
+    
+    llm_input_messages = ([summary_message(summary)] if summary else []) + recent
+    if len(recent) < len(state["messages"]):
+        summarization_stats["compacted_calls"] += 1
+        summarization_stats["prompt_tokens_saved"] += max(0,
+            count_tokens_approximately(state["messages"]) - count_tokens_approximately(llm_input_messages))
+    update["llm_input_messages"] = llm_input_messages
+    return update
+
+def compact_history(state) -> Dict:
+    """Pre-model hook, replaces older turns in the model input with the running summary"""
+    summary, messages_to_fold, recent = plan_history_compaction(state)
+    summary_text = None
+    if messages_to_fold:
+        summary_text = get_summary_model().invoke(build_summary_request(summary, messages_to_fold)).content
+    return finish_history_compaction(state, summary, messages_to_fold, recent, summary_text)
+
+async def acompact_history(state) -> Dict:
+    """Async version of compact_history"""
+    summary, messages_to_fold, recent = plan_history_compaction(state)
+    summary_text = None
+    if messages_to_fold:
+        summary_text = (await get_summary_model().ainvoke(build_summary_request(summary, messages_to_fold))).content
+    return finish_history_compaction(state, summary, messages_to_fold, recent, summary_text)
+
 # --- LLM AGENT MANAGEMENT ---
+# Compiled agent graphs are shared by all users with the same tool selection.
+# Everything user specific (user_id, system prompt, temperature and the
+# conversation thread) is passed in the run config of each call.
+# Conversations are checkpointed to SQLite, so they survive restarts and
+# evictions from the agent pool and are shared between workers.
+shared_agents = {}
+chat_models = {}
+conversation_memory = SqliteCheckpointer(
+    CONVERSATION_DB_FILE,
+    keep_latest=CONVERSATION_KEEP_CHECKPOINTS,
+    max_user_bytes=CONVERSATION_MAX_USER_BYTES
+)
+
+def get_tool_signature(phase, settings) -> tuple:
+    """Returns the key of the shared agent graph for a phase and agent settings"""
+    return (
+        phase,
+        bool(settings['use_search_tool']),
+        bool(settings['use_plan_tool']),
+        bool(settings['use_learningmaterial_tool']),
+        bool(settings['use_milestones_tool'])
+    )
+
+def get_chat_model(temperature, tools, tool_signature):
+    """Returns a chat model with the given temperature and tools bound, cached per temperature and tool set"""
+    key = (float(temperature), tool_signature)
+    if key not in chat_models:
+        model = ChatOpenAI(model=LLM_MODEL, temperature=temperature, stream_usage=True)
+        chat_models[key] = model.bind_tools(tools) if tools else model
+    return chat_models[key]
+
+def agent_prompt(state, config: RunnableConfig):
+    """Prepends the user's system prompt from the run config to the conversation"""
+    system_prompt = config["configurable"]["system_prompt"]
+    return [SystemMessage(content=system_prompt)] + state["messages"]
+
+def get_shared_agent(phase, settings):
+    """Returns the compiled agent graph for a phase and tool selection, compiling it on first use"""
+    tool_signature = get_tool_signature(phase, settings)
+    if tool_signature in shared_agents:
+        return shared_agents[tool_signature]
+    
+    # Set agent tool list
+    tools = []
+    
+    if settings['use_search_tool']:
+        tools.append(initialize_search_tool())
+        
+    if settings['use_plan_tool']:
+        tools.append(phase1_plan_tool if phase == 1 else phase2_plan_tool)
+        
+    if settings['use_learningmaterial_tool']:
+        tools.append(additional_materials_tool)
+        
+    if settings['use_milestones_tool']:
+        tools.append(milestones_tool)
+    
+    def select_model(state, runtime):
+        """Selects the chat model with the temperature of the current run"""
+        temperature = get_config()["configurable"]["temperature"]
+        return get_chat_model(temperature, tools, tool_signature)
+    
+    # Create langchain agent
+    shared_agents[tool_signature] = create_react_agent(
+        select_model,
+        tools=tools,
+        prompt=agent_prompt,
+        pre_model_hook=RunnableLambda(compact_history, afunc=acompact_history),
+        state_schema=ConversationState,
+        checkpointer=conversation_memory
+    )
+    return shared_agents[tool_signature]
+
+# --- ADMISSION CONTROL ---
+# Chat turns, streamed or not, run in one of CHAT_CONCURRENCY_LIMIT slots of
+# the worker. Turns without a free slot wait in a FIFO queue of at most
+# CHAT_QUEUE_LIMIT turns, streamed turns tell the client their queue position.
+# A conversation thread has at most one turn running or waiting. Turns beyond
+# these limits are rejected at once with 429 and a Retry-After estimated from
+# the durations of the recent turns.
+class AdmissionTicket:
+    """A chat turn that is running or waiting for a slot"""
+    
+    __slots__ = ('thread_id', 'created', 'started', 'admitted')
+    
+    def __init__(self, thread_id: str):
+        self.thread_id = thread_id
+        self.created = time.monotonic()
+        self.started = None
+        self.admitted = asyncio.Event()
+
+class AdmissionController:
+    """Limits running chat turns per worker, with a bounded wait queue and one turn per thread"""
+    
+    def __init__(self, limit: int, queue_limit: int):
+        self.limit = max(1, limit)
+        self.queue_limit = queue_limit
+        self.running = 0
+        self.waiting = deque()
+        self.threads = set()
+        self.average_duration = 10.0  # Seconds per turn, updated as turns finish
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = {'thread_busy': 0, 'queue_full': 0}
+        self._changed = asyncio.Event()
+    
+    def retry_after(self) -> int:
+        """Estimated seconds until a new turn would get a slot"""
+        return min(60, max(1, math.ceil(self.average_duration * (len(self.waiting) + 1) / self.limit)))
+    
+    def admit(self, thread_id: str) -> AdmissionTicket:
+        """Lets a turn run or wait, raises HTTPException 429 if the thread is busy or the queue is full"""
+        if thread_id in self.threads:
+            self._reject('thread_busy', "A reply in this conversation is still in progress",
+                         max(1, math.ceil(self.average_duration)))
+        if self.running >= self.limit and len(self.waiting) >= self.queue_limit:
+            self._reject('queue_full', "The assistant is busy, please try again shortly", self.retry_after())
+        
+        ticket = AdmissionTicket(thread_id)
+        self.threads.add(thread_id)
+        if self.running < self.limit:
+            self._start(ticket)
+        else:
+            self.waiting.append(ticket)
+            self.queued += 1
+            chat_queue_length.set(len(self.waiting))
+        return ticket
+    
+    def _reject(self, reason: str, detail: str, retry_after: int):
+        self.rejected[reason] += 1
+        chat_admission_rejections.inc(reason=reason)
+        raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(retry_after)})
+    
+    def _start(self, ticket: AdmissionTicket):
+        self.running += 1
+        self.admitted += 1
+        ticket.started = time.monotonic()
+        ticket.admitted.set()
+        chat_queue_wait.observe(ticket.started - ticket.created)
+    
+    async def wait(self, ticket: AdmissionTicket):
+        """Yields the queue position of a waiting turn whenever it changes, ends once the turn has a slot"""
+        position = None
+        while not ticket.admitted.is_set():
+            changed = self._changed
+            if self.waiting.index(ticket) + 1 != position:
+                position = self.waiting.index(ticket) + 1
+                yield position
+            await changed.wait()
+    
+    def release(self, ticket: AdmissionTicket):
+        """Frees the slot or queue place of a turn, the next waiting turns get the free slots"""
+        self.threads.discard(ticket.thread_id)
+        if ticket.started is None:
+            self.waiting.remove(ticket)
+        else:
+            self.running -= 1
+            self.average_duration = 0.8 * self.average_duration + 0.2 * (time.monotonic() - ticket.started)
+            while self.waiting and self.running < self.limit:
+                self._start(self.waiting.popleft())
+        chat_queue_length.set(len(self.waiting))
+        
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def stats(self) -> Dict:
+        return {
+            "limit": self.limit,
+            "queue_limit": self.queue_limit,
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+            "average_turn_seconds": round(self.average_duration, 2)
+        }
+
+admission = AdmissionController(CHAT_CONCURRENCY_LIMIT, CHAT_QUEUE_LIMIT)
+
+# --- ANSWER CACHE ---
+# Opt-in with ANSWER_CACHE_ENABLED. A question asked again in the same words,
+# e.g. "what are my milestones?", is answered from the cache instead of an
+# agent run. Answers are cached when the question opened the conversation or
+# when the agent used only the plan and milestone tools for it. Answers of
+# opening questions that needed other tools (e.g. web search) or no tools are
+# only reused to open a conversation, as later turns also depend on the
+# conversation history. The key holds
+# the normalized question, user, phase, a hash of the agent settings and the
+# content hash of the user's plans. A user's answers are also dropped when
+# their settings, plans or milestones change. A cached answer is replayed as
+# the stream events of the original turn and appended to the conversation, so
+# follow-up questions have it in their history.
+ANSWER_CACHE_TOOLS = frozenset({'phase1_plan_tool', 'phase2_plan_tool', 'milestones_tool'})
+answer_cache = OrderedDict()  # key -> {"answer", "events", "first_turn", "expires"}
+answer_cache_stats = {'hits': 0, 'misses': 0, 'stored': 0, 'invalidated': 0}
+
+def hash_settings(settings: Dict) -> str:
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def answer_cache_key(user_id: str, message: str, agent_entry: Dict) -> tuple:
+    """Returns the answer cache key of a question, case and punctuation are ignored"""
+    question = ' '.join(re.findall(r'\w+', message.lower()))
+    return (user_id, current_phase, question, agent_entry['settings_hash'], user_datasets.content_hash(user_id))
+
+def get_cached_answer(key: tuple, first_turn: bool) -> Optional[Dict]:
+    """
+    Returns the cached answer of a key, None if caching is off or the answer is
+    missing or expired. Answers cached as first turns are only returned for first turns.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    entry = answer_cache.get(key)
+    if entry is not None and entry['expires'] < time.monotonic():
+        del answer_cache[key]
+        entry = None
+    if entry is None or entry['first_turn'] and not first_turn:
+        answer_cache_stats['misses'] += 1
+        return None
+    answer_cache.move_to_end(key)
+    answer_cache_stats['hits'] += 1
+    return entry
+
+def is_plan_only_turn(tools_used: set) -> bool:
+    """Whether the answer of a turn depends only on the question, the plans and the settings"""
+    return bool(tools_used) and tools_used <= ANSWER_CACHE_TOOLS
+
+def is_cacheable_turn(first_turn: bool, tools_used: set) -> bool:
+    """Whether the answer of a turn can be cached, for first turns only or for any turn"""
+    return first_turn or is_plan_only_turn(tools_used)
+
+def turn_events(messages) -> List[tuple]:
+    """Returns the stream events (event type, data) of the messages of one turn"""
+    events = []
+    for msg in messages:
+        if isinstance(msg, AIMessage):
+            for tool_call in msg.tool_calls:
+                events.append(('tool-start', {"name": tool_call['name'], "id": tool_call.get('id')}))
+            if msg.content:
+                events.append(('token', {"delta": msg.content}))
+        elif isinstance(msg, ToolMessage):
+            events.append(('tool-end', {"name": msg.name, "id": msg.tool_call_id}))
+    return events
+
+def store_answer(key: tuple, messages, first_turn: bool):
+    """Caches the answer of a finished turn given the conversation messages, if the turn is cacheable"""
+    if not ANSWER_CACHE_ENABLED:
+        return
+    last_question = max((index for index, msg in enumerate(messages) if isinstance(msg, HumanMessage)), default=-1)
+    turn = messages[last_question + 1:]
+    tools_used = {msg.name for msg in turn if isinstance(msg, ToolMessage)}
+    if not turn or not isinstance(turn[-1], AIMessage) or not isinstance(turn[-1].content, str) or not turn[-1].content:
+        return
+    if not is_cacheable_turn(first_turn, tools_used):
+        return
+    
+    answer_cache[key] = {
+        "answer": turn[-1].content,
+        "events": turn_events(turn),
+        "first_turn": not is_plan_only_turn(tools_used),
+        "expires": time.monotonic() + ANSWER_CACHE_TTL
+    }
+    answer_cache.move_to_end(key)
+    answer_cache_stats['stored'] += 1
+    while len(answer_cache) > ANSWER_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+
+def invalidate_answers(user_id: str):
+    """Drops the cached answers of a user"""
+    keys = [key for key in answer_cache if key[0] == user_id]
+    for key in keys:
+        del answer_cache[key]
+    answer_cache_stats['invalidated'] += len(keys)
+
+async def is_first_turn(config: Dict) -> bool:
+    """Whether the conversation thread has no messages yet, only checked if answers are cached"""
+    return ANSWER_CACHE_ENABLED and await conversation_memory.aget_tuple(config) is None
+
+async def append_cached_answer(agent, config: Dict, message: str, answer: str):
+    """Adds a question and its cached answer to the conversation as if the agent had answered"""
+    with tracing.span('answer_cache.append'):
+        await agent.aupdate_state(
+            config,
+            {"messages": [HumanMessage(content=message), AIMessage(content=answer)]},
+            as_node="agent"
+        )
+
 def create_agent_for_user(user_id, settings=None):
     """Creates or updates an LLM agent for a specific user"""
     if user_id not in user_datasets:
@@ -431,56 +1715,22 @@ def create_agent_for_user(user_id, settings=None):
                 'use_milestones_tool': True
             }
     
-    # Initialize user_agents for this user if not existing
-    if user_id not in user_agents:
-        user_agents[user_id] = {
-            'settings': settings,
-            'memory': MemorySaver(),
-            'config': {"configurable": {"thread_id": f"{user_id}-1"}},
-            'agent_phase1': None,
-            'agent_phase2': None
-        }
-    else:
-        # Update existing settings
-        user_agents[user_id]['settings'] = settings
-    
-    # Set agent tool lists
-    phase1_tools = []
-    phase2_tools = []
-    
-    if settings['use_search_tool']:
-        search_tool = initialize_search_tool()
-        phase1_tools.append(search_tool)
-        phase2_tools.append(search_tool)
-        
-    if settings['use_plan_tool']:
-        phase1_tools.append(get_phase1_plan_tool(user_id))
-        phase2_tools.append(get_phase2_plan_tool(user_id))
-        
-    if settings['use_learningmaterial_tool']:
-        phase1_tools.append(get_additional_materials_tool(user_id))
-        phase2_tools.append(get_additional_materials_tool(user_id))
-        
-    if settings['use_milestones_tool']:
-        phase1_tools.append(get_milestones_tool(user_id))
-        phase2_tools.append(get_milestones_tool(user_id))
-    
-    # Create langchain agents
-    model = ChatOpenAI(model=LLM_MODEL, temperature=settings['temperature'])
-    
-    user_agents[user_id]['agent_phase1'] = create_react_agent(
-        model,
-        tools=phase1_tools,
-        prompt=settings['system_prompt'],
-        checkpointer=user_agents[user_id]['memory']
-    )
-    
-    user_agents[user_id]['agent_phase2'] = create_react_agent(
-        model,
-        tools=phase2_tools,
-        prompt=settings['system_prompt'],
-        checkpointer=user_agents[user_id]['memory']
-    )
+    # Per-user state is only the settings and the run config, the agent graphs are shared
+    user_agents[user_id] = {
+        'settings': settings,
+        'settings_hash': hash_settings(settings),
+        'config': {
+            "callbacks": [metrics_callback, tracing_callback],
+            "configurable": {
+                "thread_id": f"{user_id}-1",
+                "user_id": user_id,
+                "system_prompt": settings['system_prompt'],
+                "temperature": settings['temperature']
+            }
+        },
+        'agent_phase1': get_shared_agent(1, settings),
+        'agent_phase2': get_shared_agent(2, settings)
+    }
     
     return user_agents[user_id]
 
@@ -489,27 +1739,295 @@ async def predict_for_user(user_id, message, history=None):
     if history is None:
         history = []
     
-    # Ensure user agent exists
-    if user_id not in user_agents:
-        create_agent_for_user(user_id)
+    with tracing.span('chat', root=True, user_id=user_id):
+        # Ensure user agent exists, evicted agents are rebuilt here
+        agent_entry = user_agents.get(user_id)
+        if agent_entry is None:
+            with tracing.span('create_agent_for_user'):
+                agent_entry = create_agent_for_user(user_id)
+        
+        # Get appropriate agent based on phase
+        agent = agent_entry['agent_phase1'] if current_phase == 1 else agent_entry['agent_phase2']
+        config = agent_entry['config']
+        thread_id = config['configurable']['thread_id']
+        
+        # Repeated questions are answered from the cache while the conversation is not busy
+        cache_key = answer_cache_key(user_id, message, agent_entry)
+        first_turn = await is_first_turn(config)
+        cached = get_cached_answer(cache_key, first_turn) if thread_id not in admission.threads else None
+        if cached is not None:
+            await append_cached_answer(agent, config, message, cached['answer'])
+            return cached['answer']
+        
+        # Wait for a free slot, raises 429 if the queue is full or the conversation is busy
+        ticket = admission.admit(thread_id)
+        try:
+            with tracing.span('wait_for_slot'):
+                async for _ in admission.wait(ticket):
+                    pass
+            first_turn = await is_first_turn(config)
+            
+            # Invoke agent asynchronously so that the event loop keeps serving other requests
+            response = await agent.ainvoke(
+                {"messages": [{"role": "user", "content": message}]},
+                config,
+                stream_mode="values",
+            )
+        finally:
+            admission.release(ticket)
+        
+        store_answer(cache_key, response["messages"], first_turn)
     
-    # Get appropriate agent based on phase
-    agent = user_agents[user_id]['agent_phase1'] if current_phase == 1 else user_agents[user_id]['agent_phase2']
+    return response["messages"][-1].content
+
+# --- CHAT STREAMS ---
+# A streamed chat turn runs as a background task that publishes typed events
+# (token, tool-start, tool-end, error, done) into a ChatStream. SSE responses
+# follow the stream, so a client reconnecting with Last-Event-ID resumes from
+# the ring buffer instead of starting a new agent run.
+# Tokens are coalesced into one token event per STREAM_FLUSH_INTERVAL_MS or
+# STREAM_FLUSH_CHARS, whichever comes first. The first token is sent at once.
+chat_streams = {}
+
+class ChatStream:
+    """Events of one streamed chat turn, the latest ones kept in a ring buffer"""
+    
+    def __init__(self, user_id: str):
+        self.stream_id = uuid.uuid4().hex[:16]
+        self.user_id = user_id
+        self.events = deque(maxlen=STREAM_RING_BUFFER_SIZE)
+        self.last_seq = 0
+        self.done = False
+        self.finished_at = None
+        self.task = None
+        self.trace = None  # Root span of the turn if it is traced
+        self._text_parts = []
+        self._pending_tokens = []
+        self._pending_chars = 0
+        self._first_token_sent = False
+        self._flush_handle = None
+        self._changed = asyncio.Event()
+    
+    @property
+    def text(self) -> str:
+        """The response so far as shown to the user, including tool usage notes"""
+        return ''.join(self._text_parts)
+    
+    def publish(self, event_type: str, data: Dict):
+        """Publishes an event, token events are coalesced according to the flush policy"""
+        if event_type != 'token':
+            # Keep the order of events, pending text goes out before a tool call or the end
+            self.flush_tokens()
+            self._append(event_type, data)
+            return
+        
+        self._pending_tokens.append(data['delta'])
+        self._pending_chars += len(data['delta'])
+        
+        if (not self._first_token_sent or STREAM_FLUSH_INTERVAL_MS <= 0
+                or self._pending_chars >= STREAM_FLUSH_CHARS):
+            self.flush_tokens()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                STREAM_FLUSH_INTERVAL_MS / 1000, self.flush_tokens)
+    
+    def flush_tokens(self):
+        """Publishes the pending tokens as one token event"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending_tokens:
+            return
+        
+        delta = ''.join(self._pending_tokens)
+        self._pending_tokens = []
+        self._pending_chars = 0
+        self._first_token_sent = True
+        self._append('token', {"delta": delta})
+    
+    def _append(self, event_type: str, data: Dict):
+        """Appends an event to the ring buffer and wakes up the followers"""
+        self.last_seq += 1
+        self.events.append((self.last_seq, event_type, data))
+        
+        if event_type == 'token':
+            self._text_parts.append(data['delta'])
+        elif event_type == 'tool-end':
+            self._text_parts.append(f'\n[used tool "{data["name"]}"]\n')
+        elif event_type == 'done':
+            self.done = True
+            self.finished_at = time.monotonic()
+        
+        self._changed.set()
+        self._changed = asyncio.Event()
     
-    # Invoke agent
-    response = agent.invoke(
-        {"messages": [{"role": "user", "content": message}]},
-        user_agents[user_id]['config'],
-        stream_mode="values",
-    )
+    async def follow(self, after_seq: int = 0):
+        """
+        Yields (seq, event_type, data) for all events after after_seq until the stream is done.
+        
+        If the requested events have already dropped out of the ring buffer, a
+        'snapshot' event with the full text so far is yielded in their place.
+        """
+        while True:
+            changed = self._changed
+            pending = []
+            if self.events:
+                first_seq = self.events[0][0]
+                if after_seq + 1 < first_seq:
+                    pending.append((self.last_seq, 'snapshot', {'text': self.text}))
+                else:
+                    pending.extend(islice(self.events, after_seq + 1 - first_seq, None))
+            
+            for event in pending:
+                yield event
+                after_seq = event[0]
+            
+            if self.done and after_seq >= self.last_seq:
+                return
+            if not pending:
+                await changed.wait()
+
+def prune_chat_streams():
+    """Removes finished streams that are older than the retention time"""
+    deadline = time.monotonic() - STREAM_RETENTION_SECONDS
+    for stream_id in [stream_id for stream_id, stream in chat_streams.items()
+                      if stream.done and stream.finished_at < deadline]:
+        del chat_streams[stream_id]
+
+async def run_chat_stream(stream: ChatStream, agent, config: Dict, message: str, ticket: AdmissionTicket,
+                          cache_key: tuple):
+    """Runs the agent for one chat turn once it has a slot and publishes its output to the stream"""
+    start = time.perf_counter()
+    first_token = False
+    running = False
+    tools_used = set()
+    outcome = 'ok'
+    try:
+        # The client is told its place in the queue while the turn waits for a slot
+        with tracing.span('wait_for_slot'):
+            async for position in admission.wait(ticket):
+                stream.publish('queued', {"position": position})
+        running = True
+        chat_streams_active.inc()
+        first_turn = await is_first_turn(config)
+        
+        async for msg, _ in agent.astream(
+            {"messages": [{"role": "user", "content": message}]},
+            config,
+            stream_mode="messages"
+        ):
+            if isinstance(msg, AIMessageChunk) or isinstance(msg, AIMessage):
+                tool_calls = msg.tool_call_chunks if isinstance(msg, AIMessageChunk) else msg.tool_calls
+                for tool_call in tool_calls:
+                    # Only the first chunk of a streamed tool call carries the name
+                    if tool_call.get('name'):
+                        stream.publish('tool-start', {"name": tool_call['name'], "id": tool_call.get('id')})
+                if msg.content:
+                    if not first_token:
+                        first_token = True
+                        chat_time_to_first_token.observe(time.perf_counter() - start)
+                        if stream.trace is not None:
+                            stream.trace.set(time_to_first_token_ms=round((time.perf_counter() - start) * 1000, 1))
+                    stream.publish('token', {"delta": msg.content})
+            elif isinstance(msg, ToolMessage):
+                tools_used.add(msg.name)
+                stream.publish('tool-end', {"name": msg.name, "id": msg.tool_call_id})
+        
+        # The messages of the turn are only read back if its answer can be cached
+        if ANSWER_CACHE_ENABLED and is_cacheable_turn(first_turn, tools_used):
+            state = await agent.aget_state(config)
+            store_answer(cache_key, state.values['messages'], first_turn)
+    except Exception as e:
+        print(f"Error streaming chat for {stream.user_id}: {e}")
+        outcome = 'error'
+        stream.publish('error', {"error": str(e)})
+    finally:
+        admission.release(ticket)
+        if running:
+            chat_streams_active.dec()
+        chat_stream_duration.observe(time.perf_counter() - start, outcome=outcome)
+        stream.publish('done', {})
+        if stream.trace is not None:
+            stream.trace.set(events=stream.last_seq)
+            stream.trace.end(outcome)
+
+async def start_chat_stream(user_id: str, message: str) -> ChatStream:
+    """Starts a streamed chat turn for a user in the background, raises 429 if it is not admitted"""
+    prune_chat_streams()
     
-    return response["messages"][-1].content
+    # The root span ends with the agent run, the run task inherits it as the current span
+    trace = tracing.start_span('chat.stream', root=True, user_id=user_id)
+    with tracing.use_span(trace):
+        try:
+            # Ensure user agent exists, evicted agents are rebuilt here
+            agent_entry = user_agents.get(user_id)
+            if agent_entry is None:
+                with tracing.span('create_agent_for_user'):
+                    agent_entry = create_agent_for_user(user_id)
+            
+            # Repeated questions are answered from the cache while the conversation is not busy
+            thread_id = agent_entry['config']['configurable']['thread_id']
+            cache_key = answer_cache_key(user_id, message, agent_entry)
+            first_turn = await is_first_turn(agent_entry['config'])
+            cached = get_cached_answer(cache_key, first_turn) if thread_id not in admission.threads else None
+            
+            # Raises 429 if the queue is full or the conversation is busy
+            ticket = admission.admit(thread_id) if cached is None else None
+        except Exception:
+            if trace is not None:
+                trace.end('error')
+            raise
+        
+        # Get appropriate agent based on phase
+        agent = agent_entry['agent_phase1'] if current_phase == 1 else agent_entry['agent_phase2']
+        
+        stream = ChatStream(user_id)
+        stream.trace = trace
+        chat_streams[stream.stream_id] = stream
+        if cached is not None:
+            stream.task = asyncio.create_task(replay_cached_answer(stream, agent, agent_entry['config'], message, cached))
+        else:
+            stream.task = asyncio.create_task(
+                run_chat_stream(stream, agent, agent_entry['config'], message, ticket, cache_key))
+    return stream
+
+async def replay_cached_answer(stream: ChatStream, agent, config: Dict, message: str, cached: Dict):
+    """Publishes the events of a cached answer to the stream and appends the answer to the conversation"""
+    outcome = 'ok'
+    try:
+        for event_type, data in cached['events']:
+            stream.publish(event_type, data)
+        await append_cached_answer(agent, config, message, cached['answer'])
+    except Exception as e:
+        print(f"Error replaying a cached answer for {stream.user_id}: {e}")
+        outcome = 'error'
+        stream.publish('error', {"error": str(e)})
+    finally:
+        stream.publish('done', {})
+        if stream.trace is not None:
+            stream.trace.set(events=stream.last_seq, answer_cache='hit')
+            stream.trace.end(outcome)
+
+def format_sse_event(stream: ChatStream, seq: int, event_type: str, data: Dict) -> str:
+    """Formats a stream event for the delta protocol"""
+    return f"id: {stream.stream_id}:{seq}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
 
-async def stream_predict_for_user(user_id, message):
+async def stream_predict_for_user(user_id, message, stream_format='delta', resume_from=None):
     """
     Streams a prediction for a specific user.
     
-    IMPORTANT STREAMING NOTES:
+    DELTA FORMAT (default):
+    Each event has a type, a JSON payload and an id "<stream_id>:<seq>":
+    - queued: {"position": n}, the turn waits for a free slot, sent when the position changes
+    - token: {"delta": "..."}, new response text
+    - tool-start: {"name": "...", "id": "..."}, the agent calls a tool
+    - tool-end: {"name": "...", "id": "..."}, the tool returned
+    - snapshot: {"text": "..."}, full text so far, sent when resumed events are no longer buffered
+    - error: {"error": "..."}
+    - done: {}, the stream is complete
+    A client reconnecting with Last-Event-ID continues after that event.
+    
+    FULL FORMAT (format=full, for old clients):
     1. We encode the response as JSON to prevent conflicts between markdown
        formatting (especially lists) and SSE protocol which uses double newlines
        as event separators
@@ -517,45 +2035,75 @@ async def stream_predict_for_user(user_id, message):
     3. We ensure proper SSE format with "data: " prefix and double newlines after each event
     4. We explicitly handle the [DONE] signal to notify the client the stream is complete
     
-    This approach works reliably with markdown content including complex elements
-    like numbered lists, bullet points, and code blocks.
+    Args:
+        stream_format: 'delta' or 'full'
+        resume_from: (stream, seq) of the last event the client received, starts a new turn if None
     """
+    if resume_from is None:
+        stream = await start_chat_stream(user_id, message)
+        after_seq = 0
+    else:
+        stream, after_seq = resume_from
     
-    # Ensure user agent exists
-    if user_id not in user_agents:
-        create_agent_for_user(user_id)
-    
-    # Get appropriate agent based on phase
-    agent = user_agents[user_id]['agent_phase1'] if current_phase == 1 else user_agents[user_id]['agent_phase2']
-    
-    # Send an initial empty event to establish connection
-    yield "data: \n\n"
-    
-    # Stream response
-    full_response = ""
-    
-    async for msg, _ in agent.astream(
-        {"messages": [{"role": "user", "content": message}]},
-        user_agents[user_id]['config'],
-        stream_mode="messages"
-    ):
-        if isinstance(msg, AIMessageChunk) or isinstance(msg, AIMessage):
-            if hasattr(msg, 'content') and msg.content:
-                full_response += msg.content
-                # Use JSON to safely encode the message - this prevents newline issues
-                import json
-                yield f"data: {json.dumps(full_response)}\n\n"
-        elif isinstance(msg, ToolMessage):
-            tool_msg = f'\n[used tool "{msg.name}"]\n'
-            full_response += tool_msg
-            import json
-            yield f"data: {json.dumps(full_response)}\n\n"
-    
-    # Signal completion
-    yield "data: [DONE]\n\n"
+    if stream_format == 'full':
+        # Send an initial empty event to establish connection
+        yield "data: \n\n"
+        
+        full_response = ""
+        async for seq, event_type, data in stream.follow(after_seq):
+            if event_type == 'token':
+                full_response += data['delta']
+            elif event_type == 'tool-end':
+                full_response += f'\n[used tool "{data["name"]}"]\n'
+            elif event_type == 'snapshot':
+                full_response = data['text']
+            elif event_type == 'error':
+                yield f"data: {json.dumps(data)}\n\n"
+                continue
+            else:
+                continue
+            # Use JSON to safely encode the message - this prevents newline issues
+            with tracing.span('sse.serialize', parent=stream.trace, type=event_type, seq=seq):
+                event = f"data: {json.dumps(full_response)}\n\n"
+            yield event
+        
+        # Signal completion
+        yield "data: [DONE]\n\n"
+        return
+    
+    # Establish the connection and tell the client how soon to reconnect
+    yield f"retry: {STREAM_RECONNECT_MS}\n\n"
+    async for seq, event_type, data in stream.follow(after_seq):
+        # Serialization is traced as part of the turn, also for followers in other requests
+        with tracing.span('sse.serialize', parent=stream.trace, type=event_type, seq=seq):
+            event = format_sse_event(stream, seq, event_type, data)
+        yield event
 
 # --- FASTAPI APP ---
-app = FastAPI(title="UPBEAT Learning Assistant API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs startup and shutdown tasks of the API"""
+    if PRECOMPUTE_STRUCTURED_PLANS:
+        print('Precomputing structured learning plans...', end='')
+        warm_structured_plan_cache()
+        print(f' done ({len(structured_plan_cache)} plans cached)')
+    
+    conversation_memory.start_background_compaction(CONVERSATION_COMPACTION_INTERVAL)
+    learning_states.start(MILESTONE_FLUSH_INTERVAL_MS / 1000)
+    sweeper = asyncio.create_task(sweep_agent_pool())
+    watcher = asyncio.create_task(watch_study_plans(STUDY_PLANS_RELOAD_INTERVAL)) if STUDY_PLANS_RELOAD_INTERVAL > 0 else None
+    follower = asyncio.create_task(follow_state_events(STATE_EVENT_POLL_MS / 1000))
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    yield
+    loop_monitor.cancel()
+    follower.cancel()
+    sweeper.cancel()
+    if watcher is not None:
+        watcher.cancel()
+    # Write the milestone updates that are still buffered
+    learning_states.close()
+
+app = FastAPI(title="UPBEAT Learning Assistant API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -565,6 +2113,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def measure_request_duration(request: Request, call_next):
+    """Records the time to the response start of each request, per route template"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        http_request_duration.observe(time.perf_counter() - start, method=request.method,
+                                      route=route.path if route is not None else 'unmatched', status=status)
+
 # --- API ROUTES ---
     
 @app.get("/")
@@ -576,6 +2138,11 @@ async def root():
         "current_phase": current_phase
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Returns the metrics of this worker in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/users")
 async def get_users():
     """Gets a list of available users"""
@@ -583,38 +2150,49 @@ async def get_users():
 
 @app.get("/api/user/{user_id}")
 async def get_user_data(user_id: str):
-    """Gets user data for a specific user"""
+    """Gets user data for a specific user, served from the user payload cache"""
     if user_id not in user_datasets:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
     
-    # Load learning state
-    learning_state = load_user_state(user_id)
-    if learning_state is None and 'milestones' in user_datasets[user_id]:
-        learning_state = {
-            'labels': user_datasets[user_id]['milestones'],
-            'states': [False] * len(user_datasets[user_id]['milestones'])
-        }
-        save_user_state(user_id, learning_state)
-    
+    return Response(content=get_user_payload(user_id), media_type="application/json")
+
+@app.get("/api/admin/stats")
+async def get_admin_stats():
+    """Gets runtime metrics of the API, such as agent pool usage"""
     return {
-        "username": user_id,
-        "smart_plan_phase1": user_datasets[user_id]["smart_plan_phase1"],
-        "smart_plan_phase2": user_datasets[user_id]["smart_plan_phase2"],
-        "milestones": user_datasets[user_id]["milestones"],
-        "learning_state": learning_state,
-        "data": user_datasets[user_id].get("data", {})
+        "agent_pool": user_agents.stats(),
+        "shared_agents": len(shared_agents),
+        "conversations": conversation_memory.stats(),
+        "learning_state": {**state_store.stats(), **learning_states.stats()},
+        "user_payload_cache": {**user_payload_stats, "users": len(user_payload_cache)},
+        "study_plans": {**plans_reload_stats, "users": len(user_datasets)},
+        "worker_sync": {**worker_sync_stats, "origin": state_store.origin},
+        "admission": admission.stats(),
+        "answer_cache": {**answer_cache_stats, "enabled": ANSWER_CACHE_ENABLED, "answers": len(answer_cache)},
+        "summarization": summarization_stats,
+        "search_cache": web_search.stats() if web_search else None,
+        "search_extraction": extraction_stats
     }
 
+@app.get("/api/admin/milestone-progress")
+async def get_milestone_progress():
+    """Gets the number of completed and total milestones of every user"""
+    learning_states.flush()
+    return {"users": state_store.milestone_progress()}
+
 @app.get("/api/phase")
 async def get_current_phase():
     """Gets the current phase (1=onboarding, 2=training)"""
     return {"phase": current_phase}
 
 @app.get("/api/learning-plan/{user_id}/{phase}/structured")
-async def get_structured_learning_plan(user_id: str, phase: int):
+async def get_structured_learning_plan(user_id: str, phase: int, request: Request):
     """
     Returns the user's learning plan in a structured JSON format,
     which can be used in a tab-based view.
+    
+    The response is served from the structured plan cache and supports
+    conditional requests (ETag / If-None-Match) and gzip encoding.
     """
     if user_id not in user_datasets:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
@@ -622,14 +2200,24 @@ async def get_structured_learning_plan(user_id: str, phase: int):
     if phase not in [1, 2]:
         raise HTTPException(status_code=400, detail="Invalid phase. Must be 1 or 2.")
     
-    # Get learning plan for user and phase
-    plan_key = 'smart_plan_phase1' if phase == 1 else 'smart_plan_phase2'
-    plan_text = user_datasets[user_id][plan_key]
+    # Get cached structured plan for user and phase
+    entry = get_structured_plan_entry(user_id, phase)
+    use_gzip = accepts_gzip(request.headers.get('accept-encoding'))
+    
+    headers = {
+        "ETag": entry['gzip_etag'] if use_gzip else entry['etag'],
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+    
+    if etag_matches(request.headers.get('if-none-match'), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
     
-    # Parse plan into structured format
-    structured_plan = parse_learning_plan(plan_text)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=entry['gzip_body'], media_type="application/json", headers=headers)
     
-    return structured_plan
+    return Response(content=entry['body'], media_type="application/json", headers=headers)
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
@@ -641,11 +2229,41 @@ async def chat(request: ChatRequest):
     return ChatResponse(response=response)
 
 @app.get("/api/chat/stream")
-async def chat_stream(user_id: str, message: str):
-    """Streams a conversation with the assistant"""
+async def chat_stream(
+    user_id: str,
+    message: str,
+    request: Request,
+    stream_format: str = Query('delta', alias='format'),
+    last_event_id: Optional[str] = None
+):
+    """
+    Streams a conversation with the assistant.
+    
+    The default format sends deltas with typed events (see stream_predict_for_user),
+    format=full sends the full response on every update for old clients. A request
+    with a Last-Event-ID header (or last_event_id parameter) resumes an earlier stream.
+    """
     if user_id not in user_datasets:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
     
+    if stream_format not in ['delta', 'full']:
+        raise HTTPException(status_code=400, detail="Invalid format. Must be 'delta' or 'full'.")
+    
+    # Resume an earlier stream from the event after Last-Event-ID
+    resume_from = None
+    last_event_id = request.headers.get('last-event-id') or last_event_id
+    if last_event_id:
+        stream_id, _, seq = last_event_id.partition(':')
+        stream = chat_streams.get(stream_id)
+        if stream is None or stream.user_id != user_id:
+            raise HTTPException(status_code=404, detail=f"Stream {stream_id} not found")
+        if not seq.isdigit():
+            raise HTTPException(status_code=400, detail=f"Invalid Last-Event-ID {last_event_id}")
+        resume_from = (stream, int(seq))
+    else:
+        # Started before the response, so a turn that is not admitted gets a 429 with Retry-After
+        resume_from = (await start_chat_stream(user_id, message), 0)
+    
     # CORS- ja streaming-ystävälliset headerit
     headers = {
         "Content-Type": "text/event-stream",
@@ -659,7 +2277,7 @@ async def chat_stream(user_id: str, message: str):
     }
     
     return StreamingResponse(
-        stream_predict_for_user(user_id, message),
+        count_sse_connection(stream_predict_for_user(user_id, message, stream_format, resume_from)),
         media_type="text/event-stream",
         headers=headers
     )
@@ -682,52 +2300,28 @@ async def update_milestones(request: UpdateMilestonesRequest):
     state['states'] = request.milestones
     
     # Save updated state
-    success = save_user_state(request.user_id, state)
+    try:
+        success = save_user_state(request.user_id, state)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"success": success}
 
 def save_agent_settings(user_id, settings):
-    """Saves agent settings to disk"""
-    user_dir = os.path.join('user_data', user_id)
-    
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir, exist_ok=True)
-        
-    settings_file = os.path.join(user_dir, 'agent_settings.pickle')
-    temp_file = os.path.join(user_dir, 'agent_settings.temp.pickle')
-    
+    """Saves agent settings to the state store"""
+    invalidate_answers(user_id)
     try:
-        with open(temp_file, 'wb') as f:
-            pickle.dump(settings, f)
-            f.flush()
-            os.fsync(f.fileno())
-        
-        # Rename for atomic write
-        if os.path.exists(settings_file) and os.name == 'nt':
-            os.remove(settings_file)
-            
-        os.rename(temp_file, settings_file)
+        state_store.save_agent_settings(user_id, settings)
         return True
-    except Exception as e:
+    except sqlite3.Error as e:
         print(f"Error saving agent settings: {e}")
-        if os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
         return False
 
 def load_agent_settings(user_id):
-    """Loads agent settings from disk"""
-    user_dir = os.path.join('user_data', user_id)
-    settings_file = os.path.join(user_dir, 'agent_settings.pickle')
-    
-    if os.path.exists(settings_file):
-        try:
-            with open(settings_file, 'rb') as f:
-                return pickle.load(f)
-        except Exception as e:
-            print(f"Error loading agent settings: {e}")
-    
+    """Loads agent settings from the state store"""
+    try:
+        return state_store.load_agent_settings(user_id)
+    except sqlite3.Error as e:
+        print(f"Error loading agent settings: {e}")
     return None
    
 @app.post("/api/update-agent-settings")
@@ -793,40 +2387,67 @@ async def reset_agent_settings(user_id: str, reset: bool = False):
             }
         else:
             # If no settings on disk, create with default settings
-            create_agent_for_user(user_id)
+            agent_entry = create_agent_for_user(user_id)
             return {
                 "success": True,
-                "settings": user_agents[user_id]['settings']
+                "settings": agent_entry['settings']
             }
 
-@app.get("/api/download-pdf/{user_id}/{phase}")
-async def download_pdf(user_id: str, phase: int, background_tasks: BackgroundTasks):
-    """Downloads a PDF for a user"""
+@app.api_route("/api/download-pdf/{user_id}/{phase}", methods=["GET", "HEAD"])
+async def download_pdf(user_id: str, phase: int, request: Request):
+    """
+    Downloads a PDF for a user
+    
+    The PDF is streamed from memory and supports conditional requests
+    (ETag / If-None-Match, Last-Modified / If-Modified-Since) and single byte ranges.
+    HEAD requests get the headers only.
+    """
     if user_id not in user_datasets:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
     
     if phase not in [1, 2]:
         raise HTTPException(status_code=400, detail="Invalid phase. Must be 1 or 2.")
     
-    # Determine which PDF to return
     file_name = "UPBEAT_onboarding_plan.pdf" if phase == 1 else "UPBEAT_training_plan.pdf"
-    temp_dir = tempfile.gettempdir()
-    file_path = os.path.join(temp_dir, f"{user_id}_{file_name}")
-    
-    # Write PDF data to temporary file
-    pdf_data_key = 'smart_plan_pdf_phase1' if phase == 1 else 'smart_plan_pdf_phase2'
-    with open(file_path, 'wb') as pdf_file:
-        pdf_file.write(user_datasets[user_id][pdf_data_key])
-    
-    # Schedule cleanup after response is sent
-    background_tasks.add_task(lambda: os.remove(file_path) if os.path.exists(file_path) else None)
-    
-    return FileResponse(
-        path=file_path,
-        filename=file_name,
-        media_type="application/pdf",
-        background=background_tasks
-    )
+    entry = get_pdf_entry(user_id, phase)
+    data = entry['data']
+    headers = {
+        "ETag": entry['etag'],
+        "Last-Modified": entry['last_modified'],
+        "Cache-Control": "no-cache",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{file_name}"'
+    }
+    
+    if_none_match = request.headers.get('if-none-match')
+    if etag_matches(if_none_match, entry['etag']) or (
+            if_none_match is None and
+            not_modified_since(request.headers.get('if-modified-since'), entry['modified'])):
+        return Response(status_code=304, headers=headers)
+    
+    # A range is only served if the client's copy (If-Range) is still current
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if if_range and if_range not in (entry['etag'], entry['last_modified']):
+        range_header = None
+    
+    try:
+        byte_range = parse_byte_range(range_header, len(data))
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{len(data)}"
+        return Response(status_code=416, headers=headers)
+    
+    status_code = 200
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        data = memoryview(data)[start:end + 1]
+        status_code = 206
+    headers["Content-Length"] = str(len(data))
+    
+    if request.method == "HEAD":
+        return Response(status_code=status_code, media_type="application/pdf", headers=headers)
+    return StreamingResponse(iter_pdf_chunks(data), status_code=status_code, media_type="application/pdf", headers=headers)
 
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
@@ -0,0 +1,26 @@
+"""
+Environment of the benchmarks that import app.py in-process
+
+app.py opens its databases when it is imported, so prepare_app_env is called
+before the import: the API keys get dummy values unless they are set, and the
+conversation, state and search cache databases are created in a temp
+directory that is removed at exit. Benchmark runs never write into user_data.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+def prepare_app_env() -> str:
+    """Points the app's databases to a new temp directory, returns the directory"""
+    directory = tempfile.mkdtemp(prefix='upbeat-benchmark-')
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ.update(
+        CONVERSATION_DB_FILE=os.path.join(directory, 'conversations.sqlite'),
+        STATE_DB_FILE=os.path.join(directory, 'state.sqlite'),
+        SEARCH_CACHE_DB_FILE=os.path.join(directory, 'search_cache.sqlite'),
+    )
+    for key in ('ANTHROPIC_API_KEY', 'OPENAI_API_KEY', 'TAVILY_API_KEY'):
+        os.environ.setdefault(key, 'benchmark')
+    return directory
@@ -0,0 +1,231 @@
+"""
+Learning plan parser benchmark and fuzzer
+
+Measures the parsing time of parse_learning_plan for adversarial plans of growing
+size, checks that the time per byte stays flat (linear scaling), and runs a
+mutation fuzzer over the corpus in benchmarks/plan_parser_corpus and the stored
+study plans. The previous regex-based parser is included for comparison.
+
+Usage (from the repository root):
+    python benchmarks/bench_plan_parser.py [--check] [--legacy] [--fuzz-iterations N]
+"""
+
+import argparse
+import os
+import pickle
+import random
+import re
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'plan_parser_corpus')
+SIZES = [2_000, 20_000, 200_000, 2_000_000]
+MAX_SLOWDOWN_PER_BYTE = 3.0  # Allowed growth of time/byte from the smallest to the largest input
+LEGACY_TIME_BUDGET = 2.0  # Seconds, legacy parser is not run on larger inputs once exceeded
+
+# app.py reads data files relative to the repository root and exports API keys at import
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+for key in ('ANTHROPIC_API_KEY', 'OPENAI_API_KEY', 'TAVILY_API_KEY'):
+    os.environ.setdefault(key, 'benchmark')
+
+from app import STUDY_PLANS_FILE, parse_learning_plan  # noqa: E402
+
+# --- LEGACY PARSER (regex based, kept for comparison) ---
+def legacy_parse_learning_plan(plan_text):
+    title_match = re.search(r'^(.*?)\n(Dear.*?)(?=\n\n\d+\.)', plan_text, re.DOTALL)
+    if not title_match:
+        return {"error": "Couldn't parse the learning plan format"}
+    sections = {}
+    section_pattern = r'(?:^|\n)(\d+)\.\s+(.*?)\n(.*?)(?=\n\d+\.|$)'
+    for section_num, section_title, section_content in re.findall(section_pattern, plan_text, re.DOTALL):
+        sections[f"section_{section_num}"] = section_content
+        if "Learning objectives" in section_title:
+            re.findall(r'(.*?)\n((?:.*?\n)*?)(?=\n[A-Za-z]|$)', section_content)
+        elif "Extra assignments" in section_title:
+            re.findall(r'(.*?)\nTask:(.*?)(?:Process:|Tool:|$)(.*?)(?:Tool:|Sample prompt:|$)(.*?)(?:Sample prompt:|$)(.*?)(?=\n\n|$)',
+                       section_content, re.DOTALL)
+    return sections
+
+# --- ADVERSARIAL INPUTS ---
+def repeat_to_size(header, block, size):
+    """Repeats a text block after a header until the text reaches the given size"""
+    return header + block * max(1, (size - len(header)) // len(block))
+
+def assignments_without_breaks(size):
+    """Assignment labels without any blank lines between them"""
+    return repeat_to_size('Plan\nDear Student,\n\n1. Extra assignments\n',
+                          'Assignment title\nTask: write Process: Tool: Sample prompt: Task:\n', size)
+
+def assignments_without_task(size):
+    """Assignment blocks that never contain the "Task:" label"""
+    return repeat_to_size('Plan\nDear Student,\n\n1. Extra assignments\n',
+                          'Assignment title\nProcess: describe the steps\n', size)
+
+def numbered_lines(size):
+    """Numbered list items that look like section headers"""
+    return repeat_to_size('Plan\nDear Student,\n\n', '1. Learning objectives\n2. x\n', size)
+
+def objectives_without_breaks(size):
+    """One objective category with a very long run of items"""
+    return repeat_to_size('Plan\nDear Student,\n\n## 1. Learning objectives\nCategory\n', '- objective item\n', size)
+
+def single_long_line(size):
+    """One huge line without any newline"""
+    return repeat_to_size('Plan\nDear Student, ', 'lorem ipsum Task: Process: 1. ', size)
+
+def materials_without_urls(size):
+    """Material items that never get a URL"""
+    return repeat_to_size('Plan\nDear Student,\n\n## 1. Additional online materials\n', '7: description<br>not a url\n', size)
+
+def assignment_with_long_task(size):
+    """A single assignment whose task continues for thousands of lines"""
+    return repeat_to_size('Plan\nDear Student,\n\n1. Extra assignments\nAssignment title\nTask: start\n',
+                          'the task description continues on this line\n', size)
+
+def bold_assignment_with_long_description(size):
+    """A single bold-titled assignment followed by thousands of list items"""
+    return repeat_to_size('Plan\nDear Student,\n\n## 1. Extra assignments\n1. **Title**: description\n',
+                          '- another step of the assignment\n', size)
+
+def material_with_long_description(size):
+    """A single material item whose description continues for thousands of lines"""
+    return repeat_to_size('Plan\nDear Student,\n\n## 1. Additional online materials\n1: description\n',
+                          'more description without a url\n', size)
+
+def repeated_real_plan(size):
+    """A real generated plan repeated back to back"""
+    with open(STUDY_PLANS_FILE, 'rb') as f:
+        user_datasets = pickle.load(f)
+    plan_text = next(iter(user_datasets.values()))['smart_plan_phase1']
+    return repeat_to_size('', plan_text + '\n', size)
+
+GENERATORS = [
+    assignments_without_breaks,
+    assignments_without_task,
+    numbered_lines,
+    objectives_without_breaks,
+    single_long_line,
+    materials_without_urls,
+    assignment_with_long_task,
+    bold_assignment_with_long_description,
+    material_with_long_description,
+    repeated_real_plan
+]
+
+def best_time(func, text, repeats=3):
+    """Returns the best wall-clock time of several runs"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_benchmark(run_legacy):
+    """Times the parser on all adversarial inputs, returns False if scaling is not linear"""
+    linear = True
+    print(f"{'input':<28}{'bytes':>10}{'parse ms':>11}{'ns/byte':>9}{'legacy ms':>12}")
+    for generator in GENERATORS:
+        per_byte = []
+        legacy_exhausted = not run_legacy
+        for size in SIZES:
+            text = generator(size)
+            elapsed = best_time(parse_learning_plan, text)
+            per_byte.append(elapsed / len(text))
+
+            legacy = '-'
+            if not legacy_exhausted:
+                legacy_elapsed = best_time(legacy_parse_learning_plan, text, repeats=1)
+                legacy = f'{legacy_elapsed * 1000:.1f}'
+                legacy_exhausted = legacy_elapsed > LEGACY_TIME_BUDGET
+            print(f'{generator.__name__:<28}{len(text):>10}{elapsed * 1000:>11.2f}{per_byte[-1] * 1e9:>9.1f}{legacy:>12}')
+
+        slowdown = per_byte[-1] / per_byte[0]
+        if slowdown > MAX_SLOWDOWN_PER_BYTE:
+            print(f'  -> NOT LINEAR: time per byte grew {slowdown:.1f}x')
+            linear = False
+    return linear
+
+# --- FUZZING ---
+def load_corpus():
+    """Loads the adversarial corpus files and the stored study plans"""
+    corpus = []
+    for file_name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, file_name), encoding='utf-8', newline='') as f:
+            corpus.append(f.read())
+    with open(STUDY_PLANS_FILE, 'rb') as f:
+        for record in pickle.load(f).values():
+            corpus.extend([record['smart_plan_phase1'], record['smart_plan_phase2']])
+    return corpus
+
+def mutate(text, rng):
+    """Applies a random line-level or character-level mutation"""
+    lines = text.split('\n')
+    operation = rng.randrange(7)
+    if operation == 0 and lines:
+        del lines[rng.randrange(len(lines))]
+    elif operation == 1 and lines:
+        index = rng.randrange(len(lines))
+        lines[index:index] = [lines[index]] * rng.randint(2, 50)
+    elif operation == 2:
+        rng.shuffle(lines)
+    elif operation == 3:
+        lines.insert(rng.randrange(len(lines) + 1), rng.choice(
+            ['Task:', '**', '## 1.', '1: ', '<br>', 'Dear', '###', '- ', 'We are glad to have you onboard', '\r', '']))
+    elif operation == 4 and text:
+        return text[:rng.randrange(len(text))]
+    elif operation == 5 and lines:
+        index = rng.randrange(len(lines))
+        lines[index] = lines[index].replace(' ', '')
+    else:
+        return text.replace('\n\n', '\n')
+    return '\n'.join(lines)
+
+def check_schema(result):
+    """Raises AssertionError if a parse result does not follow the plan schema"""
+    assert isinstance(result, dict)
+    if 'error' in result:
+        assert set(result) == {'error'}
+        return
+    assert set(result) == {'title', 'introduction', 'sections', 'ending'}
+    for key, section in result['sections'].items():
+        assert key == f"section_{section['number']}"
+        assert all(isinstance(section[field], str) for field in ('number', 'title', 'content'))
+        for topic in section.get('topics', []):
+            assert set(topic) == {'number', 'title', 'description'}
+        for category, items in section.get('objectives', {}).items():
+            assert isinstance(category, str) and all(isinstance(item, str) for item in items)
+        for assignment in section.get('assignments', []):
+            assert 'title' in assignment and len(assignment) > 1
+            assert set(assignment) <= {'title', 'task', 'process', 'tools', 'sample_prompt'}
+        for material in section.get('materials', []):
+            assert set(material) == {'number', 'description', 'url'}
+
+def run_fuzzer(iterations, seed=1234):
+    """Parses randomly mutated corpus plans and validates the result schema"""
+    rng = random.Random(seed)
+    corpus = load_corpus()
+    for iteration in range(iterations):
+        text = rng.choice(corpus)
+        for _ in range(rng.randint(1, 5)):
+            text = mutate(text, rng)
+        try:
+            check_schema(parse_learning_plan(text))
+        except Exception:
+            print(f'Fuzzing failed at iteration {iteration} (seed {seed}) for input:\n{text[:2000]!r}')
+            raise
+    print(f'Fuzzing: {iterations} mutated plans parsed ({len(corpus)} corpus entries)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Learning plan parser benchmark')
+    parser.add_argument('--check', action='store_true', help='exit with an error if scaling is not linear')
+    parser.add_argument('--legacy', action='store_true', help='also time the old regex parser')
+    parser.add_argument('--fuzz-iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    is_linear = run_benchmark(args.legacy)
+    run_fuzzer(args.fuzz_iterations)
+    if args.check and not is_linear:
+        sys.exit(1)
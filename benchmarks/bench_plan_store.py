@@ -0,0 +1,106 @@
+"""
+Startup time and memory of the study plan pickle vs. the plan store
+
+Builds a synthetic cohort by copying the stored personas under new user ids,
+writes it both as a pickle and as a plan store, and measures in a fresh process
+for each format: the time to load, the resident memory after loading, and the
+time to read a plan and a PDF of random users.
+
+Usage (from the repository root):
+    python benchmarks/bench_plan_store.py [--users 5000] [--reads 2000]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUDY_PLANS_FILE = os.path.join(ROOT_DIR, 'learning_plans', 'study_plans_data.pickle')
+sys.path.insert(0, ROOT_DIR)
+
+from plan_store import PlanStore, convert_pickle  # noqa: E402
+
+# Runs in a fresh interpreter, prints a JSON line of measurements
+MEASURE_SCRIPT = """
+import json, random, resource, sys, time
+sys.path.insert(0, {root!r})
+import pandas, plan_store  # Imported before timing, the app imports them anyway
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+baseline = rss_mb()
+start = time.perf_counter()
+if {format!r} == 'pickle':
+    import pickle
+    with open({path!r}, 'rb') as f:
+        user_datasets = pickle.load(f)
+else:
+    user_datasets = plan_store.PlanStore({path!r})
+load_seconds = time.perf_counter() - start
+loaded = rss_mb()
+
+user_ids = list(user_datasets)
+rng = random.Random(1)
+start = time.perf_counter()
+size = 0
+for _ in range({reads}):
+    record = user_datasets[rng.choice(user_ids)]
+    size += len(record['smart_plan_phase2']) + len(record['smart_plan_pdf_phase1'])
+read_seconds = time.perf_counter() - start
+print(json.dumps({{'load_ms': load_seconds * 1000, 'rss_mb': loaded - baseline,
+                  'read_us': read_seconds / {reads} * 1e6, 'rss_after_reads_mb': rss_mb() - baseline}}))
+"""
+
+def build_cohort(users):
+    """Copies the stored personas under new ids, each user gets distinct objects like in real data"""
+    with open(STUDY_PLANS_FILE, 'rb') as f:
+        personas = list(pickle.load(f).values())
+    cohort = {}
+    for index in range(users):
+        user_id = f'student{index}@example.com'
+        record = {}
+        for key, value in personas[index % len(personas)].items():
+            if isinstance(value, (str, bytes)):
+                value = value + (user_id if isinstance(value, str) else user_id.encode())
+            elif hasattr(value, 'copy'):
+                value = value.copy()
+            record[key] = value
+        cohort[user_id] = record
+    return cohort
+
+def measure(data_format, path, reads):
+    script = MEASURE_SCRIPT.format(root=ROOT_DIR, format=data_format, path=path, reads=reads)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        pickle_path = os.path.join(directory, 'study_plans_data.pickle')
+        store_path = os.path.join(directory, 'study_plans')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(build_cohort(args.users), f)
+        convert_pickle(pickle_path, store_path)
+
+        print(f'{args.users} users: pickle {os.path.getsize(pickle_path) / 1e6:.1f} MB, '
+              f'store index {os.path.getsize(store_path + ".index.json") / 1e6:.2f} MB '
+              f'+ blobs {os.path.getsize(PlanStore(store_path).blob_path) / 1e6:.1f} MB')
+        print(f"{'format':<8}{'load ms':>10}{'RSS MB':>9}{'read us':>10}{'RSS after reads MB':>20}")
+        for data_format, path in (('pickle', pickle_path), ('store', store_path)):
+            result = measure(data_format, path, args.reads)
+            print(f"{data_format:<8}{result['load_ms']:>10.1f}{result['rss_mb']:>9.1f}"
+                  f"{result['read_us']:>10.1f}{result['rss_after_reads_mb']:>20.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Study plan pickle vs. plan store')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--reads', type=int, default=2000, help='random plan and PDF reads per format')
+    main(parser.parse_args())
@@ -0,0 +1,121 @@
+"""
+Web search cache latency and hit ratio
+
+Replays a day of cohort questions (a few popular topics asked in many
+phrasings) against the offline fixture backend with a fixed search latency,
+without a cache, with the cache, and after a restart with only the persistent
+tier warm. It also reports the bytes removed by the content extraction for
+the pages in benchmarks/search_fixtures.json. No network access or API key is
+needed.
+
+Usage (from the repository root):
+    python benchmarks/bench_search_cache.py [--queries 600] [--topics 40] [--latency 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from web_search import CachedSearch, FixtureBackend, extract_results  # noqa: E402
+
+FIXTURE_FILE = os.path.join(ROOT_DIR, 'benchmarks', 'search_fixtures.json')
+
+SUBJECTS = [
+    'lean canvas', 'business model canvas', 'market research', 'customer interviews', 'pitch deck',
+    'minimum viable product', 'startup funding', 'value proposition', 'competitor analysis', 'pricing strategy',
+    'social media marketing', 'branding', 'financial projections', 'cash flow', 'business plan',
+    'company registration in finland', 'intellectual property', 'crowdfunding', 'angel investors', 'seo basics',
+    'customer personas', 'sales funnel', 'product market fit', 'growth hacking', 'unit economics',
+    'email marketing', 'networking events', 'grant applications', 'export to eu markets', 'team building',
+    'time management', 'risk assessment', 'swot analysis', 'okrs', 'user testing',
+    'landing page', 'content marketing', 'b2b sales', 'supply chain', 'legal forms of a company'
+]
+PHRASINGS = [
+    'how to write a {}', 'How do I write a {}?', '{} tutorial', 'what is {}', 'What is {}?',
+    '{} examples', 'examples of {}', 'best {} tips', 'tips for {}', '{}'
+]
+PERCENTILES = (0.5, 0.95, 0.99)
+
+def make_workload(queries, topics, seed=7):
+    """Questions on Zipf-distributed topics, each asked in a random phrasing"""
+    rng = random.Random(seed)
+    subjects = (SUBJECTS * (topics // len(SUBJECTS) + 1))[:topics]
+    subjects = [subject if index < len(SUBJECTS) else f'{subject} {index}' for index, subject in enumerate(subjects)]
+    weights = [1 / rank for rank in range(1, topics + 1)]
+    return [rng.choice(PHRASINGS).format(rng.choices(subjects, weights)[0]) for _ in range(queries)]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def replay(search, workload, concurrency):
+    """Runs the workload with concurrent students, returns latencies in ms"""
+    queue = list(reversed(workload))
+    latencies = []
+
+    async def student():
+        while queue:
+            query = queue.pop()
+            start = time.perf_counter()
+            await search(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(student() for _ in range(concurrency)))
+    return latencies
+
+def report(name, latencies, elapsed, cache=None):
+    stats = ' '.join(f'p{int(fraction * 100)}={percentile(latencies, fraction):7.1f} ms' for fraction in PERCENTILES)
+    line = f'{name:<22} {stats}  mean={statistics.mean(latencies):7.1f} ms  total={elapsed:5.1f} s'
+    if cache is not None:
+        cache_stats = cache.stats()
+        line += (f"  hit ratio={cache_stats['hit_ratio']:.2f} (memory {cache_stats['memory_hits']},"
+                 f" disk {cache_stats['disk_hits']}, misses {cache_stats['misses']})")
+    print(line)
+
+async def main(args):
+    workload = make_workload(args.queries, args.topics)
+    print(f'{args.queries} queries on {args.topics} topics, search latency {args.latency * 1000:.0f} ms, '
+          f'{args.concurrency} concurrent students')
+
+    runs = [('no cache', None), ('cache (cold)', 'new'), ('cache (restart)', 'reopen')]
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'search_cache.sqlite')
+        for name, mode in runs:
+            backend = FixtureBackend(latency=args.latency)
+            cache = None
+            search = backend.asearch
+            if mode is not None:
+                # A restart keeps the SQLite tier but starts with an empty memory tier
+                cache = CachedSearch(backend, ttl=3600, capacity=args.capacity, db_path=db_path)
+                search = cache.asearch
+            start = time.perf_counter()
+            latencies = await replay(search, workload, args.concurrency)
+            report(name, latencies, time.perf_counter() - start, cache)
+
+    print(f'\nContent extraction, {args.token_budget} tokens per result')
+    backend = FixtureBackend(FIXTURE_FILE)
+    for query in backend.fixtures:
+        results = backend.search(query)
+        start = time.perf_counter()
+        extracted = extract_results(results, query, args.token_budget)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f'  {query:<24} {len(json.dumps(results)):>7} bytes -> {len(json.dumps(extracted)):>6} bytes  {elapsed:5.2f} ms')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Web search cache latency and hit ratio')
+    parser.add_argument('--queries', type=int, default=600)
+    parser.add_argument('--topics', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.5, help='fixture search latency in seconds')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--capacity', type=int, default=1000, help='queries kept in the memory tier')
+    parser.add_argument('--token-budget', type=int, default=350, help='extraction token budget per result')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,164 @@
+"""
+Write throughput and cold read latency of per-user pickle files vs. the state store
+
+Creates a synthetic cohort of milestone states and agent settings and measures:
+- saves per second with one pickle file per user (temp file, fsync, rename as
+  in the earlier save_user_state), with one state store transaction per save,
+  and with batched state store transactions
+- in a fresh process, the latency of loading the state and settings of random
+  users, and of an admin-wide read of every user's milestone progress
+
+Usage (from the repository root):
+    python benchmarks/bench_state_store.py [--users 10000] [--reads 2000] [--batch-size 500]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from state_store import StateStore  # noqa: E402
+
+MILESTONES = 10
+
+# Runs in a fresh interpreter, prints a JSON line of measurements
+MEASURE_SCRIPT = """
+import json, os, pickle, random, sys, time
+sys.path.insert(0, {root!r})
+import state_store
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+start = time.perf_counter()
+if {format!r} == 'pickle':
+    user_ids = sorted(os.listdir({path!r}))
+    def load(user_id):
+        user_dir = os.path.join({path!r}, user_id)
+        return load_pickle(os.path.join(user_dir, 'state_variables.pickle')), load_pickle(os.path.join(user_dir, 'agent_settings.pickle'))
+    def progress():
+        states = {{user_id: load_pickle(os.path.join({path!r}, user_id, 'state_variables.pickle')) for user_id in user_ids}}
+        return {{user_id: sum(state['states']) for user_id, state in states.items()}}
+else:
+    store = state_store.StateStore({path!r})
+    user_ids = [f'student{{index}}@example.com' for index in range({users})]
+    def load(user_id):
+        return store.load_learning_state(user_id), store.load_agent_settings(user_id)
+    progress = store.milestone_progress
+open_ms = (time.perf_counter() - start) * 1000
+
+rng = random.Random(1)
+latencies = []
+for _ in range({reads}):
+    user_id = rng.choice(user_ids)
+    start = time.perf_counter()
+    state, settings = load(user_id)
+    latencies.append((time.perf_counter() - start) * 1e6)
+    assert len(state['states']) == {milestones} and settings['temperature'] == 0.3
+
+start = time.perf_counter()
+assert len(progress()) == {users}
+progress_ms = (time.perf_counter() - start) * 1000
+
+latencies.sort()
+print(json.dumps({{'open_ms': open_ms, 'progress_ms': progress_ms,
+                  **{{f'p{{p}}_us': latencies[min(len(latencies) - 1, len(latencies) * p // 100)] for p in (50, 95, 99)}}}}))
+"""
+
+def make_cohort(users):
+    """Learning states and agent settings of a synthetic cohort"""
+    states, settings = {}, {}
+    for index in range(users):
+        user_id = f'student{index}@example.com'
+        states[user_id] = {
+            'labels': [f'Milestone {number} of {user_id}: ' + 'complete a task of the learning plan ' * 3
+                       for number in range(MILESTONES)],
+            'states': [number < index % MILESTONES for number in range(MILESTONES)]
+        }
+        settings[user_id] = {
+            'system_prompt': f'You are the learning assistant of {user_id}. ' + 'Help the student with the plan. ' * 40,
+            'temperature': 0.3,
+            'use_plan_tool': True,
+            'use_search_tool': True,
+            'use_learningmaterial_tool': True,
+            'use_milestones_tool': index % 2 == 0
+        }
+    return states, settings
+
+def save_pickle(path, value):
+    """Saves like the earlier per-user pickle files"""
+    temp_file = path + '.temp'
+    with open(temp_file, 'wb') as f:
+        pickle.dump(value, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_file, path)
+
+def write_pickles(directory, states, settings):
+    for user_id in states:
+        user_dir = os.path.join(directory, user_id)
+        os.makedirs(user_dir, exist_ok=True)
+        save_pickle(os.path.join(user_dir, 'state_variables.pickle'), states[user_id])
+        save_pickle(os.path.join(user_dir, 'agent_settings.pickle'), settings[user_id])
+
+def write_store(path, states, settings):
+    store = StateStore(path)
+    for user_id in states:
+        store.save_learning_state(user_id, states[user_id])
+        store.save_agent_settings(user_id, settings[user_id])
+
+def write_store_batched(path, states, settings, batch_size):
+    store = StateStore(path)
+    user_ids = list(states)
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        store.save_learning_states({user_id: states[user_id] for user_id in batch})
+        store.save_many_agent_settings({user_id: settings[user_id] for user_id in batch})
+
+def measure(data_format, path, args):
+    script = MEASURE_SCRIPT.format(root=ROOT_DIR, format=data_format, path=path, users=args.users,
+                                   reads=args.reads, milestones=MILESTONES)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main(args):
+    states, settings = make_cohort(args.users)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        pickle_dir = os.path.join(directory, 'user_data')
+        runs = [
+            ('pickle files', pickle_dir, lambda: write_pickles(pickle_dir, states, settings)),
+            ('store', os.path.join(directory, 'single.sqlite'),
+             lambda: write_store(os.path.join(directory, 'single.sqlite'), states, settings)),
+            (f'store, batches of {args.batch_size}', os.path.join(directory, 'batched.sqlite'),
+             lambda: write_store_batched(os.path.join(directory, 'batched.sqlite'), states, settings, args.batch_size))
+        ]
+
+        print(f'{args.users} users, {MILESTONES} milestones each, state and settings saved per user')
+        print(f"{'writes':<26}{'seconds':>9}{'saves/s':>10}")
+        for name, _, write in runs:
+            start = time.perf_counter()
+            write()
+            elapsed = time.perf_counter() - start
+            print(f'{name:<26}{elapsed:>9.2f}{2 * args.users / elapsed:>10.0f}')
+
+        print(f"\n{'cold reads':<26}{'open ms':>9}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'all progress ms':>17}")
+        for name, path in (('pickle files', pickle_dir), ('store', runs[2][1])):
+            result = measure('pickle' if path == pickle_dir else 'store', path, args)
+            print(f"{name:<26}{result['open_ms']:>9.1f}{result['p50_us']:>10.1f}{result['p95_us']:>10.1f}"
+                  f"{result['p99_us']:>10.1f}{result['progress_ms']:>17.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-user pickle files vs. the state store')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--reads', type=int, default=2000, help='random users loaded in the cold read test')
+    parser.add_argument('--batch-size', type=int, default=500, help='users saved per transaction in the batched run')
+    parser.add_argument('--directory', default=None, help='where to write the data, defaults to the temp directory')
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+"""
+Token coalescing of the chat stream
+
+Streams chats from the API (served in-process against a fake chat model that
+emits one word per token) with different flush policies and reports the number
+of SSE events, bytes sent and time to first token per stream. Each stream is
+sent by its own user, as the API runs one turn per conversation at a time, and
+the concurrency limit is raised to the number of streams, so that no stream
+waits in the admission queue.
+
+Usage (from the repository root):
+    python benchmarks/bench_stream_coalescing.py [--streams 20] [--tokens 400] [--token-interval 0.002]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.app_env import prepare_app_env  # noqa: E402
+
+prepare_app_env()
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+from benchmarks.benchmark_users import add_benchmark_users  # noqa: E402
+from benchmarks.fake_chat_model import install_fake_chat_model  # noqa: E402
+
+# (flush interval ms, flush chars), interval 0 sends every token as its own event
+POLICIES = [(0, 0), (20, 256), (50, 256), (100, 1024)]
+
+async def stream_chat(client, user_id, index):
+    """Streams one chat, returns (events, bytes, time to first token in ms)"""
+    events = 0
+    size = 0
+    first_token = None
+    start = time.perf_counter()
+    async with client.stream('GET', '/api/chat/stream', params={
+        'user_id': user_id, 'message': f'Benchmark question {index}'
+    }) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            size += len(chunk.encode())
+            if first_token is None and 'event: token' in chunk:
+                first_token = (time.perf_counter() - start) * 1000
+            events += chunk.count('\n\n')
+    return events, size, first_token
+
+async def run_policy(client, user_ids, streams):
+    results = await asyncio.gather(*(stream_chat(client, user_ids[index], index) for index in range(streams)))
+    events, sizes, first_tokens = zip(*results)
+    return statistics.mean(events), statistics.mean(sizes), statistics.median(first_tokens)
+
+async def main(args):
+    answer = ' '.join(f'word{index}' for index in range(args.tokens))
+    install_fake_chat_model(app, latency=0.05, token_interval=args.token_interval, answer=answer)
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+        user_ids = add_benchmark_users(app, args.streams)
+        app.admission.limit = max(app.admission.limit, args.streams)
+
+        print(f'{args.streams} concurrent streams, {args.tokens} tokens each, one token per {args.token_interval * 1000:.0f} ms')
+        print(f"{'interval ms':>12}{'chars':>7}{'events/stream':>15}{'bytes/stream':>14}{'TTFT ms':>9}")
+        for interval, chars in POLICIES:
+            app.STREAM_FLUSH_INTERVAL_MS = interval
+            app.STREAM_FLUSH_CHARS = chars
+            events, size, first_token = await run_policy(client, user_ids, args.streams)
+            print(f'{interval:>12}{chars:>7}{events:>15.0f}{size:>14.0f}{first_token:>9.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Token coalescing of the chat stream')
+    parser.add_argument('--streams', type=int, default=20, help='number of concurrent streams')
+    parser.add_argument('--tokens', type=int, default=400, help='tokens in each fake answer')
+    parser.add_argument('--token-interval', type=float, default=0.002, help='seconds between fake tokens')
+    asyncio.run(main(parser.parse_args()))
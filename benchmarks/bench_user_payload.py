@@ -0,0 +1,100 @@
+"""
+Requests per second of GET /api/user
+
+Serves the API in-process and compares the cached, pre-serialized payload with
+the earlier handler, which loaded the learning state and returned the record
+fields, including the pandas Series of survey answers from the pickle, for
+FastAPI to encode on every request. It also reports the time to build the
+payloads of all users with orjson and with the json module.
+
+Usage (from the repository root):
+    python benchmarks/bench_user_payload.py [--requests 5000] [--concurrency 20]
+"""
+
+import argparse
+import asyncio
+import os
+import pickle
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.app_env import prepare_app_env  # noqa: E402
+
+prepare_app_env()
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+
+with open(app.STUDY_PLANS_FILE, 'rb') as f:
+    pickled_datasets = pickle.load(f)
+
+@app.app.get("/benchmark/legacy-user/{user_id}")
+async def legacy_get_user_data(user_id: str):
+    """The handler before the payload cache, state loaded and response encoded per request"""
+    learning_state = app.state_store.load_learning_state(user_id)
+    return {
+        "username": user_id,
+        "smart_plan_phase1": pickled_datasets[user_id]["smart_plan_phase1"],
+        "smart_plan_phase2": pickled_datasets[user_id]["smart_plan_phase2"],
+        "milestones": pickled_datasets[user_id]["milestones"],
+        "learning_state": learning_state,
+        "data": pickled_datasets[user_id].get("data", {})
+    }
+
+async def measure(client, path, user_ids, requests, concurrency):
+    """Returns requests per second for the path template"""
+    remaining = list(range(requests))
+
+    async def worker():
+        while remaining:
+            index = remaining.pop()
+            response = await client.get(path.format(user_ids[index % len(user_ids)]))
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - start)
+
+def build_all_payloads():
+    """Returns the ms to serialize the payloads of all users from scratch"""
+    app.user_payload_cache.clear()
+    start = time.perf_counter()
+    for user_id in app.user_datasets:
+        app.get_user_payload(user_id)
+    return (time.perf_counter() - start) * 1000
+
+async def main(args):
+    user_ids = list(app.user_datasets)
+    for user_id in user_ids:
+        app.load_user_state(user_id)
+    app.learning_states.flush()
+
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        print(f'{len(user_ids)} users, {args.requests} requests, concurrency {args.concurrency}')
+        for name, path in (('before (encoded per request)', '/benchmark/legacy-user/{}'),
+                           ('after (cached payload)', '/api/user/{}')):
+            await measure(client, path, user_ids, args.concurrency * 10, args.concurrency)  # warm-up
+            rps = await measure(client, path, user_ids, args.requests, args.concurrency)
+            print(f'  {name:<30} {rps:8.0f} requests/s')
+
+    print('Building the payloads of all users')
+    orjson = app.orjson
+    for name in ('orjson', 'json'):
+        app.orjson = orjson if name == 'orjson' else None
+        if name == 'orjson' and orjson is None:
+            print('  orjson                         not installed')
+            continue
+        print(f'  {name:<30} {min(build_all_payloads() for _ in range(5)):8.2f} ms')
+    app.orjson = orjson
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Requests per second of GET /api/user')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,32 @@
+"""
+Additional users for the in-process benchmarks
+
+The API runs one chat turn per conversation at a time and answers a second
+concurrent turn of a user with 429, so a benchmark that keeps N chats in
+flight needs N users. add_benchmark_users copies the stored personas under new
+user ids into a temporary plan store and swaps it into the app.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+from plan_store import PlanStore, append_users
+
+def add_benchmark_users(app_module, users: int) -> list:
+    """Copies the stored personas until the app has at least users users, returns all user ids"""
+    user_ids = list(app_module.user_datasets)
+    if len(user_ids) >= users:
+        return user_ids
+
+    cohort = {user_id: dict(app_module.user_datasets[user_id]) for user_id in user_ids}
+    for index in range(users - len(user_ids)):
+        cohort[f'benchmark{index}@example.com'] = cohort[user_ids[index % len(user_ids)]]
+
+    directory = tempfile.mkdtemp(prefix='upbeat-benchmark-')
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    base_path = os.path.join(directory, 'study_plans')
+    append_users(base_path, cohort)
+    app_module.swap_study_plans(PlanStore(base_path), set())
+    return list(app_module.user_datasets)
@@ -0,0 +1,85 @@
+"""
+In-process stand-in for ChatOpenAI used by the benchmarks
+
+The fake model answers after a configurable delay without any network access.
+The synchronous path blocks the calling thread (like a real HTTP round-trip in a
+sync client) and the asynchronous path awaits, so blocking calls show up in the
+event loop measurements exactly as they would with the real model.
+"""
+
+import asyncio
+import time
+from typing import List
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning a fixed answer after latency seconds, streamed word by word"""
+
+    model: str = "fake"
+    temperature: float = 0.3
+    latency: float = 1.0
+    token_interval: float = 0.0
+    answer: str = "This is a benchmark answer from the fake chat model."
+    tool_names: List[str] = []
+    tool_call: str = ""  # Name of a tool called once per turn before answering, e.g. for traces of tool calls
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        """Records the tool names, only tool_call is ever called"""
+        return self.model_copy(update={"tool_names": [tool.name for tool in tools]})
+
+    def _calls_tool(self, messages) -> bool:
+        return bool(self.tool_call) and self.tool_call in self.tool_names and not isinstance(messages[-1], ToolMessage)
+
+    def _usage(self, messages, output: str) -> dict:
+        """Returns token usage counting words as tokens, so that the token metrics get values"""
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        output_tokens = len(output.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _reply(self, messages) -> AIMessage:
+        if self._calls_tool(messages):
+            return AIMessage(content="", tool_calls=[{"name": self.tool_call, "args": {}, "id": "call_fake"}],
+                             usage_metadata=self._usage(messages, ""))
+        return AIMessage(content=self.answer, usage_metadata=self._usage(messages, self.answer))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        if self._calls_tool(messages):
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": self.tool_call, "args": "{}", "id": "call_fake", "index": 0}], usage_metadata=self._usage(messages, "")))
+            return
+        words = self.answer.split(' ')
+        for index, word in enumerate(words):
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+            last = index == len(words) - 1
+            text = word if last else word + ' '
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=text, usage_metadata=self._usage(messages, self.answer) if last else None))
+            if run_manager:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+def install_fake_chat_model(app_module, **model_fields):
+    """Replaces ChatOpenAI in app.py with FakeChatModel configured with the given fields"""
+    def create_fake_model(model=None, temperature=0.3, **kwargs):
+        return FakeChatModel(temperature=temperature, **model_fields)
+
+    app_module.ChatOpenAI = create_fake_model
+    app_module.chat_models.clear()
+    app_module.shared_agents.clear()
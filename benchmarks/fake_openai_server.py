@@ -0,0 +1,133 @@
+"""
+Local stand-in for the OpenAI chat completions API used by the load suite
+
+Serves POST /v1/chat/completions, streamed and non-streamed, without any
+network access or API key. Answers start after --ttft seconds and are produced
+at --tokens-per-second. A tool-call script makes the model call tools like the
+real agent does: each new chat turn (a request ending with a user message)
+takes the next entry of the script in turn, a list of tool calls to make before
+answering. Tools the request does not offer are skipped, e.g. for the summary
+model. Example script:
+    [[], [{"name": "web_search_tool", "arguments": {"query": "how to write a lean canvas"}}],
+     [{"name": "milestones_tool", "arguments": {}}]]
+
+Usage (from the repository root):
+    python benchmarks/fake_openai_server.py [--port 8100] [--ttft 0.3] [--tokens-per-second 50] [--tool-script script.json]
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1 (and OPENAI_API_BASE for langchain).
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_TOOL_SCRIPT = [
+    [],
+    [{"name": "web_search_tool", "arguments": {"query": "how to write a lean canvas"}}],
+    [{"name": "milestones_tool", "arguments": {}}],
+    [{"name": "additional_materials_tool", "arguments": {"query": "customer interviews"}}],
+]
+
+def create_app(ttft: float = 0.3, tokens_per_second: float = 50, answer_tokens: int = 60, tool_script=None) -> FastAPI:
+    """Returns the stand-in API with the given timing and tool-call script"""
+    app = FastAPI()
+    script = itertools.cycle(tool_script or [[]])
+    stats = {'requests': 0, 'streamed': 0, 'tool_calls': 0}
+
+    def plan_response(body):
+        """Returns (tool calls, answer tokens) of the response to a request"""
+        messages = body.get('messages', [])
+        offered = {tool['function']['name'] for tool in body.get('tools', [])}
+        if messages and messages[-1].get('role') == 'user':
+            calls = [call for call in next(script) if call['name'] in offered]
+            if calls:
+                return [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": call['name'], "arguments": json.dumps(call.get('arguments', {}))}
+                } for call in calls], []
+        return [], [f"word{index} " for index in range(answer_tokens)]
+
+    def usage(body, completion_tokens):
+        prompt_chars = sum(len(str(message.get('content') or '')) for message in body.get('messages', []))
+        prompt_tokens = prompt_chars // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats['requests'] += 1
+        tool_calls, tokens = plan_response(body)
+        stats['tool_calls'] += len(tool_calls)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = body.get('model', 'fake')
+        finish_reason = 'tool_calls' if tool_calls else 'stop'
+        completion_tokens = len(tokens) or len(tool_calls) * 10
+
+        if not body.get('stream'):
+            await asyncio.sleep(ttft + len(tokens) / tokens_per_second)
+            message = {"role": "assistant", "content": ''.join(tokens) or None}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage(body, completion_tokens)
+            })
+
+        stats['streamed'] += 1
+        include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+
+        def chunk(delta, finish=None, choices=True, **extra):
+            return 'data: ' + json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if choices else [],
+                **extra
+            }) + '\n\n'
+
+        async def events():
+            await asyncio.sleep(ttft)
+            yield chunk({"role": "assistant", "content": ""})
+            for index, call in enumerate(tool_calls):
+                yield chunk({"tool_calls": [{"index": index, **call}]})
+            for token in tokens:
+                yield chunk({"content": token})
+                await asyncio.sleep(1 / tokens_per_second)
+            yield chunk({}, finish_reason)
+            if include_usage:
+                yield chunk({}, choices=False, usage=usage(body, completion_tokens))
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--ttft', type=float, default=0.3, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=60, help='tokens per answer')
+    parser.add_argument('--tool-script', help='JSON file of the tool calls per turn, see the module docstring')
+    parser.add_argument('--default-tool-script', action='store_true', help='use the built-in script calling each tool in turn')
+    args = parser.parse_args()
+
+    tool_script = DEFAULT_TOOL_SCRIPT if args.default_tool_script else None
+    if args.tool_script:
+        with open(args.tool_script, encoding='utf-8') as f:
+            tool_script = json.load(f)
+    uvicorn.run(create_app(args.ttft, args.tokens_per_second, args.answer_tokens, tool_script),
+                host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,113 @@
+"""
+Event loop responsiveness under concurrent /api/chat requests
+
+Sends N concurrent chats to the API (served in-process against a fake chat
+model with a fixed latency) and measures GET /api/users latency before and
+while the chats are in flight. With a non-blocking chat path the p99 of GET
+/api/users stays flat; a blocking agent call would add the whole LLM latency
+to it.
+
+The API runs one turn per conversation at a time, so each chat is sent by its
+own user, copied from the stored personas if needed. Chats beyond
+CHAT_CONCURRENCY_LIMIT wait in the admission queue of the API.
+
+Usage (from the repository root):
+    python benchmarks/load_chat_concurrency.py [--chats 50] [--llm-latency 1.0] [--check]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.app_env import prepare_app_env  # noqa: E402
+
+prepare_app_env()
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+from benchmarks.benchmark_users import add_benchmark_users  # noqa: E402
+from benchmarks.fake_chat_model import install_fake_chat_model  # noqa: E402
+
+MAX_P99_MS = 50  # Allowed p99 of GET /api/users while chats are in flight (--check)
+
+def percentile(values, fraction):
+    """Returns the given percentile (0-1) of a list of values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def probe_users(client, stop_event, interval):
+    """Requests GET /api/users until stop_event is set, returns latencies in ms"""
+    latencies = []
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        response = await client.get('/api/users')
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(interval)
+    return latencies
+
+async def run_chats(client, user_ids, chats):
+    """Sends concurrent chat requests, one per user, returns their latencies in ms"""
+    async def chat(index):
+        start = time.perf_counter()
+        response = await client.post('/api/chat', json={
+            'user_id': user_ids[index],
+            'message': f'Benchmark question {index}'
+        })
+        response.raise_for_status()
+        return (time.perf_counter() - start) * 1000
+
+    return await asyncio.gather(*(chat(index) for index in range(chats)))
+
+def describe(name, latencies):
+    print(f'{name:<28} n={len(latencies):<5} p50={statistics.median(latencies):8.1f} ms'
+          f'  p99={percentile(latencies, 0.99):8.1f} ms  max={max(latencies):8.1f} ms')
+
+async def main(args):
+    install_fake_chat_model(app, latency=args.llm_latency)
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as client:
+        user_ids = add_benchmark_users(app, args.chats)
+
+        # Baseline without chats in flight
+        stop_event = asyncio.Event()
+        probe = asyncio.create_task(probe_users(client, stop_event, args.probe_interval))
+        await asyncio.sleep(args.llm_latency)
+        stop_event.set()
+        idle_latencies = await probe
+
+        # Same probe while the chats are running
+        stop_event = asyncio.Event()
+        probe = asyncio.create_task(probe_users(client, stop_event, args.probe_interval))
+        start = time.perf_counter()
+        chat_latencies = await run_chats(client, user_ids, args.chats)
+        elapsed = time.perf_counter() - start
+        stop_event.set()
+        loaded_latencies = await probe
+
+    print(f'{args.chats} chats, LLM latency {args.llm_latency}s, '
+          f'concurrency limit {app.CHAT_CONCURRENCY_LIMIT}, queue limit {app.CHAT_QUEUE_LIMIT}')
+    describe('GET /api/users (idle)', idle_latencies)
+    describe('GET /api/users (chats)', loaded_latencies)
+    describe('POST /api/chat', chat_latencies)
+    print(f'chat throughput: {args.chats / elapsed:.1f} chats/s')
+
+    if args.check and percentile(loaded_latencies, 0.99) > MAX_P99_MS:
+        print(f'FAILED: p99 of GET /api/users exceeds {MAX_P99_MS} ms while chats are in flight')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Event loop responsiveness under concurrent chats')
+    parser.add_argument('--chats', type=int, default=50, help='number of concurrent chat requests, each from its own user')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='fake LLM response time in seconds')
+    parser.add_argument('--probe-interval', type=float, default=0.01, help='seconds between GET /api/users probes')
+    parser.add_argument('--check', action='store_true', help=f'exit with an error if p99 exceeds {MAX_P99_MS} ms')
+    asyncio.run(main(parser.parse_args()))
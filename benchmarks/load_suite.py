@@ -0,0 +1,351 @@
+"""
+Load-test suite of the API against a local fake LLM
+
+Starts benchmarks/fake_openai_server.py and `uvicorn app:app` as separate
+processes. The app is pointed at the fake server and uses the fixture search
+backend, with its databases in a temp directory. Each scenario is then driven
+by --concurrency simulated students, each looping requests for --duration
+seconds:
+- sse_chat: GET /api/chat/stream until the done event, also measures time to first token
+- chat: POST /api/chat
+- structured_plan: GET /api/learning-plan/{user}/{phase}/structured
+- pdf: GET /api/download-pdf/{user}/{phase}
+- milestones: POST /api/update-milestones
+- mixed: a weighted mix of the above, see MIXED_WEIGHTS
+
+Requests rejected with 429 are counted separately and the student waits for
+Retry-After before its next request. Per scenario it reports throughput,
+p50/p95/p99 latency, rejections, errors and the RSS
+of the app processes (peak while the scenario ran, read from /proc, so Linux
+only). --output writes the results as JSON; --compare diffs a run against
+such a baseline and exits with status 1 if a metric regressed by more than
+--max-regression.
+
+Usage (from the repository root):
+    python benchmarks/load_suite.py [--scenarios sse_chat,mixed] [--concurrency 20] [--duration 20]
+        [--ttft 0.3] [--tokens-per-second 50] [--workers 1] [--output baseline.json] [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('sse_chat', 'chat', 'structured_plan', 'pdf', 'milestones', 'mixed')
+MIXED_WEIGHTS = {'sse_chat': 3, 'chat': 1, 'structured_plan': 3, 'pdf': 1, 'milestones': 2}
+# Metrics checked by --compare, True if higher is better
+COMPARED_METRICS = {
+    'throughput_rps': True,
+    'latency_p50_ms': False,
+    'latency_p95_ms': False,
+    'latency_p99_ms': False,
+    'ttft_p95_ms': False,
+    'rss_peak_mb': False,
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentile(values, fraction):
+    """Returns the given percentile (0-1) of a list of values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def process_tree_rss(pid: int) -> float:
+    """Returns the RSS in MB of a process and its children, e.g. the uvicorn workers"""
+    total_kb = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                total_kb += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total_kb / 1024
+
+async def sample_rss(pid: int, samples: list, interval: float = 0.2):
+    while True:
+        samples.append(process_tree_rss(pid))
+        await asyncio.sleep(interval)
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 120):
+    """Waits until GET url answers, fails if the process exits first"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'{process.args} exited with status {process.returncode}')
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'{url} not ready after {timeout} s')
+
+class Workload:
+    """The requests of the scenarios, with the users and plans the app has data for"""
+
+    def __init__(self, client: httpx.AsyncClient, users: dict, pdfs: list, phase: int):
+        self.client = client
+        self.users = users  # user_id -> number of milestones
+        self.pdfs = pdfs  # (user_id, phase) with a PDF
+        self.phase = phase
+        self.counter = 0
+
+    def user(self) -> str:
+        return random.choice(list(self.users))
+
+    def question(self) -> str:
+        self.counter += 1
+        return f'Load test question {self.counter}: what should I do next?'
+
+    async def sse_chat(self, result):
+        start = time.perf_counter()
+        params = {'user_id': self.user(), 'message': self.question()}
+        async with self.client.stream('GET', '/api/chat/stream', params=params) as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith('event: '):
+                    event = line[7:]
+                    if event == 'token' and 'ttft' not in result:
+                        result['ttft'] = (time.perf_counter() - start) * 1000
+                    elif event == 'done':
+                        break
+                elif line.startswith('data: ') and event == 'error':
+                    raise RuntimeError(f'error event {line[6:]}')
+
+    async def chat(self, result):
+        response = await self.client.post('/api/chat', json={'user_id': self.user(), 'message': self.question()})
+        response.raise_for_status()
+
+    async def structured_plan(self, result):
+        response = await self.client.get(f'/api/learning-plan/{self.user()}/{random.choice((1, 2))}/structured')
+        response.raise_for_status()
+
+    async def pdf(self, result):
+        user_id, phase = random.choice(self.pdfs)
+        response = await self.client.get(f'/api/download-pdf/{user_id}/{phase}')
+        response.raise_for_status()
+
+    async def milestones(self, result):
+        user_id = self.user()
+        states = [random.random() < 0.5 for _ in range(self.users[user_id])]
+        response = await self.client.post('/api/update-milestones', json={'user_id': user_id, 'milestones': states})
+        response.raise_for_status()
+
+    async def mixed(self, result):
+        names = [name for name in MIXED_WEIGHTS if name != 'pdf' or self.pdfs]
+        name = random.choices(names, weights=[MIXED_WEIGHTS[name] for name in names])[0]
+        await getattr(self, name)(result)
+
+async def discover(client: httpx.AsyncClient):
+    """Returns the users with their number of milestones, the available PDFs and the current phase"""
+    user_ids = (await client.get('/api/users')).json()['users']
+    users = {}
+    for user_id in user_ids:
+        data = (await client.get(f'/api/user/{user_id}')).json()
+        users[user_id] = len(data.get('milestones') or [])
+    pdfs = [(user_id, phase) for user_id in user_ids for phase in (1, 2)
+            if (await client.head(f'/api/download-pdf/{user_id}/{phase}')).status_code == 200]
+    phase = (await client.get('/api/phase')).json()['phase']
+    return users, pdfs, phase
+
+async def run_scenario(workload: Workload, name: str, concurrency: int, duration: float, app_pid: int) -> dict:
+    """Runs one scenario in a closed loop, returns its results"""
+    operation = getattr(workload, name)
+    latencies, ttfts, errors, rejected = [], [], [], []
+    rss_samples = []
+    deadline = time.perf_counter() + duration
+
+    async def student():
+        while time.perf_counter() < deadline:
+            result = {}
+            start = time.perf_counter()
+            try:
+                await operation(result)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 429:
+                    errors.append(f'{type(e).__name__}: {e}')
+                    continue
+                rejected.append(e.response.headers.get('retry-after'))
+                await asyncio.sleep(min(float(e.response.headers.get('retry-after') or 1),
+                                        max(0.0, deadline - time.perf_counter())))
+                continue
+            except Exception as e:
+                errors.append(f'{type(e).__name__}: {e}')
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+            if 'ttft' in result:
+                ttfts.append(result['ttft'])
+
+    sampler = asyncio.create_task(sample_rss(app_pid, rss_samples))
+    start = time.perf_counter()
+    await asyncio.gather(*(student() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    rss_samples.append(process_tree_rss(app_pid))
+
+    results = {
+        'requests': len(latencies),
+        'rejected': len(rejected),
+        'errors': len(errors),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'rss_peak_mb': round(max(rss_samples), 1),
+        'rss_end_mb': round(rss_samples[-1], 1),
+    }
+    for key, values in (('latency', latencies), ('ttft', ttfts)):
+        if values:
+            for p in (50, 95, 99):
+                results[f'{key}_p{p}_ms'] = round(percentile(values, p / 100), 1)
+    if errors:
+        results['first_error'] = errors[0]
+    return results
+
+def print_results(name: str, results: dict):
+    ttft = f"{results['ttft_p50_ms']:>8.0f}{results['ttft_p95_ms']:>8.0f}" if 'ttft_p50_ms' in results else f"{'':>8}{'':>8}"
+    latency = ''.join(f"{results.get(f'latency_p{p}_ms', 0):>8.0f}" for p in (50, 95, 99))
+    print(f"{name:<16}{results['requests']:>8}{results['rejected']:>6}{results['errors']:>7}{results['throughput_rps']:>9.1f}"
+          f"{latency}{ttft}{results['rss_peak_mb']:>9.0f}")
+    if 'first_error' in results:
+        print(f"{'':<16}first error: {results['first_error']}")
+
+def compare(baseline: dict, current: dict, max_regression: float) -> list:
+    """Prints the change of the compared metrics, returns the regressions beyond max_regression"""
+    regressions = []
+    print(f"\nCompared with the baseline of {baseline['meta']['date']} ({baseline['meta'].get('commit') or 'unknown commit'})")
+    print(f"{'scenario':<16}{'metric':<18}{'baseline':>10}{'current':>10}{'change':>9}")
+    for name, results in current['scenarios'].items():
+        old_results = baseline['scenarios'].get(name)
+        if old_results is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in results or not old_results.get(metric):
+                continue
+            change = results[metric] / old_results[metric] - 1
+            regressed = (-change if higher_is_better else change) > max_regression
+            if regressed:
+                regressions.append(f'{name} {metric}')
+            print(f"{name:<16}{metric:<18}{old_results[metric]:>10.1f}{results[metric]:>10.1f}{change:>+8.0%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def drive(args, app_url: str, app_pid: int) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency + 10, max_keepalive_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=app_url, timeout=120, limits=limits) as client:
+        users, pdfs, phase = await discover(client)
+        workload = Workload(client, users, pdfs, phase)
+        print(f'{len(users)} users, {len(pdfs)} PDFs, phase {phase}, concurrency {args.concurrency}, '
+              f'{args.duration:g} s per scenario, TTFT {args.ttft:g} s, {args.tokens_per_second:g} tokens/s')
+        print(f"{'scenario':<16}{'ok':>8}{'429':>6}{'errors':>7}{'req/s':>9}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}"
+              f"{'ttft50':>8}{'ttft95':>8}{'RSS MB':>9}")
+        scenarios = {}
+        for name in args.scenarios.split(','):
+            if name == 'pdf' and not pdfs:
+                print(f'{name:<16}skipped, no PDFs')
+                continue
+            scenarios[name] = await run_scenario(workload, name, args.concurrency, args.duration, app_pid)
+            print_results(name, scenarios[name])
+    return scenarios
+
+def main(args):
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'Unknown scenarios {sorted(unknown)}, choose from {SCENARIOS}')
+
+    llm_port, app_port = free_port(), free_port()
+    llm_command = [sys.executable, os.path.join(ROOT_DIR, 'benchmarks', 'fake_openai_server.py'),
+                   '--port', str(llm_port), '--ttft', str(args.ttft),
+                   '--tokens-per-second', str(args.tokens_per_second), '--answer-tokens', str(args.answer_tokens)]
+    if args.tool_script:
+        llm_command += ['--tool-script', args.tool_script]
+    elif not args.no_tools:
+        llm_command.append('--default-tool-script')
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ,
+                   OPENAI_API_KEY='benchmark',
+                   TAVILY_API_KEY='benchmark',
+                   OPENAI_BASE_URL=f'http://127.0.0.1:{llm_port}/v1',
+                   OPENAI_API_BASE=f'http://127.0.0.1:{llm_port}/v1',
+                   SEARCH_BACKEND='fixture',
+                   SEARCH_FIXTURE_FILE=os.path.join(ROOT_DIR, 'benchmarks', 'search_fixtures.json'),
+                   CONVERSATION_DB_FILE=os.path.join(directory, 'conversations.sqlite'),
+                   STATE_DB_FILE=os.path.join(directory, 'state.sqlite'),
+                   SEARCH_CACHE_DB_FILE=os.path.join(directory, 'search_cache.sqlite'))
+        app_command = [sys.executable, '-m', 'uvicorn', 'app:app', '--host', '127.0.0.1', '--port', str(app_port),
+                       '--workers', str(args.workers), '--log-level', 'warning', '--no-access-log']
+        log = open(os.path.join(directory, 'app.log'), 'w')
+        llm_server = subprocess.Popen(llm_command, cwd=ROOT_DIR)
+        app_server = subprocess.Popen(app_command, cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_until_ready(f'http://127.0.0.1:{llm_port}/stats', llm_server)
+            wait_until_ready(f'http://127.0.0.1:{app_port}/api/phase', app_server)
+            scenarios = asyncio.run(drive(args, f'http://127.0.0.1:{app_port}', app_server.pid))
+        finally:
+            for process in (app_server, llm_server):
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            log.close()
+
+    current = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        },
+        'scenarios': scenarios
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f'\nResults written to {args.output}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(json.load(f), current, args.max_regression)
+        if regressions:
+            print(f"\n{len(regressions)} regressions beyond {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test suite of the API against a local fake LLM')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated, from ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=20, help='simulated students per scenario')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per scenario')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers of the app')
+    parser.add_argument('--ttft', type=float, default=0.3, help='seconds to the first token of the fake model')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=60)
+    parser.add_argument('--tool-script', help='tool calls per turn for the fake model, see fake_openai_server.py')
+    parser.add_argument('--no-tools', action='store_true', help='the fake model never calls tools')
+    parser.add_argument('--output', help='write the results as JSON, e.g. as the baseline of a release')
+    parser.add_argument('--compare', help='baseline JSON to compare the results with')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='allowed relative change for --compare')
+    main(parser.parse_args())
@@ -24,5 +24,9 @@ fi
 # Set environment variable to flag we're running in Rahti
 export DEPLOYMENT_ENV=${DEPLOYMENT_ENV:-rahti}
 
+# Number of uvicorn worker processes, e.g. the CPU cores of the pod. The workers
+# share conversations, learning states and settings through the SQLite files in user_data
+WEB_CONCURRENCY=${WEB_CONCURRENCY:-1}
+
 # Start the application
-exec uvicorn app:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+exec uvicorn app:app --host 0.0.0.0 --port 8000 --workers "$WEB_CONCURRENCY"
\ No newline at end of file
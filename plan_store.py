@@ -0,0 +1,339 @@
+"""
+Study plan store: a metadata index with a memory-mapped blob file
+
+The study plans used to be a single pickle that every worker loads completely,
+including each user's two PDFs. The store splits the data into two files:
+
+    <base>.index.json     small fields of each user inline, large ones as blob references
+    <base>.<token>.blobs  append-only file of PDFs, long texts and other large values
+
+Values are normalized to plain Python types on conversion, e.g. the pandas
+Series of survey answers is stored as a dict. Only the index is read at
+startup. The blob file is memory-mapped, so the operating system pages in (and
+shares between workers) only the blobs that are used. PDFs are returned as
+zero-copy memoryview slices of the map, long texts are decoded on access.
+
+Each conversion writes a new blob file and then atomically replaces the index
+naming it, so a store can be converted again while workers are reading it.
+Replaced stores are closed, and old blob files are deleted once no worker has
+them open (on Windows, open files cannot be deleted and are retried on the
+next conversion).
+
+Convert the pickle with:
+    python plan_store.py learning_plans/study_plans_data.pickle learning_plans/study_plans
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import threading
+import time
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows, conversions are not serialized between processes
+    fcntl = None
+
+INLINE_LIMIT = 512  # Values encoding to more bytes than this go to the blob file
+FORMAT_VERSION = 3  # Stores of an older version are converted again from the pickle
+
+class UserRecord(MutableMapping):
+    """
+    Data of one user, blob values are read from the store on access.
+
+    Values assigned to the record (e.g. by the GUI) are kept in memory only.
+    """
+
+    def __init__(self, store: 'PlanStore', entry: Dict):
+        self._store = store
+        self._inline = entry['inline']
+        self._blobs = entry['blobs']
+        self._local = {}
+
+    def __getitem__(self, key):
+        if key in self._local:
+            return self._local[key]
+        if key in self._inline:
+            return self._inline[key]
+        if key in self._blobs:
+            return self._store.read_blob(*self._blobs[key])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        for values in (self._local, self._inline, self._blobs):
+            values.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._local or key in self._inline or key in self._blobs
+
+    def __iter__(self) -> Iterator:
+        yield from self._local
+        yield from (key for key in self._inline if key not in self._local)
+        yield from (key for key in self._blobs if key not in self._local and key not in self._inline)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def blob_size(self, key) -> int:
+        """Returns the stored size of a blob field without reading it"""
+        return self._blobs[key][2]
+
+class PlanStore(Mapping):
+    """Read access to a converted study plan store, a mapping of user_id -> UserRecord"""
+
+    def __init__(self, base_path: str):
+        self.index_path = base_path + '.index.json'
+        for attempt in range(3):
+            modified = os.path.getmtime(self.index_path)
+            with open(self.index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            self.blob_path = os.path.join(os.path.dirname(self.index_path),
+                                          index.get('blob_file', os.path.basename(base_path) + '.blobs'))
+            try:
+                self._file = open(self.blob_path, 'rb')
+                break
+            except FileNotFoundError:
+                # The store was converted again between reading the index and opening its blob file
+                if attempt == 2:
+                    raise
+        self._index = index['users']
+        self.version = index.get('version', 1)
+        self.source_hash = index.get('source_hash')  # SHA-256 of the pickle the store was converted from
+        self.modified = modified  # Last-Modified time of the stored data
+        self._records = {}
+        self._map = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, user_id) -> UserRecord:
+        if user_id not in self._records:
+            self._records[user_id] = UserRecord(self, self._index[user_id])
+        return self._records[user_id]
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._index
+
+    def __iter__(self) -> Iterator:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def changed_users(self, other: 'PlanStore') -> Set[str]:
+        """Returns the users added, removed or changed in other compared to this store"""
+        return {user_id for user_id in self._index.keys() | other._index.keys()
+                if self._index.get(user_id, {}).get('hash') is None
+                or self._index.get(user_id, {}).get('hash') != other._index.get(user_id, {}).get('hash')}
+
+    def content_hash(self, user_id) -> Optional[str]:
+        """Returns a hash of the user's data, the hash of the whole source for stores without per-user hashes"""
+        return self._index.get(user_id, {}).get('hash') or self.source_hash
+
+    def close(self):
+        """Closes the blob file and its map, e.g. when the store was replaced by a newer one"""
+        with self._lock:
+            if self._map is not None and not isinstance(self._map, bytes):
+                try:
+                    self._map.close()
+                except BufferError:
+                    pass  # Views of a PDF are still in use, the map is freed when they are released
+            self._map = None
+            self._file.close()
+
+    def read_blob(self, kind: str, offset: int, length: int) -> Any:
+        """Returns a blob value, bytes blobs as zero-copy memoryviews of the blob file"""
+        if self._file.closed:
+            raise ValueError(f'{self.index_path} store is closed')
+        if self._map is None or offset + length > len(self._map):
+            self._remap()
+        view = memoryview(self._map)[offset:offset + length]
+        if kind == 'bytes':
+            return view
+        if kind == 'text':
+            return str(view, 'utf-8')
+        if kind == 'json':
+            return json.loads(str(view, 'utf-8'))
+        return pickle.loads(view)
+
+    def _remap(self):
+        with self._lock:
+            size = os.fstat(self._file.fileno()).st_size
+            if self._map is None or size > len(self._map):
+                # Slices of an older map keep it alive until they are released
+                self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else b''
+
+def normalize_value(value):
+    """
+    Converts a value of the plan generator to plain Python types: pandas Series
+    and dicts to dicts with string keys, tuples to lists, numpy scalars to
+    Python scalars and NaN to None. Bytes are returned unchanged.
+    """
+    if isinstance(value, (str, bytes, bytearray, memoryview, bool, int)) or value is None:
+        return value
+    if isinstance(value, float):
+        return None if value != value else value
+    if hasattr(value, 'to_dict'):  # pandas Series
+        value = value.to_dict()
+    if isinstance(value, Mapping):
+        return {str(key): normalize_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if hasattr(value, 'item'):  # numpy scalar
+        return normalize_value(value.item())
+    return value
+
+def encode_value(value) -> tuple:
+    """Returns (kind, payload) for a blob value, or (None, value) for a value kept inline"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return 'bytes', bytes(value)
+    if isinstance(value, str):
+        payload = value.encode('utf-8')
+        return (None, value) if len(payload) <= INLINE_LIMIT else ('text', payload)
+    try:
+        payload = json.dumps(value).encode('utf-8')
+    except (TypeError, ValueError):
+        return 'pickle', pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return (None, value) if len(payload) <= INLINE_LIMIT else ('json', payload)
+
+def append_users(base_path: str, users: Dict[str, Dict], blob_file: Optional[str] = None,
+                 source_hash: Optional[str] = None):
+    """
+    Appends users to a store, creating it if needed. Existing users are replaced.
+
+    Blobs are appended to the blob file, and then the index is replaced
+    atomically, so readers never see references to missing data. Each user
+    entry gets a hash of its content for finding changed users on reload.
+    """
+    index_path = base_path + '.index.json'
+    index = {'version': FORMAT_VERSION, 'blob_file': blob_file or os.path.basename(base_path) + '.blobs', 'users': {}}
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version', 1) != FORMAT_VERSION:
+            raise ValueError(f'{index_path} has format version {index.get("version", 1)}, convert the store again')
+    if source_hash:
+        index['source_hash'] = source_hash
+    blob_path = os.path.join(os.path.dirname(index_path), index['blob_file'])
+
+    with open(blob_path, 'ab') as blobs:
+        offset = blobs.tell()
+        for user_id, record in users.items():
+            entry = {'inline': {}, 'blobs': {}}
+            digests = []
+            for key, value in record.items():
+                kind, payload = encode_value(normalize_value(value))
+                if kind is None:
+                    entry['inline'][key] = payload
+                    payload = json.dumps(payload, sort_keys=True).encode('utf-8')
+                else:
+                    blobs.write(payload)
+                    entry['blobs'][key] = [kind, offset, len(payload)]
+                    offset += len(payload)
+                digests.append((str(key), kind or 'inline', hashlib.sha256(payload).hexdigest()))
+            entry['hash'] = hashlib.sha256(json.dumps(sorted(digests)).encode('utf-8')).hexdigest()[:32]
+            index['users'][user_id] = entry
+        blobs.flush()
+        os.fsync(blobs.fileno())
+
+    temp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(temp_path, index_path)
+
+@contextmanager
+def conversion_lock(base_path: str):
+    """Serializes conversions of a store between processes, e.g. several uvicorn workers"""
+    with open(base_path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def convert_pickle(pickle_path: str, base_path: str) -> int:
+    """Builds a new store from a study plans pickle, returns the number of users"""
+    with conversion_lock(base_path):
+        return _convert_pickle(pickle_path, base_path)
+
+def _convert_pickle(pickle_path: str, base_path: str, data: Optional[bytes] = None) -> int:
+    if data is None:
+        with open(pickle_path, 'rb') as f:
+            data = f.read()
+    user_datasets = pickle.loads(data)
+
+    # Each conversion writes a new blob file, and the index that refers to it
+    # is replaced atomically, so running readers keep using the old store
+    directory, name = os.path.split(base_path)
+    blob_file = f'{name}.{time.time_ns():x}.blobs'
+    temp_base = f'{base_path}.{os.getpid()}.new'
+    if os.path.exists(temp_base + '.index.json'):
+        os.remove(temp_base + '.index.json')
+    append_users(temp_base, user_datasets, blob_file=blob_file, source_hash=hashlib.sha256(data).hexdigest())
+    os.replace(temp_base + '.index.json', base_path + '.index.json')
+
+    # Open readers keep their blob file until they close it. Windows refuses to
+    # delete open files, those are deleted by a later conversion.
+    for old_file in os.listdir(directory or '.'):
+        if old_file.startswith(name + '.') and old_file.endswith('.blobs') and old_file != blob_file:
+            try:
+                os.remove(os.path.join(directory, old_file))
+            except OSError as e:
+                print(f'Could not delete old plan store blobs {old_file}: {e}')
+    return len(user_datasets)
+
+def refresh_plan_store(base_path: str, pickle_path: str) -> bool:
+    """
+    Converts the pickle to the store unless the store was already converted
+    from the same content, e.g. by another worker. Returns True if it converted.
+    """
+    with conversion_lock(base_path):
+        with open(pickle_path, 'rb') as f:
+            data = f.read()
+        index_path = base_path + '.index.json'
+        if os.path.exists(index_path):
+            store = PlanStore(base_path)
+            store.close()
+            if store.version == FORMAT_VERSION and store.source_hash == hashlib.sha256(data).hexdigest():
+                return False
+        _convert_pickle(pickle_path, base_path, data)
+        return True
+
+def open_plan_store(base_path: str, pickle_path: str = None) -> PlanStore:
+    """
+    Opens a store, converting it from pickle_path first if it is missing,
+    older than the pickle or of an older format version
+    """
+    index_path = base_path + '.index.json'
+    store = None
+    if os.path.exists(index_path):
+        store = PlanStore(base_path)
+    if pickle_path and os.path.exists(pickle_path) and (
+            store is None or store.version != FORMAT_VERSION or store.modified < os.path.getmtime(pickle_path)):
+        print(f'Converting {pickle_path} to a plan store...', end='')
+        if store is not None:
+            store.close()
+        converted = refresh_plan_store(base_path, pickle_path)
+        print(' done' if converted else ' already up to date')
+        store = PlanStore(base_path)
+    if store is None:
+        raise FileNotFoundError(index_path)
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a study plans pickle to a plan store')
+    parser.add_argument('pickle_path', help='e.g. learning_plans/study_plans_data.pickle')
+    parser.add_argument('base_path', help='store path without suffix, e.g. learning_plans/study_plans')
+    args = parser.parse_args()
+    print(f'{convert_pickle(args.pickle_path, args.base_path)} users converted to {args.base_path}.index.json')
@@ -0,0 +1,493 @@
+"""
+SQLite checkpointer for the LangGraph agents
+
+Stores conversation checkpoints in a local SQLite database in WAL mode, so
+conversations survive restarts and several uvicorn workers (or the API and the
+Gradio GUI) on the same host share them. Like LangGraph's own savers, channel
+values are stored once per channel version in the blobs table, and checkpoints
+refer to the versions they contain. A step that changes one channel does not
+copy the others, e.g. the message history is not stored again for steps that
+only update the summary. Blobs no longer referenced by any checkpoint are
+deleted with the checkpoints, so compaction can drop all but the latest
+checkpoints of a thread without breaking it.
+
+Compaction runs in a background thread for the threads written since the last
+pass. It keeps the latest keep_latest checkpoints per thread and then enforces
+max_user_bytes per user, counting checkpoints and their blobs, by dropping the
+oldest checkpoints and conversations.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+import tracing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    user_id TEXT NOT NULL,
+    checkpoint_type TEXT NOT NULL,
+    checkpoint BLOB NOT NULL,
+    metadata_type TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE INDEX IF NOT EXISTS checkpoints_user ON checkpoints (user_id, checkpoint_id);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    value_type TEXT NOT NULL,
+    value BLOB NOT NULL,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    value_type TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS checkpoint_blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, channel)
+);
+CREATE INDEX IF NOT EXISTS checkpoint_blobs_version ON checkpoint_blobs (thread_id, checkpoint_ns, channel, version);
+"""
+
+class SqliteCheckpointer(BaseCheckpointSaver):
+    """
+    LangGraph checkpointer backed by a SQLite database in WAL mode.
+
+    Args:
+        path: Database file, created if missing
+        keep_latest: Checkpoints kept per conversation thread by compaction
+        max_user_bytes: Max. stored checkpoint bytes per user, None for no limit
+
+    The user of a checkpoint is taken from config["configurable"]["user_id"]
+    and defaults to the thread id.
+    """
+
+    def __init__(self, path: str, keep_latest: int = 5, max_user_bytes: Optional[int] = None, *, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.keep_latest = max(1, keep_latest)
+        self.max_user_bytes = max_user_bytes
+        self.compacted_checkpoints = 0
+        self._dirty_threads = set()
+        self._lock = threading.Lock()
+        self._compactor = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    # --- Reading ---
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Returns the checkpoint given by the config, or the latest checkpoint of the thread"""
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+
+        query = ('SELECT checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata '
+                 'FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?')
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id:
+            query += ' AND checkpoint_id = ?'
+            params.append(checkpoint_id)
+        else:
+            query += ' ORDER BY checkpoint_id DESC LIMIT 1'
+
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+            if row is None:
+                return None
+            writes = self._load_writes(thread_id, checkpoint_ns, row[0])
+            blobs = self._load_blobs(thread_id, checkpoint_ns, row[0])
+        return self._make_tuple(thread_id, checkpoint_ns, row, writes, blobs)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """Yields matching checkpoints, newest first"""
+        query = ('SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, '
+                 'checkpoint_type, checkpoint, metadata_type, metadata FROM checkpoints WHERE 1 = 1')
+        params = []
+        if config:
+            configurable = config["configurable"]
+            query += ' AND thread_id = ?'
+            params.append(configurable["thread_id"])
+            if configurable.get("checkpoint_ns") is not None:
+                query += ' AND checkpoint_ns = ?'
+                params.append(configurable["checkpoint_ns"])
+            if get_checkpoint_id(config):
+                query += ' AND checkpoint_id = ?'
+                params.append(get_checkpoint_id(config))
+        if before and get_checkpoint_id(before):
+            query += ' AND checkpoint_id < ?'
+            params.append(get_checkpoint_id(before))
+        query += ' ORDER BY thread_id, checkpoint_ns, checkpoint_id DESC'
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            metadata = self.serde.loads_typed((row[4], row[5]))
+            if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            with self._lock:
+                writes = self._load_writes(thread_id, checkpoint_ns, row[0])
+                blobs = self._load_blobs(thread_id, checkpoint_ns, row[0])
+            yield self._make_tuple(thread_id, checkpoint_ns, row, writes, blobs)
+
+    def _load_writes(self, thread_id, checkpoint_ns, checkpoint_id):
+        return self._conn.execute(
+            'SELECT task_id, channel, value_type, value FROM writes '
+            'WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? '
+            'ORDER BY task_path, task_id, idx',
+            (thread_id, checkpoint_ns, checkpoint_id)
+        ).fetchall()
+
+    def _load_blobs(self, thread_id, checkpoint_ns, checkpoint_id):
+        """Returns the stored channel values of a checkpoint, empty channels are skipped"""
+        return self._conn.execute(
+            'SELECT b.channel, b.value_type, b.value FROM checkpoint_blobs l JOIN blobs b '
+            'ON b.thread_id = l.thread_id AND b.checkpoint_ns = l.checkpoint_ns '
+            'AND b.channel = l.channel AND b.version = l.version '
+            'WHERE l.thread_id = ? AND l.checkpoint_ns = ? AND l.checkpoint_id = ? AND b.value_type != ?',
+            (thread_id, checkpoint_ns, checkpoint_id, 'empty')
+        ).fetchall()
+
+    def _make_tuple(self, thread_id, checkpoint_ns, row, writes, blobs) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata = row
+        checkpoint = self.serde.loads_typed((checkpoint_type, checkpoint))
+        # Checkpoints written before the blobs table carry their values inline
+        checkpoint["channel_values"] = {
+            **checkpoint.get("channel_values", {}),
+            **{channel: self.serde.loads_typed((value_type, value)) for channel, value_type, value in blobs}
+        }
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id
+            }},
+            checkpoint=checkpoint,
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=({"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id
+            }} if parent_checkpoint_id else None),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((value_type, value)))
+                            for task_id, channel, value_type, value in writes]
+        )
+
+    # --- Writing ---
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """Stores a checkpoint, and the values of the channels with a new version as blobs"""
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        versions = {channel: str(version) for channel, version in checkpoint["channel_versions"].items()}
+        checkpoint_type, checkpoint_blob = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+
+        def blob_row(channel, version):
+            value_type, value = self.serde.dumps_typed(values[channel]) if channel in values else ('empty', b'')
+            return thread_id, checkpoint_ns, channel, str(version), value_type, value
+
+        blob_rows = [blob_row(channel, version) for channel, version in new_versions.items()]
+        link_rows = [(thread_id, checkpoint_ns, checkpoint["id"], channel, version) for channel, version in versions.items()]
+
+        with self._lock:
+            # Unchanged channels of threads written before the blobs table have no blob yet
+            for channel, version in versions.items():
+                if channel not in new_versions and channel in values and self._conn.execute(
+                        'SELECT 1 FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?',
+                        (thread_id, checkpoint_ns, channel, version)).fetchone() is None:
+                    blob_rows.append(blob_row(channel, version))
+
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?, ?)', blob_rows)
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (thread_id, checkpoint_ns, checkpoint["id"], configurable.get("checkpoint_id"),
+                     str(configurable.get("user_id", thread_id)), checkpoint_type, checkpoint_blob,
+                     metadata_type, metadata_blob, len(checkpoint_blob) + len(metadata_blob))
+                )
+                self._conn.executemany('INSERT OR REPLACE INTO checkpoint_blobs VALUES (?, ?, ?, ?, ?)', link_rows)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._dirty_threads.add(thread_id)
+
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"]
+        }}
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        """Stores the pending writes of a task for a checkpoint"""
+        configurable = config["configurable"]
+        special_rows, rows = [], []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, value_blob = self.serde.dumps_typed(value)
+            row = (configurable["thread_id"], configurable.get("checkpoint_ns", ""),
+                   configurable["checkpoint_id"], task_id, WRITES_IDX_MAP.get(channel, idx),
+                   channel, value_type, value_blob, task_path)
+            (special_rows if channel in WRITES_IDX_MAP else rows).append(row)
+
+        # Special writes (errors, interrupts) replace earlier ones, regular writes are stored once
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', special_rows)
+                self._conn.executemany('INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Deletes all checkpoints and writes of a thread"""
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for table in ('checkpoints', 'writes', 'checkpoint_blobs', 'blobs'):
+                    self._conn.execute(f'DELETE FROM {table} WHERE thread_id = ?', (thread_id,))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._dirty_threads.discard(thread_id)
+
+    def prune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        """Keeps only the latest checkpoint ("keep_latest") or deletes the threads ("delete")"""
+        for thread_id in thread_ids:
+            if strategy == "delete":
+                self.delete_thread(thread_id)
+            else:
+                with self._lock:
+                    self._conn.execute('BEGIN')
+                    try:
+                        self._trim_thread(thread_id, 1)
+                        self._conn.execute('COMMIT')
+                    except BaseException:
+                        self._conn.execute('ROLLBACK')
+                        raise
+
+    # --- Async versions, SQLite calls run in a worker thread ---
+    # Reads and writes are traced as spans of the current request, see tracing.py
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with tracing.span('checkpoint.get', thread_id=config["configurable"]["thread_id"]):
+            return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        tuples = await asyncio.to_thread(lambda: [*self.list(config, filter=filter, before=before, limit=limit)])
+        for checkpoint_tuple in tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> RunnableConfig:
+        with tracing.span('checkpoint.put', thread_id=config["configurable"]["thread_id"]):
+            return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path="") -> None:
+        with tracing.span('checkpoint.put_writes', thread_id=config["configurable"]["thread_id"], writes=len(writes)):
+            await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    async def aprune(self, thread_ids, *, strategy="keep_latest") -> None:
+        await asyncio.to_thread(self.prune, thread_ids, strategy=strategy)
+
+    # --- Compaction ---
+    def compact(self, thread_ids=None) -> int:
+        """
+        Compacts the given threads, by default the ones written since the last pass.
+
+        Returns:
+            Number of deleted checkpoints
+        """
+        with self._lock:
+            if thread_ids is None:
+                thread_ids, self._dirty_threads = self._dirty_threads, set()
+
+            self._conn.execute('BEGIN')
+            deleted = 0
+            users = set()
+            try:
+                for thread_id in thread_ids:
+                    deleted += self._trim_thread(thread_id, self.keep_latest)
+                    users.update(row[0] for row in self._conn.execute(
+                        'SELECT DISTINCT user_id FROM checkpoints WHERE thread_id = ?', (thread_id,)))
+                if self.max_user_bytes is not None:
+                    for user_id in users:
+                        deleted += self._enforce_user_cap(user_id)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        self.compacted_checkpoints += deleted
+        return deleted
+
+    def _trim_thread(self, thread_id, keep) -> int:
+        """Deletes all but the latest keep checkpoints of a thread, the caller holds the lock and a transaction"""
+        deleted = 0
+        for (checkpoint_ns,) in self._conn.execute(
+                'SELECT DISTINCT checkpoint_ns FROM checkpoints WHERE thread_id = ?', (thread_id,)).fetchall():
+            old_ids = [row[0] for row in self._conn.execute(
+                'SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? '
+                'ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?', (thread_id, checkpoint_ns, keep))]
+            deleted += self._delete_checkpoints(thread_id, checkpoint_ns, old_ids)
+        return deleted
+
+    def _user_bytes(self, user_id) -> int:
+        """Returns the stored bytes of a user's checkpoints and their blobs"""
+        return self._conn.execute(
+            'SELECT (SELECT COALESCE(SUM(size), 0) FROM checkpoints WHERE user_id = ?) + '
+            '(SELECT COALESCE(SUM(LENGTH(value)), 0) FROM blobs '
+            'WHERE thread_id IN (SELECT DISTINCT thread_id FROM checkpoints WHERE user_id = ?))',
+            (user_id, user_id)).fetchone()[0]
+
+    def _enforce_user_cap(self, user_id) -> int:
+        """Deletes the oldest checkpoints of a user until the stored size is under max_user_bytes"""
+        total = self._user_bytes(user_id)
+        if total <= self.max_user_bytes:
+            return 0
+        rows = self._conn.execute(
+            'SELECT thread_id, checkpoint_ns, checkpoint_id FROM checkpoints '
+            'WHERE user_id = ? ORDER BY checkpoint_id DESC', (user_id,)).fetchall()
+
+        # The latest checkpoint of the most recent thread is always kept, then
+        # the latest checkpoints of older threads, older checkpoints go first
+        latest = {}
+        for thread_id, checkpoint_ns, checkpoint_id in rows:
+            latest.setdefault((thread_id, checkpoint_ns), checkpoint_id)
+        newest_thread = rows[0][0]
+        candidates = sorted(rows, key=lambda row: (
+            latest[(row[0], row[1])] == row[2],  # older checkpoints before the latest ones
+            row[0] == newest_thread,
+            row[2]
+        ))
+
+        # Blobs shared with the remaining checkpoints stay, so the size is counted again
+        deleted = 0
+        for thread_id, checkpoint_ns, checkpoint_id in candidates:
+            if total <= self.max_user_bytes or (thread_id == newest_thread and checkpoint_id == latest[(thread_id, checkpoint_ns)]):
+                break
+            deleted += self._delete_checkpoints(thread_id, checkpoint_ns, [checkpoint_id])
+            total = self._user_bytes(user_id)
+
+        if total > self.max_user_bytes:
+            print(f"Conversation of {user_id} exceeds the size cap ({total} > {self.max_user_bytes} bytes)")
+        return deleted
+
+    def _delete_checkpoints(self, thread_id, checkpoint_ns, checkpoint_ids) -> int:
+        """Deletes checkpoints with their writes, and the blobs no remaining checkpoint refers to"""
+        for checkpoint_id in checkpoint_ids:
+            params = (thread_id, checkpoint_ns, checkpoint_id)
+            for table in ('checkpoints', 'writes', 'checkpoint_blobs'):
+                self._conn.execute(f'DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?', params)
+        if checkpoint_ids:
+            self._conn.execute(
+                'DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND NOT EXISTS ('
+                'SELECT 1 FROM checkpoint_blobs l WHERE l.thread_id = blobs.thread_id AND l.checkpoint_ns = blobs.checkpoint_ns '
+                'AND l.channel = blobs.channel AND l.version = blobs.version)', (thread_id, checkpoint_ns))
+        return len(checkpoint_ids)
+
+    def start_background_compaction(self, interval: float = 30):
+        """Starts a daemon thread compacting the written threads every interval seconds"""
+        if self._compactor is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except sqlite3.Error as e:
+                    print(f"Error compacting conversations: {e}")
+
+        self._compactor = threading.Thread(target=run, name='checkpoint-compaction', daemon=True)
+        self._compactor.start()
+
+    def stats(self) -> Dict:
+        """Returns the number of stored threads, checkpoints and bytes"""
+        with self._lock:
+            threads, checkpoints, size = self._conn.execute(
+                'SELECT COUNT(DISTINCT thread_id), COUNT(*), COALESCE(SUM(size), 0) FROM checkpoints').fetchone()
+            blobs, blob_size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM blobs').fetchone()
+        return {
+            "threads": threads,
+            "checkpoints": checkpoints,
+            "blobs": blobs,
+            "checkpoint_bytes": size + blob_size,
+            "compacted_checkpoints": self.compacted_checkpoints,
+            "database_bytes": sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+        }
@@ -0,0 +1,406 @@
+"""
+SQLite store for the users' milestone states and agent settings
+
+Both used to be one pickle file per user under user_data/<user_id>/, written
+with a temp file, an fsync and a rename on every save. The store keeps them in
+a single SQLite database in WAL mode shared by the workers (and the Gradio GUI),
+with one row per milestone and per user's agent settings, so admin-wide reads
+are a single query. Several users can be saved in one transaction with
+save_learning_states / save_many_agent_settings.
+
+Every save also records an invalidation event (kind, user_id) in the same
+transaction. With several workers (or the API and the GUI), each process reads
+the events of the others with read_events and drops its cached copies.
+
+LearningStateBuffer keeps the learning states in memory and writes the changed
+ones behind the requests, several updates of a user in one write.
+
+Existing pickle files are imported once with import_pickles, which is run
+automatically on the first start:
+    python state_store.py user_data user_data/state.sqlite
+"""
+
+import argparse
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS milestones (
+    user_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS agent_settings (
+    user_id TEXT PRIMARY KEY,
+    system_prompt TEXT NOT NULL,
+    temperature REAL NOT NULL,
+    use_plan_tool INTEGER NOT NULL,
+    use_search_tool INTEGER NOT NULL,
+    use_learningmaterial_tool INTEGER NOT NULL,
+    use_milestones_tool INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+SETTINGS_FIELDS = ('system_prompt', 'temperature', 'use_plan_tool', 'use_search_tool',
+                   'use_learningmaterial_tool', 'use_milestones_tool')
+
+def check_learning_state(user_id: str, state: Dict):
+    """Raises ValueError unless the state has one done flag per milestone label"""
+    if len(state['labels']) != len(state['states']):
+        raise ValueError(f"Learning state of {user_id} has {len(state['labels'])} milestones "
+                         f"but {len(state['states'])} states")
+
+class StateStore:
+    """
+    Milestone states and agent settings of all users in a SQLite database in WAL mode.
+
+    Args:
+        path: Database file, created if missing
+        origin: Name of this process in the invalidation events, unique by default
+
+    Learning states are dicts with 'labels' (milestone texts) and 'states'
+    (completion flags), settings are dicts with the keys in SETTINGS_FIELDS.
+    """
+
+    def __init__(self, path: str, origin: Optional[str] = None):
+        self.path = path
+        self.origin = origin or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    # --- Milestone states ---
+    def load_learning_state(self, user_id: str) -> Optional[Dict]:
+        """Returns the learning state of a user, None if it has not been saved"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT label, done FROM milestones WHERE user_id = ? ORDER BY idx', (user_id,)).fetchall()
+        if not rows:
+            return None
+        return {'labels': [row[0] for row in rows], 'states': [bool(row[1]) for row in rows]}
+
+    def save_learning_state(self, user_id: str, state: Dict):
+        """Saves the learning state of a user"""
+        self.save_learning_states({user_id: state})
+
+    def save_learning_states(self, states: Dict[str, Dict]):
+        """Saves the learning states of several users in one transaction"""
+        for user_id, state in states.items():
+            check_learning_state(user_id, state)
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._add_events('learning_state', states, now)
+                for user_id, state in states.items():
+                    labels = list(state['labels'])
+                    self._conn.execute('DELETE FROM milestones WHERE user_id = ? AND idx >= ?', (user_id, len(labels)))
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO milestones VALUES (?, ?, ?, ?, ?)',
+                        [(user_id, idx, label, int(bool(done)), now)
+                         for idx, (label, done) in enumerate(zip(labels, state['states']))]
+                    )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    # --- Agent settings ---
+    def load_agent_settings(self, user_id: str) -> Optional[Dict]:
+        """Returns the agent settings of a user, None if they have not been saved"""
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT {", ".join(SETTINGS_FIELDS)} FROM agent_settings WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        settings = dict(zip(SETTINGS_FIELDS, row))
+        for field in SETTINGS_FIELDS[2:]:
+            settings[field] = bool(settings[field])
+        return settings
+
+    def save_agent_settings(self, user_id: str, settings: Dict):
+        """Saves the agent settings of a user"""
+        self.save_many_agent_settings({user_id: settings})
+
+    def save_many_agent_settings(self, settings_by_user: Dict[str, Dict]):
+        """Saves the agent settings of several users in one transaction"""
+        now = time.time()
+        rows = [(user_id, settings['system_prompt'], float(settings['temperature']),
+                 *(int(bool(settings[field])) for field in SETTINGS_FIELDS[2:]), now)
+                for user_id, settings in settings_by_user.items()]
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('INSERT OR REPLACE INTO agent_settings VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._add_events('agent_settings', settings_by_user, now)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    # --- Invalidation events ---
+    def _add_events(self, kind: str, user_ids, now: float):
+        """Records that the users' data of a kind changed, the caller holds the lock and a transaction"""
+        self._conn.executemany('INSERT INTO events (kind, user_id, origin, created_at) VALUES (?, ?, ?, ?)',
+                               [(kind, user_id, self.origin, now) for user_id in user_ids])
+
+    def last_event_id(self) -> int:
+        """Returns the id of the latest event, the position to follow the events from"""
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def read_events(self, after_id: int, limit: int = 1000) -> list:
+        """Returns (id, kind, user_id) of the events of other processes after an event id"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT id, kind, user_id FROM events WHERE id > ? AND origin != ? ORDER BY id LIMIT ?',
+                (after_id, self.origin, limit)).fetchall()
+
+    def prune_events(self, max_age: float) -> int:
+        """Deletes events older than max_age seconds, returns the number deleted"""
+        with self._lock:
+            return self._conn.execute('DELETE FROM events WHERE created_at < ?', (time.time() - max_age,)).rowcount
+
+    # --- Admin ---
+    def milestone_progress(self) -> Dict[str, Dict]:
+        """Returns the number of completed and total milestones of every user"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT user_id, SUM(done), COUNT(*) FROM milestones GROUP BY user_id').fetchall()
+        return {user_id: {'completed': completed, 'total': total} for user_id, completed, total in rows}
+
+    def stats(self) -> Dict:
+        """Returns the number of stored users and the database size"""
+        with self._lock:
+            users, completed, milestones = self._conn.execute(
+                'SELECT COUNT(DISTINCT user_id), COALESCE(SUM(done), 0), COUNT(*) FROM milestones').fetchone()
+            settings = self._conn.execute('SELECT COUNT(*) FROM agent_settings').fetchone()[0]
+        return {
+            "users_with_state": users,
+            "milestones": milestones,
+            "completed_milestones": completed,
+            "users_with_settings": settings,
+            "database_bytes": sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+        }
+
+    # --- Migration ---
+    def import_pickles(self, user_data_dir: str, batch_size: int = 500, force: bool = False) -> Dict:
+        """
+        Imports the state_variables.pickle and agent_settings.pickle files of
+        user_data_dir/<user_id>/, users already in the store are skipped.
+
+        The directory is only scanned once unless force is set.
+
+        Returns:
+            Dict: Numbers of imported learning states and settings
+        """
+        imported = {'learning_states': 0, 'agent_settings': 0}
+        with self._lock:
+            if not force and self._conn.execute("SELECT 1 FROM meta WHERE key = 'pickles_imported'").fetchone():
+                return imported
+            stored_states = {row[0] for row in self._conn.execute('SELECT DISTINCT user_id FROM milestones')}
+            stored_settings = {row[0] for row in self._conn.execute('SELECT user_id FROM agent_settings')}
+
+        states, settings = {}, {}
+        for user_id in sorted(os.listdir(user_data_dir)) if os.path.isdir(user_data_dir) else []:
+            user_dir = os.path.join(user_data_dir, user_id)
+            if user_id not in stored_states:
+                state = read_pickle(os.path.join(user_dir, 'state_variables.pickle'))
+                if state:
+                    states[user_id] = state
+            if user_id not in stored_settings:
+                user_settings = read_pickle(os.path.join(user_dir, 'agent_settings.pickle'))
+                if user_settings:
+                    settings[user_id] = user_settings
+
+            if len(states) >= batch_size:
+                imported['learning_states'] += self._flush_import(states, self.save_learning_states)
+            if len(settings) >= batch_size:
+                imported['agent_settings'] += self._flush_import(settings, self.save_many_agent_settings)
+
+        imported['learning_states'] += self._flush_import(states, self.save_learning_states)
+        imported['agent_settings'] += self._flush_import(settings, self.save_many_agent_settings)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('pickles_imported', ?)", (str(time.time()),))
+        return imported
+
+    @staticmethod
+    def _flush_import(batch: Dict, save) -> int:
+        count = len(batch)
+        if batch:
+            save(batch)
+            batch.clear()
+        return count
+
+class LearningStateBuffer:
+    """
+    In-memory learning states of the users with write-behind persistence.
+
+    Args:
+        store: StateStore the states are loaded from and written to
+        durability: 'write-behind' to write the changed states every flush
+                    interval in one transaction, 'sync' to write each update
+                    before returning
+
+    Updates of a user between two flushes are coalesced into one write. With
+    'write-behind', updates of the last interval are lost if the process is
+    killed before flush() or close(). The memory is authoritative for this
+    process only, other processes see the states once they are flushed and
+    they have read the invalidation events (see discard).
+    """
+
+    DURABILITY_MODES = ('write-behind', 'sync')
+
+    def __init__(self, store: StateStore, durability: str = 'write-behind'):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {durability!r}, use one of {self.DURABILITY_MODES}")
+        self.store = store
+        self.durability = durability
+        self._states = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        self.counters = {'hits': 0, 'misses': 0, 'updates': 0, 'flushes': 0, 'written_states': 0, 'flush_errors': 0}
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        """Returns a copy of the learning state of a user, None if it has not been saved"""
+        with self._lock:
+            state = self._states.get(user_id)
+            self.counters['hits' if state is not None else 'misses'] += 1
+        if state is None:
+            state = self.store.load_learning_state(user_id)
+            if state is None:
+                return None
+            with self._lock:
+                # An update made while loading wins over the stored state
+                state = self._states.setdefault(user_id, state)
+        return {'labels': list(state['labels']), 'states': list(state['states'])}
+
+    def discard(self, user_id: str):
+        """Drops the cached state of a user changed by another process, unless it has unwritten updates"""
+        with self._lock:
+            if user_id not in self._dirty:
+                self._states.pop(user_id, None)
+
+    def update(self, user_id: str, state: Dict):
+        """Sets the learning state of a user, it is written at the next flush (or now with 'sync')"""
+        state = {'labels': list(state['labels']), 'states': [bool(done) for done in state['states']]}
+        check_learning_state(user_id, state)
+        with self._lock:
+            self._states[user_id] = state
+            self._dirty.add(user_id)
+            self.counters['updates'] += 1
+        if self.durability == 'sync':
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes the changed states in one transaction, returns the number of written states"""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+            states = {user_id: self._states[user_id] for user_id in dirty}
+        try:
+            self.store.save_learning_states(states)
+        except sqlite3.Error:
+            with self._lock:
+                # Retried at the next flush, unless updated again in the meantime
+                self._dirty.update(dirty)
+                self.counters['flush_errors'] += 1
+            raise
+        with self._lock:
+            self.counters['flushes'] += 1
+            self.counters['written_states'] += len(states)
+        return len(states)
+
+    def start(self, interval: float = 1.0):
+        """Starts a daemon thread flushing the changed states every interval seconds"""
+        if self._flusher is not None or self.durability == 'sync':
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.flush()
+                except sqlite3.Error as e:
+                    print(f"Error flushing learning states: {e}")
+
+        self._flusher = threading.Thread(target=run, name='learning-state-flush', daemon=True)
+        self._flusher.start()
+
+    def close(self):
+        """Stops the flush thread and writes the remaining changes"""
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def stats(self) -> Dict:
+        """Returns the durability mode, buffered users and flush counters"""
+        with self._lock:
+            return {
+                "durability": self.durability,
+                "cached_users": len(self._states),
+                "pending_writes": len(self._dirty),
+                **self.counters,
+                "coalesced_updates": self.counters['updates'] - self.counters['written_states'] - len(self._dirty)
+            }
+
+def read_pickle(path: str):
+    """Returns the object in a pickle file, None if it is missing or unreadable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"Warning: Skipping {path}: {e}")
+        return None
+
+def open_state_store(path: str, user_data_dir: Optional[str] = None) -> StateStore:
+    """Opens the store, importing the pickle files under user_data_dir on the first start"""
+    store = StateStore(path)
+    if user_data_dir:
+        imported = store.import_pickles(user_data_dir)
+        if any(imported.values()):
+            print(f"Imported {imported['learning_states']} learning states and "
+                  f"{imported['agent_settings']} agent settings from {user_data_dir}")
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import per-user state pickles into a state store')
+    parser.add_argument('user_data_dir', help='e.g. user_data')
+    parser.add_argument('db_path', help='e.g. user_data/state.sqlite')
+    args = parser.parse_args()
+    print(StateStore(args.db_path).import_pickles(args.user_data_dir, force=True))
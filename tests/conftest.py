@@ -0,0 +1,44 @@
+"""
+Shared setup of the tests
+
+app.py reads its data files relative to the repository root and opens its
+databases when it is imported, so the environment is prepared here before a
+test imports it: the API keys are dummies, web search uses the offline
+fixture backend and the databases (including the search cache) are created in
+a temp directory. The fake_chat_model fixture answers chat turns without an
+API, with the fake chat model of the benchmarks.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+TEST_DATA_DIR = tempfile.mkdtemp(prefix='upbeat-tests-')
+os.environ.update(
+    CONVERSATION_DB_FILE=os.path.join(TEST_DATA_DIR, 'conversations.sqlite'),
+    STATE_DB_FILE=os.path.join(TEST_DATA_DIR, 'state.sqlite'),
+    SEARCH_CACHE_DB_FILE=os.path.join(TEST_DATA_DIR, 'search_cache.sqlite'),
+    SEARCH_BACKEND='fixture',
+    STUDY_PLANS_RELOAD_INTERVAL='0',
+)
+for key in ('OPENAI_API_KEY', 'TAVILY_API_KEY'):
+    os.environ.setdefault(key, 'test')
+
+@pytest.fixture
+def fake_chat_model(monkeypatch):
+    """Replaces the chat model of app.py with one that calls milestones_tool once per turn and then answers"""
+    import app
+    from benchmarks.fake_chat_model import install_fake_chat_model
+
+    monkeypatch.setattr(app, 'ChatOpenAI', app.ChatOpenAI)
+    monkeypatch.setattr(app, 'chat_models', {})
+    monkeypatch.setattr(app, 'shared_agents', {})
+    monkeypatch.setattr(app, 'user_agents', app.AgentPool(app.AGENT_POOL_CAPACITY, app.AGENT_POOL_IDLE_TTL))
+    install_fake_chat_model(app, latency=0, tool_call='milestones_tool')
+    return app
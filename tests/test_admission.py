@@ -0,0 +1,88 @@
+"""Tests of the admission control of chat turns"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import app
+from app import AdmissionController
+
+def rejection(controller, thread_id):
+    """Returns the HTTPException a turn of the thread is rejected with"""
+    with pytest.raises(HTTPException) as excinfo:
+        controller.admit(thread_id)
+    return excinfo.value
+
+def test_busy_thread_gets_429():
+    controller = AdmissionController(limit=4, queue_limit=4)
+    ticket = controller.admit('alice-1')
+    error = rejection(controller, 'alice-1')
+    assert error.status_code == 429
+    assert int(error.headers['Retry-After']) >= 1
+    assert controller.rejected == {'thread_busy': 1, 'queue_full': 0}
+
+    controller.release(ticket)
+    controller.release(controller.admit('alice-1'))
+    assert controller.running == 0
+
+def test_full_queue_gets_429():
+    controller = AdmissionController(limit=1, queue_limit=1)
+    running = controller.admit('alice-1')
+    waiting = controller.admit('bob-1')
+    assert running.admitted.is_set() and not waiting.admitted.is_set()
+
+    error = rejection(controller, 'carol-1')
+    assert error.status_code == 429
+    assert 1 <= int(error.headers['Retry-After']) <= 60
+    assert controller.rejected == {'thread_busy': 0, 'queue_full': 1}
+
+    # The waiting turn gets the slot, so a new turn can wait again
+    controller.release(running)
+    assert waiting.admitted.is_set()
+    controller.admit('carol-1')
+    assert controller.stats()['waiting'] == 1
+
+def test_retry_after_grows_with_the_queue():
+    controller = AdmissionController(limit=1, queue_limit=10)
+    controller.admit('thread-0')
+    empty = controller.retry_after()
+    for index in range(1, 6):
+        controller.admit(f'thread-{index}')
+    assert controller.retry_after() > empty
+
+def test_waiting_turns_see_their_queue_position():
+    async def scenario():
+        controller = AdmissionController(limit=1, queue_limit=10)
+        running = controller.admit('alice-1')
+        first = controller.admit('bob-1')
+        second = controller.admit('carol-1')
+
+        positions = []
+        async def wait(ticket):
+            async for position in controller.wait(ticket):
+                positions.append((ticket.thread_id, position))
+
+        waiters = [asyncio.create_task(wait(first)), asyncio.create_task(wait(second))]
+        await asyncio.sleep(0)
+        controller.release(running)
+        await waiters[0]
+        await asyncio.sleep(0)
+        controller.release(first)
+        await waiters[1]
+        return positions
+
+    positions = asyncio.run(scenario())
+    assert positions == [('bob-1', 1), ('carol-1', 2), ('carol-1', 1)]
+
+def test_chat_endpoint_returns_retry_after():
+    user_id = next(iter(app.user_datasets))
+    thread_id = f'{user_id}-1'
+    app.admission.threads.add(thread_id)
+    try:
+        response = TestClient(app.app).post('/api/chat', json={'user_id': user_id, 'message': 'Hello'})
+    finally:
+        app.admission.threads.discard(thread_id)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
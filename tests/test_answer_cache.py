@@ -0,0 +1,75 @@
+"""Tests of the answer cache eligibility rules"""
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import app
+from app import get_cached_answer, invalidate_answers, is_cacheable_turn, store_answer
+
+KEY = ('student@example.com', 1, 'what are my milestones', 'settings', 'plans')
+
+@pytest.fixture(autouse=True)
+def answer_cache(monkeypatch):
+    monkeypatch.setattr(app, 'ANSWER_CACHE_ENABLED', True)
+    app.answer_cache.clear()
+    yield app.answer_cache
+    app.answer_cache.clear()
+
+def turn(*tool_names, answer='Here are your milestones.'):
+    """Returns the messages of a conversation with one turn that called the given tools"""
+    messages = [HumanMessage(content='What are my milestones?')]
+    if tool_names:
+        messages.append(AIMessage(content='', tool_calls=[
+            {'name': name, 'args': {}, 'id': f'call_{index}'} for index, name in enumerate(tool_names)]))
+        messages.extend(ToolMessage(content='result', name=name, tool_call_id=f'call_{index}')
+                        for index, name in enumerate(tool_names))
+    messages.append(AIMessage(content=answer))
+    return messages
+
+@pytest.mark.parametrize('first_turn, tools_used, cacheable', [
+    (True, set(), True),
+    (True, {'web_search_tool'}, True),
+    (False, set(), False),
+    (False, {'milestones_tool'}, True),
+    (False, {'phase1_plan_tool', 'milestones_tool'}, True),
+    (False, {'milestones_tool', 'web_search_tool'}, False),
+    (False, {'additional_materials_tool'}, False),
+])
+def test_cacheable_turns(first_turn, tools_used, cacheable):
+    assert is_cacheable_turn(first_turn, tools_used) == cacheable
+
+def test_plan_only_answer_is_served_on_any_turn():
+    store_answer(KEY, turn('milestones_tool'), first_turn=False)
+    assert get_cached_answer(KEY, first_turn=False)['answer'] == 'Here are your milestones.'
+    assert get_cached_answer(KEY, first_turn=True) is not None
+
+def test_first_turn_answer_is_only_served_on_first_turns():
+    store_answer(KEY, turn('web_search_tool'), first_turn=True)
+    assert get_cached_answer(KEY, first_turn=False) is None
+    cached = get_cached_answer(KEY, first_turn=True)
+    assert [event for event, _ in cached['events']] == ['tool-start', 'tool-end', 'token']
+
+def test_first_turn_without_tools_is_only_served_on_first_turns():
+    store_answer(KEY, turn(), first_turn=True)
+    assert get_cached_answer(KEY, first_turn=False) is None
+    assert get_cached_answer(KEY, first_turn=True) is not None
+
+def test_later_turn_with_other_tools_is_not_stored(answer_cache):
+    store_answer(KEY, turn('web_search_tool'), first_turn=False)
+    store_answer(KEY, turn('milestones_tool', answer=''), first_turn=False)
+    assert not answer_cache
+
+def test_expired_and_invalidated_answers_are_dropped(answer_cache):
+    store_answer(KEY, turn('milestones_tool'), first_turn=False)
+    answer_cache[KEY]['expires'] = 0
+    assert get_cached_answer(KEY, first_turn=False) is None
+    assert KEY not in answer_cache
+
+    store_answer(KEY, turn('milestones_tool'), first_turn=False)
+    invalidate_answers(KEY[0])
+    assert get_cached_answer(KEY, first_turn=False) is None
+
+def test_disabled_cache_serves_nothing(monkeypatch):
+    store_answer(KEY, turn('milestones_tool'), first_turn=False)
+    monkeypatch.setattr(app, 'ANSWER_CACHE_ENABLED', False)
+    assert get_cached_answer(KEY, first_turn=False) is None
@@ -0,0 +1,83 @@
+"""Tests of the /metrics endpoint after a streamed chat turn"""
+
+import re
+
+from fastapi.testclient import TestClient
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+HISTOGRAM_SUFFIXES = ('_bucket', '_sum', '_count')
+
+def parse_metrics(text):
+    """
+    Parses the Prometheus text format, failing on lines that do not follow it.
+
+    Returns:
+        tuple: ({family: type}, {(sample name, frozenset of label pairs): value})
+    """
+    types, samples = {}, {}
+    assert text.endswith('\n')
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            assert len(line.split(' ', 3)) == 4, line
+            continue
+        if line.startswith('# TYPE '):
+            _, _, family, kind = line.split(' ')
+            assert kind in ('counter', 'gauge', 'histogram', 'summary', 'untyped'), line
+            assert family not in types, f'{family} declared twice'
+            types[family] = kind
+            continue
+        match = SAMPLE_PATTERN.match(line)
+        assert match, f'Invalid sample line: {line!r}'
+        name, labels, value = match.groups()
+        family = name if name in types else next(
+            (name[:-len(suffix)] for suffix in HISTOGRAM_SUFFIXES if name.endswith(suffix)), name)
+        assert family in types, f'{name} has no TYPE line before its samples'
+        pairs = LABEL_PATTERN.findall(labels or '')
+        assert (labels or '{}') == '{' + ','.join(f'{key}="{val}"' for key, val in pairs) + '}', line
+        samples[(name, frozenset(pairs))] = float(value)
+    return types, samples
+
+def value(samples, name, **labels):
+    return samples.get((name, frozenset(labels.items())), 0.0)
+
+def check_histogram(samples, name, **labels):
+    """Checks that the buckets of a series are cumulative and end with +Inf == _count"""
+    buckets = sorted((float(dict(pairs)['le']), count) for (sample, pairs), count in samples.items()
+                     if sample == f'{name}_bucket' and {pair for pair in pairs if pair[0] != 'le'} == set(labels.items()))
+    counts = [count for _, count in buckets]
+    assert buckets and buckets[-1][0] == float('inf')
+    assert counts == sorted(counts)
+    assert counts[-1] == value(samples, f'{name}_count', **labels)
+
+def test_metrics_after_a_chat_turn(fake_chat_model):
+    app = fake_chat_model
+    client = TestClient(app.app)
+    _, before = parse_metrics(client.get('/metrics').text)
+
+    user_id = next(iter(app.user_datasets))
+    response = client.get('/api/chat/stream', params={'user_id': user_id, 'message': 'What should I do next?'})
+    assert response.status_code == 200 and 'event: done' in response.text
+
+    response = client.get('/metrics')
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    types, after = parse_metrics(response.text)
+
+    assert types['chat_stream_duration_seconds'] == types['chat_time_to_first_token_seconds'] == 'histogram'
+    assert types['tool_calls_total'] == types['llm_prompt_tokens_total'] == types['llm_completion_tokens_total'] == 'counter'
+
+    def increase(name, **labels):
+        return value(after, name, **labels) - value(before, name, **labels)
+
+    assert increase('chat_stream_duration_seconds_count', outcome='ok') == 1
+    assert increase('chat_time_to_first_token_seconds_count') == 1
+    assert increase('llm_request_duration_seconds_count', model='fake', outcome='ok') == 2
+    assert increase('tool_calls_total', tool='milestones_tool', outcome='ok') == 1
+    assert increase('tool_duration_seconds_count', tool='milestones_tool') == 1
+    assert increase('llm_prompt_tokens_total', model='fake') > 0
+    assert increase('llm_completion_tokens_total', model='fake') == len(app.ChatOpenAI().answer.split())
+
+    check_histogram(after, 'chat_stream_duration_seconds', outcome='ok')
+    check_histogram(after, 'chat_time_to_first_token_seconds')
+    check_histogram(after, 'llm_request_duration_seconds', model='fake', outcome='ok')
+    check_histogram(after, 'tool_duration_seconds', tool='milestones_tool')
@@ -0,0 +1,87 @@
+"""Tests of the learning plan parser"""
+
+import os
+import time
+
+import pytest
+
+from app import parse_learning_plan, user_datasets
+
+CORPUS_DIR = os.path.join('benchmarks', 'plan_parser_corpus')
+
+def parse_section(header, content):
+    """Parses a plan with one section, returns that section"""
+    result = parse_learning_plan(f'Plan\nDear Student,\n\n## 1. {header}\n{content}')
+    return result['sections']['section_1']
+
+def test_stored_plans_are_parsed():
+    for user_id in user_datasets:
+        for plan_key in ('smart_plan_phase1', 'smart_plan_phase2'):
+            result = parse_learning_plan(user_datasets[user_id][plan_key])
+            assert 'error' not in result, f'{user_id} {plan_key}'
+            assert result['sections']
+
+@pytest.mark.parametrize('file_name', sorted(os.listdir(CORPUS_DIR)))
+def test_corpus_follows_schema(file_name):
+    with open(os.path.join(CORPUS_DIR, file_name), encoding='utf-8', newline='') as f:
+        result = parse_learning_plan(f.read())
+    if 'error' in result:
+        assert set(result) == {'error'}
+        return
+    assert set(result) == {'title', 'introduction', 'sections', 'ending'}
+    for key, section in result['sections'].items():
+        assert key == f"section_{section['number']}"
+        for assignment in section.get('assignments', []):
+            assert all(isinstance(value, str) for value in assignment.values())
+        for material in section.get('materials', []):
+            assert set(material) == {'number', 'description', 'url'}
+
+def test_plain_text_format():
+    with open(os.path.join(CORPUS_DIR, 'legacy_plain_format.txt'), encoding='utf-8') as f:
+        result = parse_learning_plan(f.read())
+    sections = result['sections']
+    assert result['title'] == 'Smart learning plan'
+    assert sections['section_1']['objectives'] == {'AI skills': ['item a', 'item b'], 'Business': ['item c']}
+    assert sections['section_2']['assignments'] == [{
+        'title': 'Write a canvas', 'task': 'do it', 'process': 'step one', 'tools': 'ChatGPT', 'sample_prompt': 'help me'
+    }]
+    assert [material['url'] for material in sections['section_3']['materials']] == ['https://a.example', 'https://b.example']
+    assert result['ending'].startswith('We are glad to have you onboard')
+
+def test_assignment_continuation_lines_are_joined():
+    section = parse_section('Extra assignments', 'Write a canvas\nTask: first line\nsecond line\nProcess: step\n- a list item\n')
+    assert section['assignments'] == [{
+        'title': 'Write a canvas', 'task': 'first line\nsecond line\n- a list item', 'process': 'step'
+    }]
+
+def test_bold_title_and_heading_layouts():
+    section = parse_section('Extra assignments', '1. **Canvas**: draw it\n- step one\n\n### Module 2: Pitch\nRecord a pitch\n')
+    assert section['assignments'] == [
+        {'title': 'Canvas', 'task': 'draw it\n- step one'},
+        {'title': 'Module 2: Pitch', 'task': 'Record a pitch'}
+    ]
+
+def test_material_description_continues_until_url():
+    section = parse_section('Additional materials', '1: Course A\nby a teacher\nhttps://a.example more\n2: Course B<br>https://b.example\n')
+    assert section['materials'] == [
+        {'number': '1', 'description': 'Course A\nby a teacher', 'url': 'https://a.example'},
+        {'number': '2', 'description': 'Course B', 'url': 'https://b.example'}
+    ]
+
+@pytest.mark.parametrize('header, first_line, line', [
+    ('Extra assignments', 'Assignment title\nTask: start', 'the task continues on this line'),
+    ('Extra assignments', '1. **Title**: description', '- another step of the assignment'),
+    ('Additional online materials', '1: description', 'more description without a url'),
+])
+def test_long_continuations_are_parsed_in_linear_time(header, first_line, line):
+    """A single item with many continuation lines, time must grow about 10x for 10x the lines"""
+    def best_time(lines):
+        text = f'Plan\nDear Student,\n\n## 1. {header}\n{first_line}\n' + f'{line}\n' * lines
+        best = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            parse_learning_plan(text)
+            best = min(best, time.perf_counter() - start)
+        return best
+    
+    assert best_time(100_000) / best_time(10_000) < 30
@@ -0,0 +1,107 @@
+"""Tests of the plan store and the hot reload of study plans"""
+
+import pickle
+
+import pytest
+
+import app
+from plan_store import PlanStore, convert_pickle, open_plan_store, refresh_plan_store
+
+@pytest.fixture
+def plans(tmp_path):
+    """Returns (pickle path, store path, study plans) of a copy of the stored study plans"""
+    with open(app.STUDY_PLANS_FILE, 'rb') as f:
+        user_datasets = pickle.load(f)
+    pickle_path = str(tmp_path / 'study_plans_data.pickle')
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(user_datasets, f)
+    return pickle_path, str(tmp_path / 'study_plans'), user_datasets
+
+def write_pickle(path, user_datasets):
+    with open(path, 'wb') as f:
+        pickle.dump(user_datasets, f)
+
+def test_store_matches_pickle(plans):
+    pickle_path, store_path, user_datasets = plans
+    assert convert_pickle(pickle_path, store_path) == len(user_datasets)
+    store = PlanStore(store_path)
+    assert set(store) == set(user_datasets)
+    for user_id, record in user_datasets.items():
+        assert store[user_id]['smart_plan_phase1'] == record['smart_plan_phase1']
+        assert bytes(store[user_id]['smart_plan_pdf_phase1']) == bytes(record['smart_plan_pdf_phase1'])
+
+def test_refresh_converts_changed_pickle_only(plans):
+    pickle_path, store_path, user_datasets = plans
+    old_store = open_plan_store(store_path, pickle_path)
+    assert not refresh_plan_store(store_path, pickle_path)
+
+    user_id, other_id = list(user_datasets)[:2]
+    user_datasets[user_id]['smart_plan_phase2'] += '\nOne more task.'
+    write_pickle(pickle_path, user_datasets)
+    assert refresh_plan_store(store_path, pickle_path)
+
+    new_store = PlanStore(store_path)
+    assert old_store.changed_users(new_store) == {user_id}
+    assert old_store.content_hash(user_id) != new_store.content_hash(user_id)
+    assert old_store.content_hash(other_id) == new_store.content_hash(other_id)
+    assert new_store[user_id]['smart_plan_phase2'].endswith('One more task.')
+    # Readers of the old store keep their blob file
+    assert bytes(old_store[user_id]['smart_plan_pdf_phase1']) == bytes(new_store[user_id]['smart_plan_pdf_phase1'])
+
+def test_reload_invalidates_changed_users(plans, monkeypatch):
+    pickle_path, store_path, user_datasets = plans
+    monkeypatch.setattr(app, 'STUDY_PLANS_FILE', pickle_path)
+    monkeypatch.setattr(app, 'STUDY_PLANS_STORE', store_path)
+    monkeypatch.setattr(app, 'user_datasets', open_plan_store(store_path, pickle_path))
+    monkeypatch.setattr(app, 'structured_plan_cache', {})
+    monkeypatch.setattr(app, 'pdf_cache', {})
+    assert app.load_changed_study_plans() is None
+
+    user_id, other_id = list(user_datasets)[:2]
+    for cached_user in (user_id, other_id):
+        app.get_structured_plan_entry(cached_user, 2)
+        app.get_pdf_entry(cached_user, 1)
+    old_entry = app.get_structured_plan_entry(user_id, 2)
+
+    user_datasets[user_id]['smart_plan_phase2'] += '\nOne more task.'
+    write_pickle(pickle_path, user_datasets)
+    store, changed_users = app.load_changed_study_plans()
+    assert changed_users == {user_id}
+    app.swap_study_plans(store, changed_users)
+
+    assert app.user_datasets is store
+    assert (user_id, 2) not in app.structured_plan_cache and (user_id, 1) not in app.pdf_cache
+    assert (other_id, 2) in app.structured_plan_cache and (other_id, 1) in app.pdf_cache
+    new_entry = app.get_structured_plan_entry(user_id, 2)
+    assert new_entry['etag'] != old_entry['etag']
+
+def test_swap_closes_the_replaced_store(plans, monkeypatch):
+    pickle_path, store_path, user_datasets = plans
+    old_store = open_plan_store(store_path, pickle_path)
+    user_id = next(iter(user_datasets))
+    pdf = old_store[user_id]['smart_plan_pdf_phase1']  # A response still streaming the old PDF
+    monkeypatch.setattr(app, 'user_datasets', old_store)
+
+    user_datasets[user_id]['smart_plan_phase2'] += '\nOne more task.'
+    write_pickle(pickle_path, user_datasets)
+    assert refresh_plan_store(store_path, pickle_path)
+    new_store = PlanStore(store_path)
+    app.swap_study_plans(new_store, old_store.changed_users(new_store))
+
+    assert old_store._file.closed
+    with pytest.raises(ValueError):
+        old_store[user_id]['smart_plan_pdf_phase1']
+    assert bytes(pdf) == bytes(new_store[user_id]['smart_plan_pdf_phase1'])
+    new_store.close()
+
+def test_conversion_keeps_blob_files_it_cannot_delete(plans, monkeypatch):
+    pickle_path, store_path, user_datasets = plans
+    assert convert_pickle(pickle_path, store_path) == len(user_datasets)
+
+    def remove(path):
+        raise PermissionError(13, 'The file is in use', path)
+    monkeypatch.setattr('plan_store.os.remove', remove)
+    assert convert_pickle(pickle_path, store_path) == len(user_datasets)
+    store = PlanStore(store_path)
+    assert set(store) == set(user_datasets)
+    store.close()
@@ -0,0 +1,65 @@
+"""Tests of the SQLite checkpointer storage and compaction"""
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.graph import END, START, MessagesState, StateGraph
+
+from sqlite_checkpointer import SqliteCheckpointer
+
+ANSWER = 'A long answer about the study plan. ' * 50
+
+def build_graph(checkpointer):
+    """Returns a graph that answers every message with ANSWER"""
+    graph = StateGraph(MessagesState)
+    graph.add_node('reply', lambda state: {'messages': [AIMessage(content=ANSWER)]})
+    graph.add_edge(START, 'reply')
+    graph.add_edge('reply', END)
+    return graph.compile(checkpointer=checkpointer)
+
+def config(thread_id, user_id='student@example.com'):
+    return {'configurable': {'thread_id': thread_id, 'user_id': user_id}}
+
+def run_turns(graph, thread_id, turns):
+    for index in range(turns):
+        graph.invoke({'messages': [HumanMessage(content=f'Question {index}')]}, config(thread_id))
+
+def test_state_round_trips_through_blobs(tmp_path):
+    checkpointer = SqliteCheckpointer(str(tmp_path / 'conversations.sqlite'), keep_latest=1)
+    graph = build_graph(checkpointer)
+    run_turns(graph, 'student-1', 3)
+    checkpointer.compact()
+
+    assert checkpointer.stats()['checkpoints'] == 1
+    messages = graph.get_state(config('student-1')).values['messages']
+    assert [message.content for message in messages[::2]] == ['Question 0', 'Question 1', 'Question 2']
+    assert all(message.content == ANSWER for message in messages[1::2])
+
+def test_unchanged_channels_are_not_stored_again(tmp_path):
+    checkpointer = SqliteCheckpointer(str(tmp_path / 'conversations.sqlite'), keep_latest=100)
+    graph = build_graph(checkpointer)
+    run_turns(graph, 'student-1', 5)
+
+    with checkpointer._lock:
+        versions = checkpointer._conn.execute(
+            "SELECT COUNT(*) FROM blobs WHERE channel = 'messages'").fetchone()[0]
+        links = checkpointer._conn.execute(
+            "SELECT COUNT(*) FROM checkpoint_blobs WHERE channel = 'messages'").fetchone()[0]
+    # Every turn writes two versions of the history, the other checkpoints only refer to them
+    assert versions == 10
+    assert links > versions
+
+def test_user_over_the_cap_is_brought_under_it(tmp_path):
+    checkpointer = SqliteCheckpointer(str(tmp_path / 'conversations.sqlite'), keep_latest=100)
+    graph = build_graph(checkpointer)
+    run_turns(graph, 'student-1', 4)
+    run_turns(graph, 'student-2', 4)
+    with checkpointer._lock:
+        stored = checkpointer._user_bytes('student@example.com')
+
+    checkpointer.max_user_bytes = stored // 3
+    checkpointer.compact({'student-1', 'student-2'})
+
+    with checkpointer._lock:
+        assert checkpointer._user_bytes('student@example.com') <= checkpointer.max_user_bytes
+    # The newest conversation keeps its whole history
+    messages = graph.get_state(config('student-2')).values['messages']
+    assert len(messages) == 8
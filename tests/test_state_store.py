@@ -0,0 +1,34 @@
+"""Tests of the learning states in the state store"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+from state_store import LearningStateBuffer, StateStore
+
+STATE = {'labels': ['Define the customer', 'Build a prototype', 'Pitch'], 'states': [True, False, False]}
+
+@pytest.fixture
+def store(tmp_path):
+    return StateStore(str(tmp_path / 'state.sqlite'))
+
+def test_mismatched_state_is_rejected(store):
+    store.save_learning_state('student', STATE)
+    with pytest.raises(ValueError):
+        store.save_learning_state('student', {'labels': STATE['labels'], 'states': [True]})
+    with pytest.raises(ValueError):
+        LearningStateBuffer(store).update('student', {'labels': STATE['labels'][:1], 'states': STATE['states']})
+    assert store.load_learning_state('student') == STATE
+
+def test_fewer_milestones_delete_the_rest(store):
+    store.save_learning_state('student', STATE)
+    store.save_learning_state('student', {'labels': STATE['labels'][:2], 'states': [True, True]})
+    assert store.load_learning_state('student') == {'labels': STATE['labels'][:2], 'states': [True, True]}
+
+def test_update_milestones_returns_400_on_mismatch():
+    user_id = next(iter(app.user_datasets))
+    milestones = len(app.load_user_state(user_id)['labels'])
+    response = TestClient(app.app).post('/api/update-milestones',
+                                        json={'user_id': user_id, 'milestones': [True] * (milestones + 1)})
+    assert response.status_code == 400
+    assert len(app.load_user_state(user_id)['states']) == milestones
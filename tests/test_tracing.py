@@ -0,0 +1,57 @@
+"""Tests of the spans of a traced chat turn"""
+
+import asyncio
+
+import pytest
+
+import tracing
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemoryExporter()
+    tracing.configure(exporter, sample_rate=1.0)
+    yield exporter
+    tracing.configure()
+
+def children(spans, parent, name_prefix):
+    """Returns the spans under parent whose name starts with name_prefix, in start order"""
+    return sorted((span for span in spans if span['parentSpanId'] == parent['spanId'] and span['name'].startswith(name_prefix)),
+                  key=lambda span: span['startTimeUnixNano'])
+
+def test_chat_turn_spans_form_a_tree(fake_chat_model, exporter):
+    app = fake_chat_model
+    user_id = next(iter(app.user_datasets))
+    answer = asyncio.run(app.predict_for_user(user_id, 'What should I do next?'))
+    assert answer == 'This is a benchmark answer from the fake chat model.'
+
+    [root] = [span for span in exporter.spans if span['name'] == 'chat']
+    spans = exporter.trace(root['traceId'])
+    assert len(spans) == len(exporter.spans)
+    assert root['parentSpanId'] == ''
+    span_ids = {span['spanId'] for span in spans}
+    assert all(span['parentSpanId'] in span_ids for span in spans if span is not root)
+    assert children(spans, root, 'create_agent_for_user') and children(spans, root, 'checkpoint.put')
+
+    # The agent asks for the tool, the tool node runs it, and the agent answers
+    steps = [step for step in children(spans, root, 'agent_step') if step['attributes']['node'] in ('agent', 'tools')]
+    assert [step['name'] for step in steps] == ['agent_step agent', 'agent_step tools', 'agent_step agent']
+    [first_call], [tool_call], [second_call] = (children(spans, step, '') for step in steps)
+    assert first_call['name'] == second_call['name'] == 'chat fake'
+    assert tool_call['name'] == 'execute_tool milestones_tool'
+
+    timeline = [first_call, tool_call, second_call]
+    assert all(earlier['endTimeUnixNano'] <= later['startTimeUnixNano'] for earlier, later in zip(timeline, timeline[1:]))
+    for step, call in zip(steps, timeline):
+        assert step['startTimeUnixNano'] <= call['startTimeUnixNano'] <= call['endTimeUnixNano'] <= step['endTimeUnixNano']
+    assert all(root['startTimeUnixNano'] <= span['startTimeUnixNano'] and span['endTimeUnixNano'] <= root['endTimeUnixNano']
+               for span in spans)
+
+def test_untraced_turn_records_nothing(fake_chat_model):
+    exporter = tracing.InMemoryExporter()
+    tracing.configure(exporter, sample_rate=0.0)
+    try:
+        app = fake_chat_model
+        asyncio.run(app.predict_for_user(next(iter(app.user_datasets)), 'What should I do next?'))
+    finally:
+        tracing.configure()
+    assert exporter.spans == []
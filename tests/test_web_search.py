@@ -0,0 +1,116 @@
+"""Tests of the cached web search"""
+
+import asyncio
+
+import pytest
+
+PAGE = """
+[Home](https://example.com) | [Blog](https://example.com/blog) | [Pricing](https://example.com/pricing)
+Skip to main content
+
+We use cookies to improve your experience on this site. By browsing you accept all cookies and our privacy policy.
+
+# How to write a lean canvas
+
+The lean canvas is a one-page business plan that lists the problem, the customer segments, the unique value proposition, the solution and the key metrics of a startup idea.
+
+Our team was founded in 2012 and has offices in Helsinki, Tampere and Oulu, where we host meetups about design and product work every month.
+
+Start the lean canvas with the customer segments and the problem, because every other box of the canvas depends on who the customers are and what they struggle with.
+
+Fill in the unique value proposition last: one clear sentence that says why the customers should pick your solution over the alternatives they already use.
+
+The weather in Finland in the spring is unpredictable, so bring both a raincoat and sunglasses when you travel there for a conference or a holiday.
+
+Subscribe to our newsletter and follow us on social media to get new articles about startups in your inbox every week.
+
+Copyright 2024 Example Oy. All rights reserved. Terms of use.
+"""
+RELEVANT = ('The lean canvas is a one-page business plan', 'Start the lean canvas with the customer segments',
+            'Fill in the unique value proposition last')
+IRRELEVANT = ('Our team was founded', 'The weather in Finland')
+BOILERPLATE = ('[Home]', 'Skip to main content', 'We use cookies', 'Subscribe to our newsletter', 'Copyright 2024')
+
+from web_search import CachedSearch, FixtureBackend, estimate_tokens, extract_result
+
+def test_concurrent_searches_share_one_backend_call():
+    async def scenario():
+        backend = FixtureBackend(latency=0.05)
+        search = CachedSearch(backend, ttl=60, capacity=10)
+        results = await asyncio.gather(*(search.asearch('lean canvas') for _ in range(5)))
+        return backend.calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 1
+    assert all(result == results[0] for result in results)
+
+def test_waiters_search_again_when_the_leader_is_cancelled():
+    async def scenario():
+        backend = FixtureBackend(latency=0.05)
+        search = CachedSearch(backend, ttl=60, capacity=10)
+        leader = asyncio.create_task(search.asearch('lean canvas'))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(search.asearch('lean canvas'))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.wait_for(waiter, timeout=2)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return backend.calls, results, search._in_flight
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert isinstance(results, list) and results
+    assert calls == 1  # The cancelled leader never reached the backend's result
+    assert not in_flight
+
+def test_cancelled_waiter_does_not_cancel_the_search():
+    async def scenario():
+        backend = FixtureBackend(latency=0.05)
+        search = CachedSearch(backend, ttl=60, capacity=10)
+        leader = asyncio.create_task(search.asearch('lean canvas'))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(search.asearch('lean canvas'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        return await leader
+
+    assert asyncio.run(scenario())
+
+def test_queries_differing_in_case_and_punctuation_share_a_key():
+    search = CachedSearch(FixtureBackend(), ttl=60, capacity=10)
+    assert search._key('How do I write a Lean Canvas?') == search._key('how do i  write a lean canvas')
+
+def test_question_words_and_word_order_are_kept():
+    search = CachedSearch(FixtureBackend(), ttl=60, capacity=10)
+    assert search._key('why react over vue') != search._key('how vue over react')
+    assert search._key('what is a lean canvas') != search._key('lean canvas')
+
+def test_backends_do_not_share_keys():
+    class OtherBackend(FixtureBackend):
+        name = 'other'
+
+    query = 'lean canvas'
+    assert CachedSearch(FixtureBackend(), ttl=60, capacity=10)._key(query) != \
+        CachedSearch(OtherBackend(), ttl=60, capacity=10)._key(query)
+
+def page_result():
+    return {'title': 'How to write a lean canvas', 'url': 'https://example.com/lean-canvas',
+            'content': 'A guide to the lean canvas.', 'raw_content': PAGE, 'score': 0.9}
+
+def test_extraction_keeps_relevant_paragraphs_and_drops_boilerplate():
+    extracted = extract_result(page_result(), 'how do I write a lean canvas for my customer segments', token_budget=400)
+    content = extracted['content']
+    assert content.startswith('A guide to the lean canvas.')
+    assert all(paragraph in content for paragraph in RELEVANT)
+    assert not any(text in content for text in IRRELEVANT + BOILERPLATE)
+    # Paragraphs are kept in page order
+    assert [content.index(paragraph) for paragraph in RELEVANT] == sorted(content.index(paragraph) for paragraph in RELEVANT)
+    assert extracted['score'] == 0.9 and extracted['url'] == 'https://example.com/lean-canvas'
+
+def test_extraction_respects_the_token_budget():
+    question = 'how do I write a lean canvas for my customer segments'
+    extracted = extract_result(page_result(), question, token_budget=80)
+    assert estimate_tokens(extracted['content']) <= 80
+    # The paragraph matching most question terms fits, the others are dropped
+    kept = [paragraph for paragraph in RELEVANT if paragraph in extracted['content']]
+    assert kept == ['Start the lean canvas with the customer segments']
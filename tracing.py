@@ -0,0 +1,204 @@
+"""
+Request tracing with spans and a local exporter
+
+A trace is a tree of timed spans, e.g. a chat turn with the agent rebuild,
+checkpoint reads and writes, model calls, tool calls and SSE serialization as
+children. The current span is kept in a context variable, so spans opened in
+tasks and worker threads started inside a span (asyncio.create_task,
+asyncio.to_thread) become its children. Spans are only recorded for sampled
+traces, the decision is made once per root span with sample_rate.
+
+Finished spans are written by the configured exporter, one JSON object per
+line with OTLP span field names (JsonlExporter), or kept in memory
+(InMemoryExporter). timeline() renders the spans of a trace as an indented
+flame-graph-like text, also from the command line:
+    python tracing.py user_data/traces.jsonl [trace_id]
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """A timed operation of a trace"""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'status')
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[Dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+
+    def set(self, **attributes):
+        """Adds attributes to the span"""
+        self.attributes.update(attributes)
+
+    def end(self, status: Optional[str] = None):
+        """Ends the span and exports it, a span is only ended once"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if status:
+            self.status = status
+        if _exporter is not None:
+            _exporter.export(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'attributes': self.attributes,
+            'status': self.status
+        }
+
+class JsonlExporter:
+    """Appends finished spans to a JSONL file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+class InMemoryExporter:
+    """Keeps finished spans in a list, e.g. for tests and benchmarks"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span: Span):
+        self.spans.append(span.to_dict())
+
+    def trace(self, trace_id: str) -> List[Dict]:
+        return [span for span in self.spans if span['traceId'] == trace_id]
+
+_exporter = None
+_sample_rate = 0.0
+
+def configure(exporter=None, sample_rate: float = 0.0):
+    """Sets the exporter and the fraction of root spans that are traced, tracing is off without an exporter"""
+    global _exporter, _sample_rate
+    _exporter = exporter
+    _sample_rate = sample_rate if exporter is not None else 0.0
+
+def current_span() -> Optional[Span]:
+    """Returns the innermost open span of the current context, None outside sampled traces"""
+    return _current_span.get()
+
+def start_span(name: str, parent: Optional[Span] = None, root: bool = False, force: bool = False, **attributes) -> Optional[Span]:
+    """
+    Starts a span without making it current, the caller ends it.
+
+    A root span starts a new trace if it is sampled (or force is set), other
+    spans are children of parent or the current span. Returns None if the
+    span is not recorded.
+    """
+    if root:
+        if _exporter is None or not (force or random.random() < _sample_rate):
+            return None
+        return Span(name, os.urandom(16).hex(), None, attributes)
+    parent = parent or _current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+@contextmanager
+def use_span(span: Optional[Span]):
+    """Makes a started span current in this context without ending it"""
+    token = _current_span.set(span) if span is not None else None
+    try:
+        yield span
+    finally:
+        if token is not None:
+            _current_span.reset(token)
+
+@contextmanager
+def span(name: str, parent: Optional[Span] = None, root: bool = False, force: bool = False, **attributes):
+    """Runs the block in a span, a no-op outside sampled traces"""
+    current = start_span(name, parent, root, force, **attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=f'{type(e).__name__}: {e}')
+        current.status = 'error'
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+def timeline(spans: List[Dict], width: int = 40) -> str:
+    """Renders the spans of one trace as indented lines with start offset, duration and a bar"""
+    if not spans:
+        return ''
+    children = {}
+    for item in sorted(spans, key=lambda item: item['startTimeUnixNano']):
+        children.setdefault(item['parentSpanId'], []).append(item)
+    span_ids = {item['spanId'] for item in spans}
+    roots = [item for parent, items in children.items() if parent not in span_ids for item in items]
+    start = min(item['startTimeUnixNano'] for item in spans)
+    end = max(item['endTimeUnixNano'] or item['startTimeUnixNano'] for item in spans)
+    scale = width / max(end - start, 1)
+
+    lines = []
+    def render(item, depth):
+        offset = item['startTimeUnixNano'] - start
+        duration = (item['endTimeUnixNano'] or end) - item['startTimeUnixNano']
+        bar = ' ' * int(offset * scale) + '#' * max(1, int(duration * scale))
+        label = '  ' * depth + item['name'] + ('' if item['status'] == 'ok' else f' [{item["status"]}]')
+        lines.append(f'{offset / 1e6:9.1f} ms {duration / 1e6:9.1f} ms  {label:<40} |{bar:<{width}}|')
+        for child in children.get(item['spanId'], []):
+            render(child, depth + 1)
+    for item in roots:
+        render(item, 0)
+    return '\n'.join(lines)
+
+def read_traces(path: str) -> Dict[str, List[Dict]]:
+    """Reads a JSONL export, returns the spans grouped by trace id in file order"""
+    traces = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                traces.setdefault(item['traceId'], []).append(item)
+    return traces
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the timeline of traces exported to a JSONL file')
+    parser.add_argument('path', help='e.g. user_data/traces.jsonl')
+    parser.add_argument('trace_id', nargs='?', help='trace to print, by default the latest one')
+    args = parser.parse_args()
+    traces = read_traces(args.path)
+    trace_id = args.trace_id or (list(traces)[-1] if traces else None)
+    if trace_id not in traces:
+        raise SystemExit(f'No trace {trace_id} in {args.path}')
+    print(f'Trace {trace_id}')
+    print(timeline(traces[trace_id]))
@@ -90,10 +90,10 @@ export async function streamChatAction(userId: string, message: string) {
     // Use correct API URL from config - this works for all environments
     const baseUrl = `${API_URL}/api/chat/stream`;
 
-    // Build the URL string with proper encoding
+    // Build the URL string with proper encoding, chunks are full snapshots
     const url = `${baseUrl}?user_id=${encodeURIComponent(
       userId,
-    )}&message=${encodeURIComponent(message)}`;
+    )}&message=${encodeURIComponent(message)}&format=full`;
 
     // Use Node.js fetch (server-side)
     const response = await fetch(url, {
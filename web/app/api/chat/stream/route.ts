@@ -20,16 +20,21 @@ function iteratorToStream(iterator: AsyncIterator<Uint8Array>) {
 }
 
 // Tämä meidän striimausfunktio, joka hakee backendin striimaamaa tietoa
-async function* fetchBackendStream(userId: string, message: string) {
+async function* fetchBackendStream(
+  userId: string,
+  message: string,
+  lastEventId: string | null,
+) {
   const textEncoder = new TextEncoder();
   const url = `${API_URL}/api/chat/stream?user_id=${encodeURIComponent(
     userId,
   )}&message=${encodeURIComponent(message)}`;
 
   try {
-    // Pyyntö backendille
+    // Pyyntö backendille, Last-Event-ID jatkaa keskeytynyttä striimiä
     const response = await fetch(url, {
       cache: "no-store",
+      headers: lastEventId ? { "Last-Event-ID": lastEventId } : undefined,
     });
 
     if (!response.ok) {
@@ -72,17 +77,18 @@ async function* fetchBackendStream(userId: string, message: string) {
       const events = buffer.split(/\r?\n\r?\n/);
       buffer = events.pop() || ""; // Jätä viimeinen keskeneräinen tapahtuma puskuriin
 
-      // Käsittele kaikki kokonaiset tapahtumat
+      // Välitä kokonaiset SSE-tapahtumat (id, event ja data) sellaisenaan asiakkaalle
       for (const event of events) {
-        if (event.startsWith("data: ")) {
-          // Välitä SSE-tapahtuma sellaisenaan asiakkaalle
+        if (event.trim()) {
           yield textEncoder.encode(`${event}\n\n`);
         }
       }
     }
 
-    // Varmista, että stream päättyy [DONE]-viestillä
-    yield textEncoder.encode("data: [DONE]\n\n");
+    // Striimin loppuminen ilman done-tapahtumaa kertoo asiakkaalle, että yhteys katkesi
+    if (buffer.trim()) {
+      yield textEncoder.encode(`${buffer}\n\n`);
+    }
   } catch (error) {
     console.error("[ROUTE] Error in streaming:", error);
     yield textEncoder.encode(`data: {"error": "Streaming failed:"}\n\n`);
@@ -148,7 +154,11 @@ export async function GET(request: NextRequest) {
 
   try {
     // Ensin yritetään striimausta
-    const iterator = fetchBackendStream(userId, message);
+    const iterator = fetchBackendStream(
+      userId,
+      message,
+      request.headers.get("last-event-id"),
+    );
     const stream = iteratorToStream(iterator);
 
     return new Response(stream, { headers });
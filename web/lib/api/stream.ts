@@ -3,103 +3,188 @@
  *
  * This implementation always uses server actions in Rahti environment,
  * and direct browser streaming in local development.
+ *
+ * The backend sends deltas as typed SSE events (queued, token, tool-start,
+ * tool-end, snapshot, error, done). The accumulated text is passed to onChunk,
+ * so callers always receive the full response so far. Queued events report the
+ * position of a turn waiting for a free slot and carry no text. If the connection drops before the
+ * done event, the stream is resumed with the Last-Event-ID header.
  */
 export type StreamChunkCallback = (chunk: string) => void;
+
+const MAX_RECONNECT_ATTEMPTS = 3;
+
+// Errors reported by the server, the stream is not resumed after these
+class StreamError extends Error {}
+
+interface ServerSentEvent {
+  id?: string;
+  event: string;
+  data: string;
+}
+
+function parseServerSentEvent(block: string): ServerSentEvent | null {
+  const event: ServerSentEvent = { event: "message", data: "" };
+  const dataLines: string[] = [];
+
+  for (const line of block.split(/\r?\n/)) {
+    if (!line || line.startsWith(":")) continue;
+
+    const separator = line.indexOf(":");
+    const field = separator === -1 ? line : line.slice(0, separator);
+    let value = separator === -1 ? "" : line.slice(separator + 1);
+    if (value.startsWith(" ")) value = value.slice(1);
+
+    if (field === "data") dataLines.push(value);
+    else if (field === "event") event.event = value;
+    else if (field === "id") event.id = value;
+  }
+
+  if (dataLines.length === 0) return null;
+  event.data = dataLines.join("\n");
+  return event;
+}
+
 export async function streamChatMessage(
   userId: string,
   message: string,
   onChunk: StreamChunkCallback,
 ): Promise<void> {
-  try {
-    // Käytä paikallista Next.js Route Handleria proxyn sijaan
-    // Tämä kiertää OpenShift/Rahti proxyn aiheuttamat ongelmat
-    const url = `/api/chat/stream?user_id=${encodeURIComponent(
-      userId,
-    )}&message=${encodeURIComponent(message)}`;
-
-    const response = await fetch(url, {
-      cache: "no-store",
-      headers: {
-        "Cache-Control": "no-cache",
-      },
-    });
-
-    if (!response.ok) {
-      console.error(`[STREAM] Request failed: ${response.status}`);
-      throw new Error(`Stream request failed: ${response.status}`);
+  // Käytä paikallista Next.js Route Handleria proxyn sijaan
+  // Tämä kiertää OpenShift/Rahti proxyn aiheuttamat ongelmat
+  const url = `/api/chat/stream?user_id=${encodeURIComponent(
+    userId,
+  )}&message=${encodeURIComponent(message)}`;
+
+  let text = "";
+  let lastEventId: string | undefined;
+  let attempt = 0;
+
+  // Handles one event, returns true when the stream is complete
+  const handleEvent = (event: ServerSentEvent): boolean => {
+    if (event.id) lastEventId = event.id;
+
+    switch (event.event) {
+      case "token":
+        text += JSON.parse(event.data).delta;
+        onChunk(text);
+        return false;
+      case "tool-end":
+        text += `\n[used tool "${JSON.parse(event.data).name}"]\n`;
+        onChunk(text);
+        return false;
+      case "snapshot":
+        text = JSON.parse(event.data).text;
+        onChunk(text);
+        return false;
+      case "queued":
+        console.info(
+          `[STREAM] Waiting in queue, position ${JSON.parse(event.data).position}`,
+        );
+        return false;
+      case "tool-start":
+        return false;
+      case "error": {
+        const error = JSON.parse(event.data).error;
+        console.error(`[STREAM] Error from server: ${error}`);
+        throw new StreamError(error);
+      }
+      case "done":
+        return true;
+    }
+
+    // Full-snapshot format, e.g. from the fallback route
+    if (event.data === "[DONE]") return true;
+
+    let parsedData;
+    try {
+      parsedData = JSON.parse(event.data);
+    } catch {
+      // If it's not valid JSON but not empty, use as is
+      if (event.data.trim()) onChunk(event.data);
+      return false;
     }
 
-    if (!response.body) {
-      throw new Error("ReadableStream not supported in this browser");
+    // Check if we received an error
+    if (parsedData.error) {
+      console.error(`[STREAM] Error from server: ${parsedData.error}`);
+      throw new StreamError(parsedData.error);
     }
 
-    const reader = response.body.getReader();
-    const decoder = new TextDecoder();
-    let buffer = "";
+    text = parsedData;
+    onChunk(text);
+    return false;
+  };
+
+  while (true) {
+    const headers: Record<string, string> = { "Cache-Control": "no-cache" };
+    if (lastEventId) headers["Last-Event-ID"] = lastEventId;
 
-    while (true) {
-      const { done, value } = await reader.read();
+    try {
+      const response = await fetch(url, { cache: "no-store", headers });
 
-      if (done) {
-        break;
+      if (!response.ok) {
+        console.error(`[STREAM] Request failed: ${response.status}`);
+        throw new StreamError(`Stream request failed: ${response.status}`);
       }
 
-      // Decode chunk and add to buffer
-      const text = decoder.decode(value, { stream: true });
-      buffer += text;
+      if (!response.body) {
+        throw new StreamError("ReadableStream not supported in this browser");
+      }
 
-      // Process events in buffer
-      const events = buffer.split(/\r?\n\r?\n/);
-      buffer = events.pop() || ""; // Keep the last incomplete event in buffer
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
 
-      for (const event of events) {
-        if (event.startsWith("data: ")) {
-          const data = event.slice(6); // Remove "data: " prefix
+      while (true) {
+        const { done, value } = await reader.read();
 
-          if (data === "[DONE]") {
-            return;
-          }
+        if (done) {
+          break;
+        }
+
+        // Decode chunk and add to buffer
+        buffer += decoder.decode(value, { stream: true });
+
+        // Process events in buffer
+        const blocks = buffer.split(/\r?\n\r?\n/);
+        buffer = blocks.pop() || ""; // Keep the last incomplete event in buffer
 
-          try {
-            // Try to parse JSON data
-            const parsedData = JSON.parse(data);
-
-            // Check if we received an error
-            if (parsedData.error) {
-              console.error(`[STREAM] Error from server: ${parsedData.error}`);
-              throw new Error(parsedData.error);
-            }
-
-            // Otherwise process normal response
-            onChunk(parsedData);
-          } catch {
-            // If it's not valid JSON but not empty, use as is
-            if (data.trim() && !data.includes("[DONE]")) {
-              onChunk(data);
-            }
+        for (const block of blocks) {
+          const event = parseServerSentEvent(block);
+          if (event && handleEvent(event)) {
+            return;
           }
         }
       }
-    }
 
-    // Process any remaining data in buffer
-    if (buffer && buffer.startsWith("data: ")) {
-      const data = buffer.slice(6);
-      if (data && data !== "[DONE]") {
-        try {
-          const parsedData = JSON.parse(data);
-          if (!parsedData.error) {
-            onChunk(parsedData);
-          }
-        } catch {
-          if (data.trim() && !data.includes("[DONE]")) {
-            onChunk(data);
-          }
-        }
+      // Process any remaining data in buffer
+      const event = parseServerSentEvent(buffer);
+      if (event && handleEvent(event)) {
+        return;
+      }
+
+      // Old full-snapshot streams carry no event ids and may end without [DONE]
+      if (lastEventId === undefined) {
+        return;
       }
+
+      throw new Error("Stream ended before completion");
+    } catch (error) {
+      // Resume from the last received event if the connection dropped
+      const canResume =
+        lastEventId !== undefined &&
+        attempt < MAX_RECONNECT_ATTEMPTS &&
+        !(error instanceof StreamError) &&
+        !(error instanceof SyntaxError);
+
+      if (!canResume) {
+        console.error("[STREAM] Stream error:", error);
+        throw error;
+      }
+
+      attempt += 1;
+      console.warn(`[STREAM] Connection lost, resuming from ${lastEventId}`);
     }
-  } catch (error) {
-    console.error("[STREAM] Stream error:", error);
-    throw error;
   }
 }
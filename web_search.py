@@ -0,0 +1,400 @@
+"""
+Cached web search for the learning assistant agents
+
+Students of the same cohort ask nearly the same questions, so search results
+are cached by a normalized form of the query: in memory with a TTL and an LRU
+size bound, and in a SQLite file that survives restarts and is shared by the
+workers on the host. The search itself is done by a pluggable backend, either
+Tavily or an offline fixture backend used for benchmarks and development.
+
+Raw page content is not passed to the agent as is: extract_results strips
+boilerplate, ranks the paragraphs of each page against the question and keeps
+the best ones within a token budget per result.
+"""
+
+import asyncio
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+QUERY_TERM_PATTERN = re.compile(r'[a-z0-9]+')
+QUERY_WORD_PATTERN = re.compile(r'\w+')
+QUERY_STOP_WORDS = frozenset(
+    'a an and are can do does for how i in is it me my of on should the to what when where which who why with you your'.split()
+)
+
+def normalize_query(query: str) -> str:
+    """
+    Returns the normalized form of a query used in cache keys.
+
+    Only case, punctuation and whitespace are ignored, so "How do I write a Lean
+    Canvas?" and "how do I write a lean canvas" share a key. Question words and
+    word order are kept, as they change what is searched for.
+    """
+    return ' '.join(QUERY_WORD_PATTERN.findall(query.lower())) or query.strip().lower()
+
+# --- BACKENDS ---
+# A backend returns a list of result dicts (title, url, content, ...), or an
+# error message string. Error messages are passed to the agent but not cached.
+class TavilyBackend:
+    """Searches with Tavily, the results are the same as from TavilySearchResults"""
+
+    name = 'tavily'
+
+    def __init__(self, **tool_options):
+        from langchain_community.tools import TavilySearchResults
+        self.tool = TavilySearchResults(**tool_options)
+
+    def search(self, query: str) -> Union[List[Dict], str]:
+        return self.tool.invoke({"query": query})
+
+    async def asearch(self, query: str) -> Union[List[Dict], str]:
+        return await self.tool.ainvoke({"query": query})
+
+class FixtureBackend:
+    """
+    Offline backend answering from a JSON file of {query: results}.
+
+    Queries missing from the file get generated placeholder results. latency
+    seconds are waited per search to stand in for the network round-trip.
+    """
+
+    name = 'fixture'
+
+    def __init__(self, path: Optional[str] = None, latency: float = 0.0, max_results: int = 5):
+        self.latency = latency
+        self.max_results = max_results
+        self.calls = 0
+        self.fixtures = {}
+        if path:
+            with open(path, encoding='utf-8') as f:
+                self.fixtures = {normalize_query(query): results for query, results in json.load(f).items()}
+
+    def _results(self, query: str) -> List[Dict]:
+        self.calls += 1
+        key = normalize_query(query)
+        if key in self.fixtures:
+            return self.fixtures[key]
+        slug = key.replace(' ', '-')
+        return [{
+            "title": f"{query} ({rank})",
+            "url": f"https://example.com/{slug}/{rank}",
+            "content": f"Placeholder search result {rank} for: {query}",
+            "score": round(1 - rank / 10, 2)
+        } for rank in range(1, self.max_results + 1)]
+
+    def search(self, query: str) -> List[Dict]:
+        time.sleep(self.latency)
+        return self._results(query)
+
+    async def asearch(self, query: str) -> List[Dict]:
+        await asyncio.sleep(self.latency)
+        return self._results(query)
+
+# --- CONTENT EXTRACTION ---
+BOILERPLATE_PATTERN = re.compile(
+    r'cookie|privacy policy|terms of (use|service)|all rights reserved|subscribe|newsletter|sign (in|up)|log ?in'
+    r'|skip to (main )?content|share (this|on)|follow us|advertisement|javascript|accept all|copyright|©',
+    re.IGNORECASE
+)
+LINK_ONLY_PATTERN = re.compile(r'^[\s*\-#>|]*(!?\[[^\]]*\]\([^)]*\)[\s*\-|]*)+$')
+MIN_PARAGRAPH_WORDS = 8  # Shorter lines are treated as navigation, headings or buttons
+CHARS_PER_TOKEN = 4
+extraction_stats = {"calls": 0, "results": 0, "bytes_in": 0, "bytes_out": 0}
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def split_paragraphs(text: str, max_chars: int) -> List[str]:
+    """Splits page text into content paragraphs, dropping boilerplate and duplicates"""
+    paragraphs = []
+    seen = set()
+    for block in re.split(r'\n\s*\n', text):
+        for line in block.split('\n'):
+            line = ' '.join(line.split())
+            if (len(QUERY_TERM_PATTERN.findall(line.lower())) < MIN_PARAGRAPH_WORDS or LINK_ONLY_PATTERN.match(line)
+                    or (len(line) < 300 and BOILERPLATE_PATTERN.search(line)) or line in seen):
+                continue
+            seen.add(line)
+            # Very long paragraphs are cut at sentence ends, so one of them cannot fill the budget
+            while len(line) > max_chars:
+                cut = line.rfind('. ', 0, max_chars) + 1 or max_chars
+                paragraphs.append(line[:cut].strip())
+                line = line[cut:].strip()
+            if line:
+                paragraphs.append(line)
+    return paragraphs
+
+def fold_plural(term: str) -> str:
+    return term[:-1] if term.endswith('s') and not term.endswith('ss') and len(term) > 3 else term
+
+def rank_paragraphs(paragraphs: List[str], question: str) -> List[int]:
+    """Returns the indices of paragraphs containing question terms, ordered by BM25 relevance"""
+    query_terms = {fold_plural(term) for term in QUERY_TERM_PATTERN.findall(question.lower())
+                   if term not in QUERY_STOP_WORDS}
+    paragraph_terms = [[fold_plural(term) for term in QUERY_TERM_PATTERN.findall(paragraph.lower())]
+                       for paragraph in paragraphs]
+    average_length = sum(map(len, paragraph_terms)) / max(1, len(paragraphs))
+    document_frequency = {term: sum(term in terms for terms in paragraph_terms) for term in query_terms}
+
+    scores = []
+    for terms in paragraph_terms:
+        score = 0.0
+        for term in query_terms:
+            frequency = terms.count(term)
+            if frequency:
+                idf = math.log(1 + (len(paragraphs) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                score += idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * len(terms) / max(1, average_length)))
+        scores.append(score)
+    return sorted((index for index in range(len(paragraphs)) if scores[index] > 0), key=lambda index: (-scores[index], index))
+
+def extract_result(result: Dict, question: str, token_budget: int) -> Dict:
+    """Returns the result with its snippet and the most relevant raw content within token_budget"""
+    snippet = ' '.join(str(result.get('content', '')).split())
+    budget = token_budget - estimate_tokens(snippet)
+    paragraphs = split_paragraphs(result.get('raw_content') or '', max_chars=max(200, token_budget * CHARS_PER_TOKEN // 2))
+
+    selected = []
+    for index in rank_paragraphs(paragraphs, question):
+        cost = estimate_tokens(paragraphs[index])
+        if cost <= budget and paragraphs[index] not in snippet:
+            selected.append(index)
+            budget -= cost
+
+    # Selected paragraphs are shown in page order
+    content = '\n\n'.join([snippet] + [paragraphs[index] for index in sorted(selected)]).strip()
+    extracted = {"title": result.get('title', ''), "url": result.get('url', ''), "content": content}
+    if 'score' in result:
+        extracted['score'] = result['score']
+    return extracted
+
+def extract_results(results: Union[List[Dict], str], question: str, token_budget: int) -> Union[List[Dict], str]:
+    """
+    Reduces search results to the content relevant to the question.
+
+    Args:
+        results: Backend results, error message strings are returned as is
+        question: Search query and the student's question, used for ranking
+        token_budget: Max. estimated tokens per result
+    """
+    if not isinstance(results, list):
+        return results
+    extracted = [extract_result(result, question, token_budget) for result in results]
+
+    bytes_in = len(json.dumps(results).encode())
+    bytes_out = len(json.dumps(extracted).encode())
+    extraction_stats["calls"] += 1
+    extraction_stats["results"] += len(results)
+    extraction_stats["bytes_in"] += bytes_in
+    extraction_stats["bytes_out"] += bytes_out
+    print(f'Search results extracted: {bytes_in} bytes -> {bytes_out} bytes')
+    return extracted
+
+# --- CACHE ---
+DISK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_results (
+    query_key TEXT PRIMARY KEY,
+    backend TEXT NOT NULL,
+    results TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS search_results_created_at ON search_results (created_at);
+"""
+
+class CachedSearch:
+    """
+    Search backend with a normalized-query cache.
+
+    Args:
+        backend: TavilyBackend, FixtureBackend or another object with search/asearch
+        ttl: Seconds a result stays valid in both tiers
+        capacity: Max. queries kept in memory, least recently used ones are dropped
+        db_path: SQLite file of the persistent tier, None for memory only
+        db_max_rows: Max. results kept in the persistent tier, the oldest ones are dropped, None for no limit
+        purge_every: Expired and surplus results are deleted on startup and after this many disk writes
+    """
+
+    def __init__(self, backend, ttl: float, capacity: int, db_path: Optional[str] = None,
+                 db_max_rows: Optional[int] = None, purge_every: int = 100):
+        self.backend = backend
+        self.ttl = ttl
+        self.capacity = capacity
+        self.db_path = db_path
+        self.db_max_rows = db_max_rows
+        self.purge_every = purge_every
+        self.purged = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.backend_seconds = 0.0
+        self._entries = OrderedDict()  # query key -> (created_at, results)
+        self._in_flight = {}  # query key -> future of a running async search
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disk_writes = 0
+
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.executescript(DISK_SCHEMA)
+            self.purge_expired()
+
+    def _key(self, query: str) -> str:
+        """Returns the cache key of a query, results of different backends do not share keys"""
+        return f'{self.backend.name}:{normalize_query(query)}'
+
+    def search(self, query: str) -> Union[List[Dict], str]:
+        """Returns cached results for the query, searching with the backend on a miss"""
+        key = self._key(query)
+        results = self._get_memory(key)
+        if results is None:
+            results = self._get_disk(key)
+        if results is not None:
+            return results
+
+        self.misses += 1
+        start = time.perf_counter()
+        results = self.backend.search(query)
+        self.backend_seconds += time.perf_counter() - start
+        if isinstance(results, list):
+            self._put_memory(key, results)
+            self._put_disk(key, results)
+        return results
+
+    async def asearch(self, query: str) -> Union[List[Dict], str]:
+        """Async version of search, concurrent misses for the same query share one backend call"""
+        key = self._key(query)
+        results = self._get_memory(key)
+        if results is None and self._conn is not None:
+            results = await asyncio.to_thread(self._get_disk, key)
+        if results is not None:
+            return results
+
+        if key in self._in_flight:
+            self.memory_hits += 1
+            leader = self._in_flight[key]
+            try:
+                return await asyncio.shield(leader)
+            except asyncio.CancelledError:
+                if not leader.cancelled():
+                    raise
+            # The search this one waited for was cancelled, search again
+            self.memory_hits -= 1
+            return await self.asearch(query)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            start = time.perf_counter()
+            results = await self.backend.asearch(query)
+            self.backend_seconds += time.perf_counter() - start
+            if isinstance(results, list):
+                self._put_memory(key, results)
+                if self._conn is not None:
+                    await asyncio.to_thread(self._put_disk, key, results)
+            future.set_result(results)
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve the exception, so that a search without waiters does not log it
+            future.exception()
+            raise
+        finally:
+            # A cancelled search cancels the future, so that its waiters do not wait forever
+            if not future.done():
+                future.cancel()
+            del self._in_flight[key]
+        return results
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return entry[1]
+
+    def _put_memory(self, key, results, created_at=None):
+        with self._lock:
+            self._entries[key] = (created_at or time.time(), results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def _get_disk(self, key):
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT results, created_at FROM search_results WHERE query_key = ? AND backend = ? AND created_at > ?',
+                (key, self.backend.name, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        results = json.loads(row[0])
+        self._put_memory(key, results, created_at=row[1])
+        return results
+
+    def _put_disk(self, key, results):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?)',
+                (key, self.backend.name, json.dumps(results), time.time())
+            )
+            self._disk_writes += 1
+            purge = self._disk_writes % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        """
+        Deletes expired results from the persistent tier, and the oldest ones
+        beyond db_max_rows. Returns the number deleted.
+        """
+        if self._conn is None:
+            return 0
+        with self._lock:
+            deleted = self._conn.execute(
+                'DELETE FROM search_results WHERE created_at <= ?', (time.time() - self.ttl,)
+            ).rowcount
+            if self.db_max_rows is not None:
+                deleted += self._conn.execute(
+                    'DELETE FROM search_results WHERE query_key IN '
+                    '(SELECT query_key FROM search_results ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                    (self.db_max_rows,)
+                ).rowcount
+        self.purged += deleted
+        return deleted
+
+    def stats(self) -> Dict:
+        """Returns cache metrics"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "ttl": self.ttl,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "purged": self.purged,
+            "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            "backend_seconds": round(self.backend_seconds, 3)
+        }